@@ -15,7 +15,9 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
-import sys, getopt, os, re, string, stat, subprocess, math, shlex, time
+import sys, getopt, os, re, string, stat, subprocess, math, shlex, time, collections, array
+import zlib, struct, base64, cgi, bisect, fcntl, termios, json, csv, threading, BaseHTTPServer, resource, cProfile, heapq
+import gzip, calendar, signal, select, glob, itertools, tarfile
 from multiprocessing import Process, Lock, Manager, Value, Array
 import multiprocessing
 
@@ -28,37 +30,60 @@ class global_variables:
         self.verbose           = False                       # Verbose logging (-v flag)
         self.debug             = False                       # Debug log level (-x flag)
         self.single_threaded   = False                       # Single threaded for debug/profiling
-        self.manager           = Manager()                   # Multiprocess sync object
+        self.profile           = ''                          # Print per-phase timings: text or json (--profile flag)
+        self.cprofile          = ''                          # Write cProfile output for main and worker processes here (--cprofile flag)
+        self.main_pid          = os.getpid()                 # PID of the main process (profiled phases in other processes are workers)
+        self.phase_last        = None                        # (wall, cpu) time of the last profiled phase mark in this process
+        self.manager           = None                        # Multiprocess sync object, started by start_manager() when workers need it
+        self.shared_dicts      = ['reads', 'writes', 'r_totals', 'w_totals', 'files_to_lbas', 'bucket_to_files',
+                                  'latency_hists', 'proc_stats', 'stream_stats'] # Moved to the Manager by start_manager()
+        self.shared_lists      = ['profile_records', 'spill_runs', 'region_parts', 'roi_parts', 'overwrite_parts', 'burst_parts',
+                                  'stream_parts'] # Moved to the Manager by start_manager()
 
         self.io_total          = Value('L', 0)               # Number of total I/O's
         self.read_total        = Value('L', 0)               # Number of buckets read (1 I/O can touch many buckets)
         self.write_total       = Value('L', 0)               # Number of buckets written (1 I/O can touch many buckets)
-        self.reads             = self.manager.dict()         # Array of read hits by bucket ID
-        self.writes            = self.manager.dict()         # Array of write hits by bucket ID
-        self.r_totals          = self.manager.dict()         # Hash of read I/O's with I/O size as key
-        self.w_totals          = self.manager.dict()         # Hash of write I/O's with I/O size as key
+        self.reads             = {}                          # Array of read hits by bucket ID
+        self.writes            = {}                          # Array of write hits by bucket ID
+        self.r_totals          = {}                          # Hash of read I/O's with I/O size as key
+        self.w_totals          = {}                          # Hash of write I/O's with I/O size as key
         self.bucket_hits_total = Value('L', 0)               # Total number of bucket hits (not the total buckets)
         self.total_blocks      = Value('L', 0)               # Total number of LBA's accessed during profiling
-        self.files_to_lbas     = self.manager.dict()         # Files and the lba ranges associated with them
+        self.files_to_lbas     = {}                          # Files and the lba ranges associated with them
         self.max_bucket_hits   = Value('L', 0)               # The hottest bucket
-        self.bucket_to_files   = self.manager.dict()         # List of files that reside on each bucket
+        self.bucket_to_files   = {}                          # List of files that reside on each bucket
         self.term              = Value('L', 0)               # Thread pool done with work
         self.trace_files       = False                       # Map filesystem files to block LBAs
+        self.detail_trace      = Value('L', 0)               # Trace has timestamped (detail) events for a second pass
+        self.latency_hists     = {}                          # Latency histograms keyed by (metric, rw, class, value)
+        self.inflight_dropped  = Value('L', 0)               # I/O's evicted from the in-flight table before completing
+        self.proc_stats        = {}                          # Per-process counters keyed by (pid, command), pid None for folded commands
+        self.stream_stats      = {}                          # Sequential stream counters keyed by (rw, kind, class)
+        self.profile_records   = []                          # Profiled phases: (phase, worker, wall, cpu, events, max rss)
+        self.spill_runs        = []                          # (kind, name) of the sorted on-disk runs written in out-of-core mode
+        self.region_parts      = []                          # Per-worker region counters, merged by region_totals()
+        self.roi_parts         = []                          # Per-worker region of interest counters, merged by roi_totals()
+        self.stream_parts      = []                          # Per-byte range (segment, head I/O's, head runs, open streams, last LBA's), stitched by stream_totals()
+        self.overwrite_parts   = []                          # Per-segment (segment, blocks written, block state, interval histogram), stitched by overwrite_totals()
+        self.burst_parts       = []                          # Per-trace (arrival-rate states, {queue depth: seconds}), merged by print_bursts()
 
-        ### Semaphores: These are the locks for the shared variables
-        self.read_semaphore            = self.manager.Lock() # Lock for the global read hit array
-        self.write_semaphore           = self.manager.Lock() # Lock for the global write hit array
-        self.read_totals_semaphore     = self.manager.Lock() # Lock for the global read totals
-        self.write_totals_semaphore    = self.manager.Lock() # Lock for the global write totals
-        self.total_semaphore           = self.manager.Lock() # Lock for the global I/O totals
-        self.total_blocks_semaphore    = self.manager.Lock() # Lock for the global total LBA's accessed
-        self.files_to_lbas_semaphore   = self.manager.Lock() # Lock for the global file->lba mapping hash
-        self.max_bucket_hits_semaphore = self.manager.Lock() # Lock for the global maximum hits per bucket
-        self.bucket_to_files_semaphore1 = self.manager.Lock() # Lock for the global bucket_to_files
-        self.bucket_to_files_semaphore2 = self.manager.Lock() # Lock for the global bucket_to_files
-        self.term_semaphore            = self.manager.Lock() # Lock for the global TERM
-        self.trace_files_semaphore     = self.manager.Lock() # Lock for the global trace_files
-        self.file_hit_count_semaphore  = self.manager.Lock() # Lock for the global file_hit_count
+        ### Semaphores: These are the locks for the shared variables (Manager locks once start_manager() runs)
+        self.read_semaphore            = threading.Lock()    # Lock for the global read hit array
+        self.write_semaphore           = threading.Lock()    # Lock for the global write hit array
+        self.read_totals_semaphore     = threading.Lock()    # Lock for the global read totals
+        self.write_totals_semaphore    = threading.Lock()    # Lock for the global write totals
+        self.total_semaphore           = threading.Lock()    # Lock for the global I/O totals
+        self.total_blocks_semaphore    = threading.Lock()    # Lock for the global total LBA's accessed
+        self.files_to_lbas_semaphore   = threading.Lock()    # Lock for the global file->lba mapping hash
+        self.max_bucket_hits_semaphore = threading.Lock()    # Lock for the global maximum hits per bucket
+        self.bucket_to_files_semaphore1 = threading.Lock()    # Lock for the global bucket_to_files
+        self.bucket_to_files_semaphore2 = threading.Lock()    # Lock for the global bucket_to_files
+        self.term_semaphore            = threading.Lock()    # Lock for the global TERM
+        self.trace_files_semaphore     = threading.Lock()    # Lock for the global trace_files
+        self.file_hit_count_semaphore  = threading.Lock()    # Lock for the global file_hit_count
+        self.latency_semaphore         = threading.Lock()    # Lock for the global latency histograms
+        self.proc_semaphore            = threading.Lock()    # Lock for the global per-process counters
+        self.stream_semaphore          = threading.Lock()    # Lock for the global stream counters
 
         # Thread-local variables.  Use these to avoid locking constantly
         self.thread_io_total   = 0          # Thread-local total I/O count (I/O ops)
@@ -71,6 +96,23 @@ class global_variables:
         self.thread_writes = {}             # Thread-local write count hash (buckets)
         self.thread_total_blocks = 0        # Thread-local total blocks accessed (lbas)
         self.thread_max_bucket_hits = 0     # Thread-local maximum bucket hits (bucket hits)
+        self.thread_latency_hists = {}      # Thread-local latency histograms (usec)
+        self.thread_inflight_dropped = 0    # Thread-local in-flight table evictions (I/O ops)
+        self.thread_proc_ids = {}           # Thread-local (pid, command) -> interned process ID
+        self.thread_proc_counters = array.array('L') # Thread-local per-process counters, proc_stride per process ID
+        self.thread_streams = {'R': collections.OrderedDict(), 'W': collections.OrderedDict()} # Thread-local next expected LBA -> [run I/O's, run sectors]
+        self.thread_last_lba = {'R': -1, 'W': -1} # Thread-local end LBA of the previous I/O
+        self.thread_stream_stats = {}       # Thread-local stream counters keyed by (rw, kind, class)
+        self.thread_stream_head = None      # Thread-local I/O's of a byte range before its stream table filled: rw -> [(tag, lba, end, streams, last)]
+        self.thread_head_state = {}         # Thread-local head recording per rw: 'open', 'full' (the table filled) or 'cut' (stream_head_max)
+        self.thread_head_runs = {}          # Thread-local (I/O's, sectors) of finished runs opened in the head, rw -> {tag: run}
+        self.thread_spill_count = 0         # Thread-local number of spill runs written
+        self.thread_region_stats = {}       # Thread-local region counters keyed by (kind, name)
+        self.thread_roi = None              # Thread-local region of interest (reads, writes) dicts of touched fine buckets per range
+        self.thread_segment = (0, 0)        # Thread-local trace order of the segment being parsed: (trace number, offset)
+        self.thread_write_clock = 0         # Thread-local blocks written so far in this segment
+        self.thread_overwrite_chunks = {}   # Thread-local chunk -> (last stamp, writes, first stamp) arrays per block
+        self.thread_overwrite_hist = []     # Thread-local overwrite interval histogram (HDR, in blocks), sized when enabled
 
         # Globals
         self.file_hit_count    = {}         # Count of I/O's to each file
@@ -78,10 +120,57 @@ class global_variables:
         self.total_lbas        = 0          # Total logical blocks, regardless of sector size
         self.tarfile           = ''         # .tar file outputted from 'trace' mode
         self.fdisk_file        = ""         # File capture of fdisk tool output
+        self.meta_file         = "ioprof.meta.json" # Trace metadata member of the tarball
+        self.meta_version      = 1          # Newest trace metadata format version this script reads and writes
+        self.bucket_counts     = None       # Merged per-bucket I/O counts (array, built on demand)
+        self.bucket_file       = ''         # Out-of-core mode: merged run of (bucket, reads, writes) in bucket order
+        self.files_file        = ''         # Out-of-core mode: merged run of (start bucket, finish bucket, file)
+        self.regions           = []         # Region interval tables: (kind, sorted starts, [(start, end, mapping)])
+        self.region_sizes      = {}         # Region sizes in sectors keyed by (kind, name)
+        self.region_report     = []         # Per-region results for --format output
+        self.region_batch      = 4096       # I/O's attributed to regions per batch
+        self.roi_ranges        = []         # Regions of interest: sorted (start, end) LBA's (--lba-range flag)
+        self.roi_starts        = []         # Start LBA of each region of interest
+        self.roi_min           = 0          # Lowest LBA in any region of interest
+        self.roi_max           = 0          # End of the highest region of interest
+        self.roi_buckets       = []         # Fine buckets in each region of interest
+        self.roi_report        = []         # Per-region of interest results for --format output
+        self.overwrite         = False      # Track per-block writes for the overwrite analysis ('post' mode --overwrites flag)
+        self.overwrite_head    = (0, 0)     # Segment the trace starts with, which needs no first stamps to stitch it
+        self.overwrite_max_chunks = 0       # Overwrite state chunks a process may keep under --memory (0 = no limit)
+        self.overwrite_report  = None       # Write working set and overwrite results for --format output
+        self.burst_report      = None       # Arrival-rate and queue depth results for --format output
+        self.hot_file          = ''         # File for the hot extent list (--hot-extents flag)
+        self.iolog_file        = ''         # fio iolog to convert the trace into, instead of a report (--fio-iolog flag)
+        self.iolog_version     = 2          # fio iolog format version: 2 (wait actions) or 3 (fio 3.31+, timestamped lines)
+        self.iolog_device      = ''         # Device name written into the iolog (default: the traced device)
+        self.iolog_time_scale  = 1.0        # Multiply the trace's timing by this (0: replay as fast as possible)
+        self.iolog_remap_gib   = 0          # Map LBA's proportionally onto a target device of this size (0: keep them)
+        self.iolog_rw          = 'all'      # Only export 'read', 'write' or 'trim' I/O's
+        self.diff_inputs       = []         # 'diff' mode: before and after tarballs or --format json records (-t flags)
+        self.diff_ranges       = 64         # 'diff' mode: LBA ranges the device is split into to show where heat moved
+        self.fio_job_file      = ''         # fio job file for the fitted synthetic workload (--fio-job flag)
+        self.model_report      = None       # Fitted workload model for --format output
+        self.harmonic_terms    = 1000000    # Terms of a harmonic number summed exactly, the rest is integrated
+        self.trace_seconds     = 0          # Seconds of I/O the trace or store range covers (0 = unknown)
+        self.hot_percent       = 80.0       # Hot extents cover this percent of bucket hits (--hot-percent flag)
+        self.hot_gib           = 0          # Hot extents are at most this many GiB (--hot-gib flag, 0 = no limit)
+        self.extent_units      = 'device'   # Hot extent LBA's relative to the 'device' or each 'partition' (--extent-units flag)
 
         self.top_files         = []         # Top files list
+        self.top_file_hits     = []         # Top files: (percent, I/O's, filename)
+        self.zipf_theta        = None       # Approximate Zipfian theta: (min, max, estimate)
+        self.histogram_iops    = []         # IOPS histogram rows: (GB, I/O percent, cumulative percent)
+        self.report_heatmap    = ''         # Heatmap PNG for the report
+        self.report_histogram  = ''         # Histogram SVG chart for the report
+        self.report_stats      = ''         # I/O size SVG chart for the report
+        self.stats_iops        = []         # I/O size stats by IOPS: (label, percent, I/O's)
+        self.stats_bw          = []         # I/O size stats by bandwidth: (label, percent, GiB)
+        self.size_histogram    = []         # Power-of-two I/O size histogram: (size bytes, read I/O's, write I/O's)
         self.device            = ''         # Device (e.g. /dev/sdb)
         self.device_str        = ''         # Device string (e.g. sdb for /dev/sdb)
+        self.BLKSSZGET         = 0x1268     # ioctl: logical sector size (int)
+        self.BLKGETSIZE64      = 0x80081272 # ioctl: device size in bytes (u64)
 
         # Unit Scales
         self.KiB               = 1024       # 2^10
@@ -90,46 +179,124 @@ class global_variables:
 
         # Config settings
         self.bucket_size        = 1 * self.MiB # Size of the bucket for totaling I/O counts (e.g. 1MB buckets)
+        self.roi_bucket_size    = 4 * self.KiB # Fine bucket size inside the regions of interest (--roi-bucket flag)
+        self.roi_buckets_max    = 64 * self.MiB # Most fine buckets over all regions of interest
+        self.overwrite_block_size = 4 * self.KiB # Block size of the write working set and overwrite analysis
+        self.overwrite_chunk    = 64           # Blocks per lazily allocated overwrite state chunk (256 KiB of LBA's)
+        self.overwrite_chunk_bytes = 1700      # Estimated bytes per overwrite state chunk (arrays plus dict entry)
         self.num_buckets        = 1            # Number of total buckets for this device
         self.timeout            = 3            # Seconds between each print
         self.runtime            = 0            # Runtime for 'live' and 'trace' modes
         self.live_itterations   = 0            # How many iterations for live mode.  Each iteration is 'timeout' seconds long
+        self.half_life          = 60.0         # Half-life (seconds) of the decayed live mode hotness scores (--half-life flag, 0 = off)
+        self.decay_floor        = 0.01         # Decayed scores below this are dropped
+        self.decay_factor       = 1.0          # Decay per live interval, 0.5 ** (timeout / half_life)
+        self.decay_scores       = None         # Decayed hits per bucket, as of the bucket's epoch
+        self.decay_epochs       = None         # Live interval each bucket's score was last updated in
+        self.decay_live         = set()        # Buckets with a score above decay_floor
+        self.decay_report       = None         # Decayed histogram and hot sets for --format output
         self.sector_size        = 0            # Sector size (usually obtained with fdisk)
         self.percent            = 0.020        # Histogram threshold for each level (e.g. 0.02% of total drive size)
         self.total_capacity_gib = 0            # Total drive capacity
         self.mode               = ''           # Processing mode (live, trace, post)
-        self.pdf                = False        # Generate a PDF report instead of a text report
+        self.pdf                = False        # Generate an HTML report in addition to the text report
         self.top_count_limit    = 10           # How many files to list in Top Files list (e.g. Top 10 files)
         self.thread_count       = 0            # Thread Count
         self.cpu_affinity       = 0            # Tie each thread to a CPU for load balancing
         self.thread_max         = 32           # Max thread cout
         self.buffer_size        = 1024         # blktrace buffer size
         self.buffer_count       = 8            # blktrace buffer count
+        self.buffer_size_max    = 4096         # Largest blktrace buffer size when tuning for drops (KiB)
+        self.buffer_count_max   = 16           # Largest blktrace buffer count when tuning for drops
+        self.sample_every       = 1            # Trace 1 of every N intervals (raised when drops persist at the largest buffers)
+        self.sample_max         = 8            # Largest sampling interval
+        self.trace_events       = 0            # blktrace events captured (from its summaries or the capture log)
+        self.trace_dropped      = 0            # blktrace events dropped
+        self.sample_fraction    = 1.0          # Fraction of the capture intervals that were traced
+        self.drop_warn_percent  = 1.0          # Warn about the histogram when more than this percent of events were dropped
+        self.trace_block_size   = 16 * self.MiB # Uncompressed bytes per independently decompressible gzip member of a trace
+        self.trace_block_level  = 1            # gzip level for trace members (same as gzip --fast)
+        self.parse_workers      = multiprocessing.cpu_count() # Worker processes each block-compressed trace is split across
+        self.memory_limit       = 0            # Out-of-core mode memory ceiling in bytes (--memory flag, 0 = all in memory)
+        self.spill_entry_bytes  = 160          # Estimated bytes per in-memory bucket/file aggregate entry
+        self.spill_entries      = 0            # Aggregate entries a process keeps before spilling a sorted run (0 = never)
+        self.spill_fanin        = 64           # Max runs merged at once
+        self.latency            = False        # Capture D and C events for latency breakdown (--latency flag)
+        self.procs              = False        # Capture PID and command name of each I/O (--procs flag)
+        self.proc_max           = 1024         # Max processes tracked per worker, the rest are folded by command name
+        self.proc_size_classes  = 24           # Power-of-two I/O size classes per process (512B - 4GiB)
+        self.proc_stride        = 6 + self.proc_size_classes # Counters per process: r/w I/O's, r/w sectors, bucket hits, hot bucket hits, size mix
+        self.stream_max         = 32           # Max interleaved sequential streams tracked per read/write
+        self.stream_head_max    = 4096         # I/O's a byte range records for stitching onto the range before it, per read/write
+        self.blktrace_actions   = "-a queue"   # blktrace action mask
+        self.blkparse_format    = " %d %a %S %n\n" # blkparse output format
+        self.inflight_max       = 65536        # Max outstanding I/O's tracked when matching Q/D/C events
+        self.heat_classes       = [('hot', 50), ('warm', 80)] # Hottest buckets covering X% of bucket hits, rest are 'cold'
+        self.percentiles        = [50, 90, 99, 99.9, 99.99] # Latency percentiles to report
+        self.burst_resolutions  = [0.001, 0.01, 1.0] # Window sizes (seconds) for IOPS and bandwidth burstiness
+        self.burst_percentiles  = [50, 99]     # Per-window IOPS/bandwidth and queue depth percentiles to report
+        self.burst_ring         = 1024         # Newest windows kept per window size; older ones go into histograms
+        self.format             = ''           # Machine-readable output format: json or csv (--format flag)
+        self.output             = ''           # Machine-readable output file (--output flag, default <dev>.json/.csv)
+        self.output_buckets     = False        # Include per-bucket counts in machine-readable output (--buckets flag)
+        self.output_fo          = None         # Open machine-readable output file
+        self.output_csv         = None         # csv.writer for the output file
+        self.metrics_port       = 0            # Serve live mode metrics on this local port (--metrics-port flag, 0 = off)
+        self.hot_set_percents   = [50, 80, 90, 99] # Hot-set sizes exported as metrics (percent of bucket hits)
+        self.metrics_totals     = {}           # Metrics counters accumulated over all live intervals
+        self.metrics_buffers    = ["", ""]     # Double-buffered metrics snapshots (Prometheus text format)
+        self.metrics_front      = 0            # Index of the metrics buffer being served
+        self.store              = ''           # Daemon mode rollup store, also read by 'post' mode (--store flag)
+        self.store_levels       = [('minute', 60, "%Y%m%d%H%M"), ('hour', 3600, "%Y%m%d%H"), ('day', 86400, "%Y%m%d")] # Rollup levels: (name, seconds, UTC file name)
+        self.store_retention    = [1440, 720, 400] # Rollups kept per level (--retention flag)
+        self.store_from         = 0            # 'post' mode --store query start (epoch seconds)
+        self.store_to           = 0            # 'post' mode --store query end (epoch seconds, 0 = now)
+        self.rollup_totals      = ["io_total", "read_total", "write_total", "bucket_hits_total", "total_blocks", "dropped"] # Rollup counters
+        self.rollup_hashes      = ["r_totals", "w_totals", "reads", "writes"] # Rollup hashes, keyed by I/O size or bucket
+        self.daemon_stopping    = False        # Daemon mode got SIGTERM/SIGINT
 
-        # Gnuplot settings
-        self.x_width            = 800          # gnuplot x-width
-        self.y_height           = 600          # gnuplot y-height
+        # HDR histogram settings (log-bucketed, constant memory)
+        self.hdr_sub_bits       = 5            # 2^5 sub-buckets per power of two (~3% precision)
+        self.hdr_max_exp        = 32           # Largest power of two tracked above the sub-buckets (~38 hours in usec)
+        self.hdr_size           = (self.hdr_max_exp + 2) * (1 << (self.hdr_sub_bits - 1)) # Counters per histogram
+
+        # Analysis strings
+        self.analysis_histogram_iops = "Histogram analysis coming soon.\n"
+        self.analysis_heatmap        = "Heatmap analysis coming soon.\n"
+        self.analysis_stats_iops     = "IOPS analysis coming soon.\n"
+        self.analysis_stats_bw       = "Bandwidth analysis coming soon.\n"
+
+        # Report settings
+        self.x_width            = 800          # Heatmap x-width (pixels, one bucket per pixel)
+        self.y_height           = 600          # Heatmap y-height (pixels)
+        self.chart_width        = 800          # Histogram/stats chart width (pixels)
+        self.chart_height       = 600          # Histogram/stats chart height (pixels)
+        self.palette_stops      = [(0, (255, 255, 255)), (10, (0, 0, 255)), (20, (0, 160, 0)), (60, (255, 255, 0)), (70, (255, 165, 0)), (100, (255, 0, 0))] # Heatmap colors (percent of log scale)
 
         ### ANSI COLORS
-        self.black   = "\e[40m"
-        self.red     = "\e[41m"
-        self.green   = "\e[42m"
-        self.yellow  = "\e[43m"
-        self.blue    = "\e[44m"
-        self.magenta = "\e[45m"
-        self.cyan    = "\e[46m"
-        self.white   = "\e[47m"
-        self.none    = "\e[0m"
-
-        ### Heatmap Key
-        self.colors = [self.black, self.red, self.green, self.yellow, self.blue, self.magenta, self.cyan, self.white, self.none]
-
-        ### Heatmap Globals (TODO)
-        self.color_index = 0
-        self.choices = len(self.colors)
-        self.vpc = 1
-        self.cap = 0
-        self.rate = 0
+        self.black   = "\033[40m"
+        self.red     = "\033[41m"
+        self.green   = "\033[42m"
+        self.yellow  = "\033[43m"
+        self.blue    = "\033[44m"
+        self.magenta = "\033[45m"
+        self.cyan    = "\033[46m"
+        self.white   = "\033[47m"
+        self.none    = "\033[0m"
+
+        ### Heatmap Key (coldest to hottest)
+        self.colors = [self.white, self.blue, self.cyan, self.green, self.yellow, self.magenta, self.red]
+
+        ### Heatmap Globals
+        self.color_index = 0                # Index in heatmap key
+        self.choices = len(self.colors)     # Number of color choices
+        self.color_thresholds = []          # Cell value where each color after the first starts (quantiles)
+        self.cap = 0                        # Maximum IOPS per heatmap block
+        self.rate = 0                       # How densely we pack buckets into heatmap blocks
+        self.scale_x = 5                    # Scale heatmap to term width - scale_x chars
+        self.scale_y = 20                   # Scale heatmap to term height - scale_y chars
+        self.min_x = 5                      # Minimum terminal width in chars
+        self.min_y = 5                      # Minimum terminal height in chars
 
         self.mount_point        = ""
         self.extents            = []
@@ -146,20 +313,67 @@ def usage(g, argv):
     for opt in argv:
         print opt,
     print "\n\nUsage:"
-    print name + " -m trace -d <dev> -r <runtime> [-v] [-f] # run trace for post-processing later"
-    print name + " -m post  -t <dev.tar file>     [-v] [-p]   # post-process mode"
-    print name + " -m live  -d <dev> -r <runtime> [-v]        # live mode"
+    print name + " -m trace -d <dev> -r <runtime> [-v] [-f] [--latency] [--procs] # run trace for post-processing later"
+    print name + " -m post  -t <dev.tar file>     [-v] [-p] [--format json|csv] [--memory <MiB>] [--lba-range <start>:<end>] [--hot-extents <file>] [--overwrites] # post-process mode"
+    print name + " -m live  -d <dev> -r <runtime> [-v] [--format json|csv] [--metrics-port <port>] [--lba-range <start>:<end>] [--half-life <s>] # live mode"
+    print name + " -m post  -t <dev.tar file> --fio-iolog <file> [--iolog-version 2|3] [--time-scale <x>] [--remap-gib <N>] [--iolog-rw <rw>] # export for fio replay"
+    print name + " -m post  -t <dev.tar file>|--store <dir> --fio-job <file> # fit a synthetic workload and write an fio job for it"
+    print name + " -m diff  -t <before> -t <after> [-v] # compare two dev.tar files or '--format json --buckets' post records"
+    print name + " -m daemon -d <dev> [-r <runtime>] [--store <dir>] [--retention <m>,<h>,<d>] # capture rollups continuously"
+    print name + " -m post  --store <dir> [--from <time>] [--to <time>] [-p] [--format json|csv] [--hot-extents <file>] # report on a daemon time range"
     print "\nCommand Line Arguments:"
     print "-d <dev>            : The device to trace (e.g. /dev/sdb).  You can run traces to multiple devices (e.g. /dev/sda and /dev/sdb)"
     print "                      at the same time, but please only run 1 trace to a single device (e.g. /dev/sdb) at a time"
     print "-r <runtime>        : Runtime (seconds) for tracing"
     print "-t <dev.tar file>   : A .tar file is created during the 'trace' phase.  Please use this file for the 'post' phase"
     print "                      You can offload this file and run the 'post' phase on another system."
+    print "                      In 'diff' mode, give -t twice: the before and after tarballs or post '--format json --buckets' output."
     print "-v                  : (OPTIONAL) Print verbose messages."
     print "-f                  : (OPTIONAL) Map all files on the device specified by -d <dev> during 'trace' phase to their LBA ranges."
     print "                       This is useful for determining the most fequently accessed files, but may take a while on really large filesystems"
-    print "-p                  : (OPTIONAL) Generate a .pdf output file in addition to STDOUT.  This requires 'pdflatex', 'gnuplot' and 'terminal png'"
-    print "                       to be installed."
+    print "-p                  : (OPTIONAL) Generate a self-contained .html report (with a .png heatmap) in addition to STDOUT."
+    print "                       No external tools are required."
+    print "--latency           : (OPTIONAL) Also capture dispatch (D) and complete (C) events with timestamps during 'trace' phase."
+    print "                       The 'post' phase will report Q2D, D2C and Q2C latency percentiles."
+    print "--procs             : (OPTIONAL) Also capture the PID and command name of each I/O during 'trace' phase."
+    print "                       The 'post' phase will report the top processes and commands by IOPS."
+    print "--format <json|csv> : (OPTIONAL) Also write the results in a machine-readable format during 'post' and 'live' phases."
+    print "                       JSON output is newline-delimited, one record per run ('post') or per interval ('live')."
+    print "--output <file>     : (OPTIONAL) File for --format output (default: <dev>.json or <dev>.csv)."
+    print "--buckets           : (OPTIONAL) Include the read/write counts of every bucket that saw I/O in --format output."
+    print "--metrics-port <port> : (OPTIONAL) Serve live mode counters in Prometheus text format on http://127.0.0.1:<port>/metrics"
+    print "--memory <MiB>      : (OPTIONAL) Keep 'post' phase bucket and file aggregates under <MiB> by spilling sorted runs"
+    print "                       to the current directory and merging them at the end.  Results are the same as in memory."
+    print "                       The -p report, --hot-extents and the --latency/--procs detail pass still need one 8 byte"
+    print "                       count per bucket of the device on top of the ceiling."
+    print "--lba-range <start>:<end> : (OPTIONAL) Also count the I/O's between these LBA's (sectors) in fine buckets and print their"
+    print "                       stats and a zoomed heatmap in 'post' and 'live' modes.  Can be given more than once."
+    print "--roi-bucket <bytes> : (OPTIONAL) Bucket size inside --lba-range regions (default: 4096)."
+    print "--half-life <seconds> : (OPTIONAL) Also keep decayed per-bucket hit counts in 'live' mode, halving every <seconds>"
+    print "                       (default: 60, 0 = off), and show their heatmap and histogram next to the last interval's."
+    print "--overwrites        : (OPTIONAL) Report the write working set, overwrite intervals and hot/cold write split in 'post' mode."
+    print "                       Keeps state for every 4 KiB block written; under --memory it takes half of each worker's share."
+    print "--hot-extents <file> : (OPTIONAL) Write the hottest LBA extents ('start length hits' in sectors) to <file> in 'post' mode,"
+    print "                       for pinning them on a faster tier.  Adjacent hot buckets are merged into one extent."
+    print "--hot-percent <X>   : (OPTIONAL) Hot extents cover the hottest buckets with X% of bucket hits (default: 80)."
+    print "--hot-gib <N>       : (OPTIONAL) Limit the hot extents to the hottest N GiB."
+    print "--extent-units <device|partition> : (OPTIONAL) Write hot extents relative to the device (default) or to each partition."
+    print "--fio-iolog <file>  : (OPTIONAL) Convert the trace's queued I/O's into a fio iolog for 'fio --read_iolog=<file>' instead of"
+    print "                       reporting.  The tarball is streamed, so any size of trace converts in constant memory."
+    print "--iolog-version <2|3> : (OPTIONAL) iolog format (default: 2).  Version 3 needs fio 3.31 or later."
+    print "--iolog-device <dev> : (OPTIONAL) Device to replay on (default: the traced device)."
+    print "--time-scale <x>    : (OPTIONAL) Multiply the gaps between I/O's by x (default: 1, 0 = as fast as possible).  Timing needs a"
+    print "                       --latency trace, other traces replay as fast as possible."
+    print "--remap-gib <N>     : (OPTIONAL) Spread the LBA's proportionally over an N GiB target device."
+    print "--iolog-rw <all|read|write|trim> : (OPTIONAL) Only export these I/O's (default: all)."
+    print "--fio-job <file>    : (OPTIONAL) Fit a workload model (zipf theta, read mix, I/O size mix, sequential fraction, arrival rate)"
+    print "                       and write an fio job that generates it to <file> in 'post' mode.  Prints how closely it fits."
+    print "--store <dir>       : (OPTIONAL) Rollup store written by 'daemon' mode (default: ioprof.store) and read by 'post' mode."
+    print "--retention <m>,<h>,<d> : (OPTIONAL) Minute, hour and day rollups to keep (default: 1440,720,400).  Minute and hour"
+    print "                       rollups are compacted into hours and days, and only expire once their coarser rollup exists."
+    print "--from/--to <time>  : (OPTIONAL) Time range for 'post' --store (UTC: epoch seconds, YYYY-mm-dd or YYYY-mm-dd HH:MM)."
+    print "--profile <text|json> : (OPTIONAL) Print wall time, CPU time, events processed and peak memory of each phase."
+    print "--cprofile <dir>    : (OPTIONAL) Write cProfile output of the main and every worker process to <dir>."
     sys.exit(-1)
 # usage (DONE)
 
@@ -168,7 +382,8 @@ def check_args(g, argv):
 
     # Gather command line arguments
     try:
-        opts, args = getopt.getopt(argv,"m:d:t:fr:vpx")
+        opts, args = getopt.getopt(argv,"m:d:t:fr:vpx", ["latency", "procs", "format=", "output=", "buckets", "metrics-port=", "profile=", "cprofile=", "memory=", "store=", "retention=", "from=", "to=", "lba-range=", "roi-bucket=", "half-life=", "overwrites", "hot-extents=", "hot-percent=", "hot-gib=", "extent-units=",
+                                                      "fio-iolog=", "fio-job=", "iolog-version=", "iolog-device=", "time-scale=", "remap-gib=", "iolog-rw="])
     except getopt.GetoptError as err:
         print str(err)
         usage(g,argv)
@@ -181,6 +396,7 @@ def check_args(g, argv):
             g.device = arg
         elif opt == '-t':
             g.tarfile = arg
+            g.diff_inputs.append(arg)
         elif opt == '-f':
             g.trace_files= True
         elif opt == '-r':
@@ -194,6 +410,92 @@ def check_args(g, argv):
         elif opt == '-x':
             g.verbose = True
             g.debug = True
+        elif opt == '--latency':
+            g.latency = True
+        elif opt == '--procs':
+            g.procs = True
+        elif opt == '--format':
+            g.format = arg
+            if g.format not in ('json', 'csv'):
+                print "ERROR: --format must be json or csv"
+                usage(g,argv)
+        elif opt == '--output':
+            g.output = arg
+        elif opt == '--buckets':
+            g.output_buckets = True
+        elif opt == '--metrics-port':
+            g.metrics_port = int(arg)
+        elif opt == '--profile':
+            g.profile = arg
+            if g.profile not in ('text', 'json'):
+                print "ERROR: --profile must be text or json"
+                usage(g,argv)
+        elif opt == '--cprofile':
+            g.cprofile = arg
+        elif opt == '--memory':
+            g.memory_limit = int(arg) * g.MiB
+        elif opt == '--store':
+            g.store = arg
+        elif opt == '--retention':
+            try:
+                g.store_retention = [int(count) for count in arg.split(",")]
+            except ValueError:
+                g.store_retention = []
+            if len(g.store_retention) != len(g.store_levels) or min(g.store_retention) < 1:
+                print "ERROR: --retention must be <minutes>,<hours>,<days>"
+                usage(g,argv)
+        elif opt == '--lba-range':
+            g.roi_ranges.append(parse_lba_range(g, arg))
+        elif opt == '--roi-bucket':
+            g.roi_bucket_size = int(arg)
+            if g.roi_bucket_size < 512:
+                print "ERROR: --roi-bucket must be at least 512 bytes"
+                usage(g,argv)
+        elif opt == '--half-life':
+            g.half_life = float(arg)
+            if g.half_life < 0:
+                print "ERROR: --half-life must be 0 (off) or more seconds"
+                usage(g,argv)
+        elif opt == '--overwrites':
+            g.overwrite = True
+        elif opt == '--hot-extents':
+            g.hot_file = arg
+        elif opt == '--hot-percent':
+            g.hot_percent = float(arg)
+            if g.hot_percent <= 0 or g.hot_percent > 100:
+                print "ERROR: --hot-percent must be more than 0 and at most 100"
+                usage(g,argv)
+        elif opt == '--hot-gib':
+            g.hot_gib = float(arg)
+        elif opt == '--extent-units':
+            g.extent_units = arg
+            if g.extent_units not in ('device', 'partition'):
+                print "ERROR: --extent-units must be device or partition"
+                usage(g,argv)
+        elif opt == '--fio-iolog':
+            g.iolog_file = arg
+        elif opt == '--fio-job':
+            g.fio_job_file = arg
+        elif opt == '--iolog-version':
+            g.iolog_version = int(arg)
+            if g.iolog_version not in (2, 3):
+                print "ERROR: --iolog-version must be 2 or 3"
+                usage(g,argv)
+        elif opt == '--iolog-device':
+            g.iolog_device = arg
+        elif opt == '--time-scale':
+            g.iolog_time_scale = float(arg)
+        elif opt == '--remap-gib':
+            g.iolog_remap_gib = float(arg)
+        elif opt == '--iolog-rw':
+            g.iolog_rw = arg
+            if g.iolog_rw not in ('all', 'read', 'write', 'trim'):
+                print "ERROR: --iolog-rw must be all, read, write or trim"
+                usage(g,argv)
+        elif opt == '--from':
+            g.store_from = parse_time(g, arg)
+        elif opt == '--to':
+            g.store_to = parse_time(g, arg)
         else:
             usage(g,argv)
 
@@ -205,7 +507,7 @@ def check_args(g, argv):
         verbose_print(g, "LIVE")
         if g.device == '' or g.runtime == '':
             usage(g,argv)
-        debug_print(g, "Dev: " + g.device + " Runtime: " + g.runtime)
+        debug_print(g, "Dev: " + g.device + " Runtime: " + str(g.runtime))
         match = re.search("\/dev\/(\S+)", g.device)
         try: 
             debug_print(g,match.group(1))
@@ -217,6 +519,9 @@ def check_args(g, argv):
         if not stat.S_ISBLK(statinfo.st_mode):
             print "Device " + g.device + " is not a block device"
             usage(g,argv)
+    elif g.mode == 'post' and g.store != '':
+        verbose_print(g, "POST (store)")
+        store_geometry(g, False)
     elif g.mode == 'post':
         verbose_print(g, "POST")
         if g.tarfile == '':
@@ -228,19 +533,47 @@ def check_args(g, argv):
         except:
             print "ERROR: invalid tar file" + g.tarfile
         if g.pdf == True:
-            verbose_print(g, "PDF Report Output")
-            check_pdf_prereqs(g)
-
-            print "PDF Report Output - COMING SOON..." # COMING SOON
-            sys.exit(-1) # COMING SOON
+            verbose_print(g, "HTML Report Output")
         g.fdisk_file = "fdisk." + g.device_str
         debug_print(g, "fdisk_file: " + g.fdisk_file)
         g.cleanup.append(g.fdisk_file)
+    elif g.mode == 'daemon':
+        verbose_print(g, "DAEMON")
+        check_trace_prereqs(g)
+        if g.device == '':
+            usage(g,argv)
+        if g.store == '':
+            g.store = "ioprof.store"
+        match = re.search("\/dev\/(\S+)", g.device)
+        try:
+            g.device_str = string.replace(match.group(1), "/", "_")
+        except:
+            print "Invalid Device Type"
+            usage(g, argv)
+        statinfo = os.stat(g.device)
+        if not stat.S_ISBLK(statinfo.st_mode):
+            print "Device " + g.device + " is not a block device"
+            usage(g,argv)
+    elif g.mode == 'diff':
+        verbose_print(g, "DIFF")
+        if len(g.diff_inputs) != 2:
+            usage(g,argv)
+        for name in g.diff_inputs:
+            if not os.path.isfile(name):
+                print "ERROR: " + name + " does not exist"
+                usage(g,argv)
     elif g.mode == 'trace':
         verbose_print(g, "TRACE")
         check_trace_prereqs(g)
         if g.device == '' or g.runtime == '':
             usage(g,argv)
+        if g.procs == True:
+            verbose_print(g, "Process capture enabled")
+            g.blkparse_format  = " %p %C" + g.blkparse_format
+        if g.latency == True:
+            verbose_print(g, "Latency capture enabled")
+            g.blktrace_actions = "-a queue -a issue -a complete"
+            g.blkparse_format  = " %T.%9t" + g.blkparse_format
         debug_print(g, "Dev: " + g.device + " Runtime: " + str(g.runtime))
         match = re.search("\/dev\/(\S+)", g.device)
         try: 
@@ -258,62 +591,60 @@ def check_args(g, argv):
     return
 # check_args (DONE)
 
-def debug_print(g, message):
+### Debug/verbose logging.  Pass format arguments instead of a pre-built string so the
+### message is only formatted when logging is enabled.  In hot loops, also guard the call
+### with 'if g.debug:' so the arguments themselves are never evaluated
+def debug_print(g, message, *args):
     if g.debug == True:
-        print message
+        print message % args if args else message
 # debug_print (DONE)
 
-def verbose_print(g, message):
+def verbose_print(g, message, *args):
     if g.verbose == True:
-        print message
+        print message % args if args else message
 # verbose_print (DONE)
 
-### Check prereqs for gnuplot and latex
-def check_pdf_prereqs(g):
-    debug_print(g, "check_pdf_prereqs")
-
-    rc = os.system("which gnuplot &> /dev/null")
-    if rc != 0:
-        print "ERROR: gnuplot not installed.  Please offload the trace file for processing."
-        sys.exit(1)
-    else:
-        debug_print(g, "which gnuplot: rc=" + str(rc))
-    rc = os.system("which pdflatex &> /dev/null")
-    if rc != 0:
-        print "ERROR: pdflatex not installed.  Please offload the trace file for processing."
-        sys.exit(1)
-    else:
-        debug_print(g, "which pdflatex: rc=" + str(rc))
-    rc = os.system("echo 'set terminal png' > pngtest.txt; gnuplot pngtest.txt >/dev/null 2>&1")
-    if rc != 0:
-        print "ERROR: gnuplot PNG terminal not installed.  Please offload the trace file for processing."
-        sys.exit(1)
-    else:
-        debug_print(g, "gnuplot pngtest.txt: rc=" + str(rc))
-    return
-# check_pdf_prereqs (DONE)
-
 ### Check prereqs for blktrace
 def check_trace_prereqs(g):
     debug_print(g, "check_trace_prereqs")
-    rc = os.system("which blktrace &> /dev/null")
-    if rc != 0:
-        print "ERROR: blktrace not installed.  Please install blktrace"
-        sys.exit(1)
-    else:
-        debug_print(g, "which blktrace: rc=" + str(rc))
-    rc = os.system("which blkparse &> /dev/null")
-    if rc != 0:
-        print "ERROR: blkparse not installed.  Please install blkparse"
-        sys.exit(1)
-    else:
-        debug_print(g, "which blkparse: rc=" + str(rc))
+    for tool in ("blktrace", "blkparse"):
+        path = find_program(g, tool)
+        if path == None:
+            print "ERROR: " + tool + " not installed.  Please install " + tool
+            sys.exit(1)
+        debug_print(g, "found " + path)
 # check_trace_prereqs (DONE)
 
+### Find a program on $PATH (None if it is missing)
+def find_program(g, program):
+    for directory in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        path = os.path.join(directory, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+# find_program (DONE)
+
+### Start the Manager and move the shared variables and their locks onto it (only worker processes need it)
+def start_manager(g):
+    if g.manager != None:
+        return
+    g.manager = Manager()
+    for name in g.shared_dicts:
+        setattr(g, name, g.manager.dict(getattr(g, name)))
+    for name in g.shared_lists:
+        setattr(g, name, g.manager.list(getattr(g, name)))
+    for name in vars(g).keys():
+        if name.endswith("_semaphore") or name.startswith("bucket_to_files_semaphore"):
+            setattr(g, name, g.manager.Lock())
+    return
+# start_manager (DONE)
+
 ### Check if debugfs is mounted
 def mount_debugfs(g):
-    rc = os.system("mount | grep debugfs &> /dev/null")
-    if rc != 0:
+    fo = open("/proc/mounts", "r")
+    mounted = [line for line in fo if line.split()[2:3] == ["debugfs"]]
+    fo.close()
+    if not mounted:
         debug_print(g, "Need to mount debugfs")
         rc = os.system("mount -t debugfs debugfs /sys/kernel/debug")
         if rc != 0:
@@ -476,24 +807,24 @@ def file_to_bucket_helper(g, f):
         #g.file_hit_count[file]=0 # Initialize file hit count
         #g.file_hit_count_semaphore.release()
         tempstr = f[file]
-        debug_print(g, "f=" + file + " r=" + r)
+        debug_print(g, "f=%s r=%s", file, r)
         x=0
         for range in tempstr.split(' '):
             if range == ' ' or range == '':
                 continue # TODO
-            debug_print(g, 'r(' + str(x) + ')=' + range)
+            debug_print(g, "r(%d)=%s", x, range)
             x+=1
             try:
                 (start, finish) = range.split(':')
             except:
                 continue
-            debug_print(g, file + " start=" + start + ", finish=" + finish)
+            debug_print(g, "%s start=%s, finish=%s", file, start, finish)
             if start == '' or finish == '':
                 continue
             start_bucket  = lba_to_bucket(g, start)
             finish_bucket = lba_to_bucket(g, finish)
     
-            debug_print(g, file + " s_lba=" + start + " f_lba=" + finish + " s_buc=" + str(start_bucket) + "f_buc=" + str(finish_bucket ))
+            debug_print(g, "%s s_lba=%s f_lba=%s s_buc=%d f_buc=%d", file, start, finish, start_bucket, finish_bucket)
             #print "WAITING ON LOCK"
             i=start_bucket
             #print "GOT LOCK!"
@@ -593,38 +924,38 @@ def file_to_buckets(g):
                 sys.stdout.flush()
             g.file_hit_count[file]=0 # Initialize file hit count
             tempstr = f[file]
-            debug_print(g, "f=" + file + " r=" + r)
+            debug_print(g, "f=%s r=%s", file, r)
             x=0
             for range in tempstr.split(' '):
                 if range == ' ' or range == '':
                     continue # TODO
-                debug_print(g, 'r(' + str(x) + ')=' + range)
+                debug_print(g, "r(%d)=%s", x, range)
                 x+=1
                 try:
                     (start, finish) = range.split(':')
                 except:
                     continue
-                debug_print(g, file + " start=" + start + ", finish=" + finish)
+                debug_print(g, "%s start=%s, finish=%s", file, start, finish)
                 if start == '' or finish == '':
                     continue
                 start_bucket  = lba_to_bucket(g, start)
                 finish_bucket = lba_to_bucket(g, finish)
     
-                debug_print(g, file + " s_lba=" + start + " f_lba=" + finish + " s_buc=" + str(start_bucket) + "f_buc=" + str(finish_bucket ))
+                debug_print(g, "%s s_lba=%s f_lba=%s s_buc=%d f_buc=%d", file, start, finish, start_bucket, finish_bucket)
                 i=start_bucket
                 while i<= finish_bucket:
-                    debug_print(g, "i=" + str(i))
+                    if g.debug:
+                        debug_print(g, "i=%d", i)
                     if i in g.bucket_to_files:
-                        pattern = re.escape(file)
-                        match = re.search(pattern, g.bucket_to_files[i])
-                        try:
-                            match.group(0)
-                        except:
-                            debug_print(g, "No Match!  FILE=" + pattern + " PATTERN=" + g.bucket_to_files[i])
+                        # Exact name match, so /a is still added to a bucket that already lists /ab
+                        if file not in g.bucket_to_files[i].split(" "):
+                            if g.debug:
+                                debug_print(g, "No Match!  FILE=%s PATTERN=%s", file, g.bucket_to_files[i])
                             g.bucket_to_files[i] = g.bucket_to_files[i] + file + " "
                     else:
                         g.bucket_to_files[i] = file + " "
-                    debug_print(g, "i=" + str(i) + "file_to_buckets: " + g.bucket_to_files[i])
+                    if g.debug:
+                        debug_print(g, "i=%d file_to_buckets: %s", i, g.bucket_to_files[i])
                     i+=1
         print "\rDone correlating files to buckets.  Now time to count bucket hits"
         return
@@ -636,11 +967,11 @@ def add_file_hits(g, bucket_id, io_count):
     size = len(list)
     #print list
     if size == 0 and io_count != 0:
-        debug_print(g, "No file hit.  bucket=" + str(bucket_id) + ", io_cnt=" + str(io_count))
+        debug_print(g, "No file hit.  bucket=%d, io_cnt=%d", bucket_id, io_count)
 
     for file in list.split(' '):
         if file != '': 
-            debug_print(g, "file=" + file)
+            debug_print(g, "file=%s", file)
             try:
                 g.file_hit_count[file] += io_count
             except:
@@ -660,76 +991,44 @@ def theta_log(g, base, value):
 
 ### Print Results
 def print_results(g):
-    num=0
-    sum=0
-    k=0
-    buffer=''
-    row=0
-    column=0
     bw_total=0
     counts={}
     read_sum=0
     write_sum=0
-    row=column=0
-    bw_total=0
     histogram_iops=[]
     histogram_bw=[]
-    
+    g.histogram_iops = []
+    g.top_files = []
+    g.top_file_hits = []
+    g.zipf_theta = None
+
 
     g.verbose=True
     verbose_print(g, "num_buckets=" + str(g.num_buckets) + " bucket_size=" + str(g.bucket_size))
     g.verbose=False
-    if g.pdf == True:
-        # TODO
-        pass
-    x=0
-    threshold = g.num_buckets / 100
-    i=0
-    while i<g.num_buckets:
-        x+=1
-        if x > threshold:
-            printf("\rBucket Percent: %d %% (%d of %d)", ((i * 100)/ g.num_buckets), i, g.num_buckets)
-            sys.stdout.flush()
-            x=0
-        if i != 0 and (i % g.x_width) == 0:
-            if g.pdf == True:
-                # TODO
-                pass
-            buffer=''
-            row += 1
-            column=0
-        
 
-        r=0
-        if i in g.reads:
-            r=g.reads[i]
-        w=0
-        if i in g.writes:
-            w=g.writes[i]
+    # Only walk the buckets that saw I/O, every other bucket has a total of 0
+    touched = 0
+    for (i, r, w) in bucket_totals(g):
+        if i >= g.num_buckets:
+            continue
+        touched += 1
 
         bucket_total = r + w
         bw_total += bucket_total * g.bucket_size
-        if g.trace_files:
+        if g.trace_files and g.files_file == '':
             add_file_hits(g, i, bucket_total)
         if bucket_total in counts:
             counts[bucket_total] += 1
         else:
             counts[bucket_total] = 1
-        debug_print(g, "bucket_total=" + str(bucket_total) + " counts[b_bucket_total]=" + str(counts[bucket_total]))
+        if g.debug:
+            debug_print(g, "bucket_total=%d counts[b_bucket_total]=%d", bucket_total, counts[bucket_total])
         read_sum += r
         write_sum += w
-        buffer = buffer + ("%d " %  bucket_total)
-        column += 1
-        i+=1
-
-    print "\r                             "
-    while (i % g.x_width) != 0:
-        i+=1
-        buffer = buffer + "0 "
-
-    if g.pdf:
-        # TODO
-        pass
+    counts[0] = g.num_buckets - touched
+    if g.files_file != '':
+        g.file_hit_count = sweep_file_hits(g)
 
     verbose_print(g, "num_buckets=%s pfgp iot=%s bht=%s r_sum=%s w_sum=%s yheight=%s" % (g.num_buckets, g.io_total.value, g.bucket_hits_total.value, read_sum, write_sum, g.y_height))
 
@@ -746,14 +1045,6 @@ def print_results(g):
         # TODO
         pass
 
-    max_set = 0
-    max = 0
-    theta_count = 1
-    theta_total = 0
-    min = 1
-    max_theta = 0
-    min_theta = 999
-
 
     # %counts is a hash
     # each key "bucket_total" represents a particular I/O count for a bucket
@@ -764,29 +1055,16 @@ def print_results(g):
     #
     # Iterate through each key in decending order
     for total in sorted(counts, reverse=True):
-        debug_print(g, "total=" + str(total) + " counts=" + str(counts[total]))
+        debug_print(g, "total=%d counts=%d", total, counts[total])
         if total > 0:
             tot += total * counts[total]
-            if max_set == 0:
-                max_set=1
-                max = total
-            else:
-                theta_count += 1
-                min = total
-                cur_theta = theta_log(g, theta_count, max) - theta_log(g, theta_count, total)
-                if cur_theta > max_theta:
-                    max_theta = cur_theta
-                if cur_theta < min_theta:
-                    min_theta = cur_theta
-                debug_print(g, "cur_theta=" + str(cur_theta))
-                theta_total += cur_theta
             i=0
             while i<counts[total]:
                 section_count += total
                 b_count += 1
                 bw_count += total * g.bucket_size
                 if ((b_count * g.bucket_size )/ g.GiB) > (g.percent * g.total_capacity_gib):
-                    debug_print(g, "b_count:" + str(b_count))
+                    debug_print(g, "b_count:%d", b_count)
                     bw_tot += bw_count
                     gb_tot += (b_count * g.bucket_size)
                     io_sum += section_count
@@ -797,7 +1075,7 @@ def print_results(g):
                         io_sum_perc = "NA"
                         bw_perc = "NA"
                     else:
-                        debug_print(g, "b_count=" + str(b_count) + " s=" + str(section_count) + " ios=" + str(io_sum) + " bwc=" + str(bw_count))
+                        debug_print(g, "b_count=%d s=%d ios=%d bwc=%d", b_count, section_count, io_sum, bw_count)
                         io_perc = "%.1f" % ((float(section_count) / float(g.bucket_hits_total.value)) * 100.0)
                         io_sum_perc = "%.1f" % ((float(io_sum) / float(g.bucket_hits_total.value)) * 100.0)
                         if bw_total == 0:
@@ -805,10 +1083,8 @@ def print_results(g):
                         else:
                             bw_perc = "%.1f" % ((bw_count / bw_total) * 100)
     
-                    if g.pdf:
-                        # TODO
-                        pass
-                    
+                    g.histogram_iops.append((gb, io_perc, io_sum_perc))
+
                     histogram_iops.append(str(gb) + " GB " + str(io_perc) + "% (" + io_sum_perc + "% cumulative)")
                     histogram_bw.append(str(gb) + " GB " + str(bw_perc) + "% ")
 
@@ -829,16 +1105,14 @@ def print_results(g):
             io_sum_perc = "NA"
             bw_perc = "NA"
         else:
-            io_perc = "%.1f" % ((section_count / g.bucket_hits_total.value) * 100)
-            io_sum_perc = "%.1f" % ((io_sum / g.bucket_hits_total.value) * 100)
+            io_perc = "%.1f" % ((float(section_count) / g.bucket_hits_total.value) * 100)
+            io_sum_perc = "%.1f" % ((float(io_sum) / g.bucket_hits_total.value) * 100)
             if bw_total == 0:
                 bw_perc = "%.1f" % (0)
             else:
                 bw_perc = "%.1f" % ((bw_count / bw_total) * 100)
 
-        if g.pdf:
-            # TODO
-            pass
+        g.histogram_iops.append((gb, io_perc, io_sum_perc))
 
         histogram_iops.append(str(gb) + " GB " + str(io_perc) + "% (" + str(io_sum_perc) + "% cumulative)")
         histogram_bw.append(str(gb) + " GB " + str(bw_perc) + "% ")
@@ -853,21 +1127,24 @@ def print_results(g):
 
     debug_print(g, "t=" + str(t))
 
+    if drop_percent(g) != None:
+        print "--------------------------------------------"
+        printf("blktrace dropped %d of %d events (%.2f%%)", g.trace_dropped, g.trace_events + g.trace_dropped, drop_percent(g))
+        if g.sample_fraction < 1:
+            printf(", traced %.0f%% of the capture time", g.sample_fraction * 100)
+        printf("\n")
+        if drop_percent(g) >= g.drop_warn_percent:
+            print "WARNING: dropped events are missing from every count below, so hot-set sizes may be understated"
     print "--------------------------------------------"
     print "Histogram IOPS:"
     for entry in histogram_iops:
         print entry
     print "--------------------------------------------"
 
-    # TODO: Check that this is consistent with Perl version
-    if (theta_count):
-        avg_theta = theta_total / theta_count
-        med_theta = ((max_theta - min_theta) / 2 ) + min_theta
-        approx_theta = (avg_theta + med_theta) / 2
-        #string = "avg_t=%s med_t=%s approx_t=%s min_t=%s max_t=%s\n" % (avg_theta, med_theta, approx_theta, min_theta, max_theta)
-        verbose_print(g, "avg_t=%s med_t=%s approx_t=%s min_t=%s max_t=%s\n" % (avg_theta, med_theta, approx_theta, min_theta, max_theta))
-        analysis_histogram_iops = "Approximate Zipfian Theta Range: %0.4f-%0.4f (est. %0.4f).\n" % (min_theta, max_theta, approx_theta)
-        print analysis_histogram_iops
+    g.zipf_theta = zipf_theta(g, counts)
+    (min_theta, max_theta, approx_theta) = g.zipf_theta
+    g.analysis_histogram_iops = "Approximate Zipfian Theta Range: %0.4f-%0.4f (est. %0.4f).\n" % (min_theta, max_theta, approx_theta)
+    print g.analysis_histogram_iops
 
     debug_print(g, "Trace_files: " + str(g.trace_files))
     if g.trace_files:
@@ -878,13 +1155,14 @@ def print_results(g):
         if g.bucket_hits_total.value == 0:
             print "No Bucket Hits"
         else:    
-            for filename in sorted(g.file_hit_count, reverse=True, key=g.file_hit_count.get):
+            for filename in sorted(g.file_hit_count, key=lambda f: (-g.file_hit_count[f], f)):
                 hits = g.file_hit_count[filename]
                 if hits > 0:
                     hit_rate = (float(hits) / float(g.bucket_hits_total.value)) * 100.0
                     print "%0.2f%% (%d) %s" % (hit_rate, hits, filename)
+                    g.top_file_hits.append((hit_rate, hits, filename))
                     if g.pdf:
-                        g.top_files = append("%0.2f%%: (%d) %s\n" % (hit_rate, hits, filename))
+                        g.top_files.append("%0.2f%%: (%d) %s" % (hit_rate, hits, filename))
                 top_count += 1
                 if top_count > g.top_count_limit:
                     break
@@ -893,147 +1171,2347 @@ def print_results(g):
     return
 # print_results (IN PROGRESS)
 
-### Print heatmap header for PDF
+### Approximate Zipfian theta (min, max, estimate) from a hash of bucket I/O count -> number of buckets
+def zipf_theta(g, counts):
+    max_set = 0
+    max = 0
+    theta_count = 1
+    theta_total = 0
+    max_theta = 0
+    min_theta = 999
+    # Iterate through each I/O count in decending order
+    for total in sorted(counts, reverse=True):
+        if total > 0:
+            if max_set == 0:
+                max_set=1
+                max = total
+            else:
+                theta_count += 1
+                cur_theta = theta_log(g, theta_count, max) - theta_log(g, theta_count, total)
+                if cur_theta > max_theta:
+                    max_theta = cur_theta
+                if cur_theta < min_theta:
+                    min_theta = cur_theta
+                debug_print(g, "cur_theta=%s", cur_theta)
+                theta_total += cur_theta
+
+    # TODO: Check that this is consistent with Perl version
+    avg_theta = theta_total / theta_count
+    med_theta = ((max_theta - min_theta) / 2 ) + min_theta
+    approx_theta = (avg_theta + med_theta) / 2
+    verbose_print(g, "avg_t=%s med_t=%s approx_t=%s min_t=%s max_t=%s\n" % (avg_theta, med_theta, approx_theta, min_theta, max_theta))
+    return (min_theta, max_theta, approx_theta)
+# zipf_theta (DONE)
+
+### Build a 256-entry heatmap palette (index 0 = no I/O) from the color stops
+def heatmap_palette(g):
+    palette = [(0, 0, 0)]
+    stops = g.palette_stops
+    for i in xrange(255):
+        t = i * 100.0 / 254
+        j = 1
+        while j < (len(stops) - 1) and t > stops[j][0]:
+            j += 1
+        (t0, c0) = stops[j - 1]
+        (t1, c1) = stops[j]
+        f = (t - t0) / (t1 - t0)
+        palette.append(tuple([int(c0[k] + (c1[k] - c0[k]) * f) for k in xrange(3)]))
+    return palette
+# heatmap_palette (DONE)
+
+### Map each distinct bucket count to a log-scaled color level (0 = no I/O)
+def heatmap_levels(g, counts, levels):
+    lut = {0: 0}
+    cap = max(counts) if len(counts) else 0
+    if cap == 0:
+        return lut
+    scale = math.log(cap + 1)
+    for value in set(counts):
+        if value:
+            lut[value] = 1 + int(math.log(value + 1) / scale * (levels - 2))
+    return lut
+# heatmap_levels (DONE)
+
+### Build a PNG chunk
+def png_chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+# png_chunk (DONE)
+
+### Write an 8-bit palette PNG from rows of palette indexes
+def write_png(g, filename, width, height, rows, palette):
+    compressor = zlib.compressobj(6)
+    data = []
+    for row in rows:
+        data.append(compressor.compress('\x00' + str(row)))
+    data.append(compressor.flush())
+    try:
+        fo = open(filename, "wb")
+    except:
+        print "ERROR: Failed to open " + filename
+        sys.exit(3)
+    fo.write('\x89PNG\r\n\x1a\n')
+    fo.write(png_chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)))
+    fo.write(png_chunk('PLTE', ''.join([struct.pack('BBB', *color) for color in palette])))
+    fo.write(png_chunk('IDAT', ''.join(data)))
+    fo.write(png_chunk('IEND', ''))
+    fo.close()
+    return
+# write_png (DONE)
+
+### Build an SVG bar chart
+def svg_bar_chart(g, title, x_label, y_label, labels, values, y_max):
+    width = g.chart_width
+    height = g.chart_height
+    (left, right, top, bottom) = (70, 20, 40, 130)
+    plot_w = width - left - right
+    plot_h = height - top - bottom
+    if y_max <= 0:
+        y_max = 1
+    svg = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" font-family="arial" font-size="10">' % (width, height)]
+    svg.append('<text x="%d" y="20" text-anchor="middle" font-size="14">%s</text>' % (width / 2, cgi.escape(title)))
+    for i in xrange(6):
+        y = top + plot_h - (plot_h * i / 5)
+        svg.append('<line x1="%d" y1="%d" x2="%d" y2="%d" stroke="#ddd"/>' % (left, y, left + plot_w, y))
+        svg.append('<text x="%d" y="%d" text-anchor="end">%.1f</text>' % (left - 5, y + 3, y_max * i / 5.0))
+    bar_w = float(plot_w) / max(1, len(values))
+    for i in xrange(len(values)):
+        x = left + (i * bar_w)
+        bar_h = min(values[i], y_max) / float(y_max) * plot_h
+        svg.append('<rect x="%.1f" y="%.1f" width="%.1f" height="%.1f" fill="#4169e1" fill-opacity="0.6"/>' % (x + bar_w * 0.025, top + plot_h - bar_h, bar_w * 0.95, bar_h))
+        svg.append('<text transform="translate(%.1f,%d) rotate(90)">%s</text>' % (x + bar_w / 2, top + plot_h + 5, cgi.escape(labels[i])))
+    svg.append('<line x1="%d" y1="%d" x2="%d" y2="%d" stroke="black"/>' % (left, top + plot_h, left + plot_w, top + plot_h))
+    svg.append('<text x="%d" y="%d" text-anchor="middle" font-size="12">%s</text>' % (left + plot_w / 2, height - 5, cgi.escape(x_label)))
+    svg.append('<text transform="translate(15,%d) rotate(-90)" text-anchor="middle" font-size="12">%s</text>' % (top + plot_h / 2, cgi.escape(y_label)))
+    svg.append('</svg>')
+    return "\n".join(svg)
+# svg_bar_chart (DONE)
+
+### Render the per-bucket heatmap for the report (one pixel per bucket)
 def print_header_heatmap(g):
+    counts = get_bucket_counts(g)
+    width = g.x_width
+    height = (g.num_buckets + width - 1) / width
+    lookup = heatmap_levels(g, counts, 256).__getitem__
+    rows = []
+    for y in xrange(height):
+        row = bytearray(map(lookup, counts[y * width:(y + 1) * width]))
+        if len(row) < width:
+            row.extend('\x00' * (width - len(row)))
+        rows.append(row)
+    g.report_heatmap = "heatmap_" + g.device_str + ".png"
+    write_png(g, g.report_heatmap, width, height, rows, heatmap_palette(g))
+    g.analysis_heatmap = "Each pixel is one %s bucket, starting with LBA 0 at the top left.  Colors are log-scaled from white (1 I/O) to red (%d I/O's); black buckets had no I/O.\n" % (size_label(g, g.bucket_size), max(counts) if len(counts) else 0)
+    verbose_print(g, "heatmap: " + g.report_heatmap + " " + str(width) + "x" + str(height))
     return
-# print_header_heatmap (TODO)
+# print_header_heatmap (DONE)
 
-### Print histogram header for PDF
+### Build the IOPS histogram chart for the report
 def print_header_histogram_iops(g):
+    labels = []
+    values = []
+    for (gb, io_perc, io_sum_perc) in g.histogram_iops:
+        labels.append(gb + " GB")
+        values.append(float(io_perc) if io_perc != "NA" else 0)
+    g.report_histogram = svg_bar_chart(g, "I/O distribution throughout total disk space", "GB of capacity accessed by I/O", "% of Total I/O",
+        labels, values, max(values + [0]) * 1.1)
     return
-# print_header_histogram_iops (TODO)
+# print_header_histogram_iops (DONE)
 
-### Print stats header for PDF
+### Build the I/O size chart for the report
 def print_header_stats_iops(g):
+    labels = [label for (label, perc, count) in g.stats_iops]
+    values = [perc for (label, perc, count) in g.stats_iops]
+    g.report_stats = svg_bar_chart(g, "I/O Distribution by I/O Size", "I/O Size", "% of Total I/O", labels, values, 100)
     return
-# print_header_stats_iops (TODO)
+# print_header_stats_iops (DONE)
 
-### Create PDF Report
+### Create self-contained HTML report
 def create_report(g):
+    report = "report." + g.device_str + ".html"
+    heatmap = ""
+    if g.report_heatmap != "":
+        with open(g.report_heatmap, "rb") as fo:
+            heatmap = base64.b64encode(fo.read())
+    html = []
+    html.append("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>IO Profiling Report: %s</title>" % cgi.escape(g.device))
+    html.append("<style>body{font-family:arial;max-width:900px;margin:auto} img{image-rendering:pixelated;max-width:100%} pre{background:#f4f4f4;padding:8px}</style></head><body>")
+    html.append("<h1>IO Profiling Report</h1>")
+    html.append("<h2>Summary</h2><p>%s</p>" % cgi.escape(g.analysis_stats_iops))
+    html.append("<p>Please make sure to review the important notes in the section \"Caveat Emptor\" at the bottom of this document.</p>")
+    html.append("<h2>Top Files</h2>")
+    if g.trace_files:
+        html.append("<p>The following files were the top %d most accessed files by IOPS</p>" % g.top_count_limit)
+        html.append("<pre>%s</pre>" % cgi.escape("\n".join(g.top_files)))
+    else:
+        html.append("<p>Tracing was done without 'File tracing' enabled.  To enable file tracing, please use the -f flag.  Please note that it may take 3-5 minutes to gather information about file placement on large filesystems.</p>")
+    html.append("<h2>IOPS Histogram</h2><p>%s</p>" % cgi.escape(g.analysis_histogram_iops))
+    html.append(g.report_histogram)
+    html.append("<h2>IOPS Heatmap</h2><p>%s</p>" % cgi.escape(g.analysis_heatmap))
+    if heatmap != "":
+        html.append("<img alt=\"heatmap\" src=\"data:image/png;base64,%s\">" % heatmap)
+    html.append("<h2>IOPS Statistics</h2>")
+    html.append(g.report_stats)
+    html.append("<h2>Bandwidth Statistics</h2><p>%s</p>" % cgi.escape(g.analysis_stats_bw))
+    html.append("<pre>%s</pre>" % cgi.escape("\n".join(["\"%s\" %0.2f%% (%0.2f GiB)" % row for row in g.stats_bw])))
+    html.append("<h2>Caveat Emptor</h2>")
+    html.append("<p>This tool is intended to provide the user with additional insight into their own workload.  This tool has the following limitations:</p><ul>")
+    html.append("<li>In order to limit the trace impact on performance, blktrace is run as a collection of 3 second traces.  Thus, there may be I/O's missed between runs.</li>")
+    html.append("<li>Larger %d byte buckets are used to count logical sector hits instead of %d bytes.  This improves post processing times, but produces less granular results.</li>" % (g.bucket_size, g.sector_size))
+    html.append("<li>Translating files into logical block ranges may rely on FIBMAP ioctl() calls.</li>")
+    html.append("<li>Translating file logical block ranges into %d byte buckets may result in some bucket overlap.  Cross-correlating this with bucket I/O hits may result in some files being identified as being top hits without any file access.  Please keep this in mind when making important migration or caching decisions.</li>" % g.bucket_size)
+    html.append("</ul></body></html>\n")
+    try:
+        fo = open(report, "w")
+    except:
+        print "ERROR: Failed to open " + report
+        sys.exit(3)
+    fo.write("\n".join(html))
+    fo.close()
+    print "Your I/O profiling report is now available: " + report
     return
-# create_report (TODO)
+# create_report (DONE)
+
+### Get an I/O size percentile (sectors) from an I/O size -> count hash
+def size_percentile(g, totals, percent):
+    total = sum(totals.values())
+    if total == 0:
+        return 0
+    target = total * percent / 100.0
+    count = 0
+    for size in sorted(totals):
+        count += totals[size]
+        if count >= target:
+            return size
+    return max(totals)
+# size_percentile (DONE)
 
 ### Print I/O statistics
 def print_stats(g):
+    # r_totals/w_totals are keyed by I/O size, so this is O(distinct sizes), not O(I/O's)
+    r_totals = dict(g.r_totals)
+    w_totals = dict(g.w_totals)
+    io_total = g.io_total.value
+    total_blocks = g.total_blocks.value
+    g.stats_iops = []
+    g.stats_bw = []
+
+    for (totals, name) in ((r_totals, "READ"), (w_totals, "WRITE")):
+        for size in sorted(totals):
+            perc = (float(totals[size]) / io_total * 100) if io_total else 0
+            debug_print(g, name + " size=" + str(size) + " perc=" + str(perc))
+            if perc > 0.5:
+                label = size_label(g, size * g.sector_size) + " " + name
+                bw_perc = (float(size * totals[size]) / total_blocks * 100) if total_blocks else 0
+                g.stats_iops.append((label, perc, totals[size]))
+                g.stats_bw.append((label, bw_perc, float(size * g.sector_size * totals[size]) / g.GiB))
+
+    print "--------------------------------------------"
+    print "Stats IOPS:"
+    for (label, perc, count) in g.stats_iops:
+        print "\"%s\" %0.2f%% (%d IO's)" % (label, perc, count)
+    print "Stats BW:"
+    for (label, perc, gib) in g.stats_bw:
+        print "\"%s\" %0.2f%% (%0.2f GiB)" % (label, perc, gib)
+
+    # Size percentiles
+    all_totals = dict(r_totals)
+    for size, count in w_totals.iteritems():
+        all_totals[size] = all_totals.get(size, 0) + count
+    print "I/O size percentiles:"
+    for (totals, name) in ((r_totals, "READ"), (w_totals, "WRITE"), (all_totals, "ALL")):
+        if len(totals) == 0:
+            continue
+        line = "%-6s" % name
+        for percent in (50, 90, 99):
+            line += " p%d=%s" % (percent, size_label(g, size_percentile(g, totals, percent) * g.sector_size))
+        ios = sum(totals.values())
+        sectors = sum([size * count for (size, count) in totals.iteritems()])
+        line += " avg=%s" % size_label(g, int(float(sectors) / ios * g.sector_size))
+        print line
+
+    # Power-of-two size histogram
+    classes = {}
+    for (totals, index) in ((r_totals, 0), (w_totals, 1)):
+        for size, count in totals.iteritems():
+            size_class = io_size_class(g, size)
+            if size_class not in classes:
+                classes[size_class] = [0, 0]
+            classes[size_class][index] += count
+    g.size_histogram = [(size_class, classes[size_class][0], classes[size_class][1]) for size_class in sorted(classes)]
+    if io_total:
+        print "I/O size histogram (power of two):"
+        for (size_class, reads, writes) in g.size_histogram:
+            perc = float(reads + writes) / io_total * 100
+            print "%6s %6.2f%% (R %6.2f%% W %6.2f%%) %s" % (size_label(g, size_class), perc, float(reads) / io_total * 100,
+                float(writes) / io_total * 100, "#" * int(perc / 2))
+
+    # Read/write ratios
+    read_percent = (float(g.read_total.value) / io_total * 100) if io_total else 0
+    write_percent = (float(g.write_total.value) / io_total * 100) if io_total else 0
+    r_blocks = sum([size * count for (size, count) in r_totals.iteritems()])
+    read_bw_percent = (float(r_blocks) / total_blocks * 100) if total_blocks else 0
+    print "Read/Write: %0.2f%% / %0.2f%% of IOPS, %0.2f%% / %0.2f%% of bandwidth" % (read_percent, write_percent, read_bw_percent, 100 - read_bw_percent if total_blocks else 0)
+    print "--------------------------------------------"
+
+    g.analysis_stats_iops = "Your workload was approximately %0.2f%% reads and %0.2f%% writes.  " % (read_percent, write_percent)
+    if read_percent > 95:
+        g.analysis_stats_iops += "Your workload was very read intensive.\n"
+    elif read_percent > 70:
+        g.analysis_stats_iops += "Your workload was moderately read intensive.\n"
+    elif read_percent > 50:
+        g.analysis_stats_iops += "Your workload was evenly split between reads and writes.\n"
+    else:
+        g.analysis_stats_iops += "Your workload was write intensive.\n"
+
+    # Analyze IOPS distribution of small reads
+    sectors_per_4k = 4096 / g.sector_size
+    read_small = []
+    for multiple in (1, 2, 4):
+        read_small.append((float(r_totals.get(sectors_per_4k * multiple, 0)) / io_total * 100) if io_total else 0)
+    if read_small[0] > 90:
+        g.analysis_stats_iops += "Your workload was %0.2f%% 4k reads.\n" % read_small[0]
+    elif (read_small[0] + read_small[1]) > 90:
+        g.analysis_stats_iops += "Your workload was greater than 90% 4k+8k reads.\n"
+    elif sum(read_small) > 90:
+        g.analysis_stats_iops += "Your workload was greater than 90% 4k+8k+16k reads.\n"
+    elif sum(read_small) > 50:
+        g.analysis_stats_iops += "Your workload was greater than 50% 4k+8k+16k reads.\n"
+    g.analysis_stats_bw = "Reads were %0.2f%% of the %0.2f GiB transferred.\n" % (read_bw_percent, float(total_blocks) * g.sector_size / g.GiB)
+    verbose_print(g, g.analysis_stats_iops + g.analysis_stats_bw)
+    return
+# print_stats (DONE)
+
+### Open the machine-readable output file (--format)
+def open_output(g):
+    if g.output == '':
+        g.output = g.device_str + "." + g.format
+    try:
+        g.output_fo = open(g.output, "w")
+    except:
+        print "ERROR: Failed to open " + g.output
+        sys.exit(3)
+    if g.format == 'csv':
+        g.output_csv = csv.writer(g.output_fo)
+        g.output_csv.writerow(["record", "interval", "key", "value1", "value2", "value3"])
+    verbose_print(g, "Writing " + g.format + " output to " + g.output)
+    return
+# open_output (DONE)
+
+### Convert a formatted percent (or "NA") to a number for output
+def output_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+# output_number (DONE)
+
+### Write one record (a post run or a live interval) in the --format output
+# Each section is written as soon as it is formatted, so the per-bucket dump
+# is streamed to the file rather than built up as one string
+def write_record(g):
+    fo = g.output_fo
+    interval = g.live_itterations
+    summary = [("time", time.time()), ("device", g.device_str), ("bucket_size", g.bucket_size), ("num_buckets", g.num_buckets),
+               ("io_total", g.io_total.value), ("read_total", g.read_total.value), ("write_total", g.write_total.value),
+               ("bucket_hits_total", g.bucket_hits_total.value), ("total_blocks", g.total_blocks.value), ("sector_size", g.sector_size),
+               ("blktrace_events", g.trace_events), ("blktrace_dropped", g.trace_dropped), ("drop_percent", drop_percent(g)),
+               ("sample_fraction", g.sample_fraction)]
+    histogram = [(output_number(gb), output_number(io_perc), output_number(io_sum_perc)) for (gb, io_perc, io_sum_perc) in g.histogram_iops]
+
+    if g.format == 'csv':
+        w = g.output_csv
+        for (key, value) in summary:
+            w.writerow(["summary", interval, key, value, "", ""])
+        for (gb, io_perc, io_sum_perc) in histogram:
+            w.writerow(["histogram_iops", interval, gb, io_perc, io_sum_perc, ""])
+        if g.zipf_theta != None:
+            w.writerow(["zipf_theta", interval, "theta"] + list(g.zipf_theta))
+        for (label, perc, count) in g.stats_iops:
+            w.writerow(["stats_iops", interval, label, perc, count, ""])
+        for (label, perc, gib) in g.stats_bw:
+            w.writerow(["stats_bw", interval, label, perc, gib, ""])
+        for (size_class, reads, writes) in g.size_histogram:
+            w.writerow(["size_histogram", interval, size_class, reads, writes, ""])
+        for (hit_rate, hits, filename) in g.top_file_hits:
+            w.writerow(["top_files", interval, filename, hit_rate, hits, ""])
+        for (kind, name, size_gib, reads, writes, read_sectors, write_sectors, hot_sets, theta) in g.region_report:
+            w.writerow(["region_" + kind, interval, name, reads, writes, theta[2] if theta else ""])
+        for (start, end, reads, writes, hot_sets, theta) in g.roi_report:
+            w.writerow(["roi", interval, "%d:%d" % (start, end), sum(reads.itervalues()), sum(writes.itervalues()), theta[2] if theta else ""])
+            if g.output_buckets:
+                for bucket in sorted(set(reads) | set(writes)):
+                    w.writerow(["roi_bucket", interval, "%d:%d" % (start, end), bucket, reads.get(bucket, 0), writes.get(bucket, 0)])
+        if g.overwrite_report != None:
+            (working_set, written, overwrites, percentiles, heat, once) = g.overwrite_report
+            w.writerow(["overwrite", interval, "blocks", working_set, written, overwrites])
+            for (percent, value) in zip(g.percentiles, percentiles):
+                w.writerow(["overwrite_interval", interval, percent, value, "", ""])
+            for (name, blocks, block_writes) in heat:
+                w.writerow(["write_heat", interval, name, blocks, block_writes, ""])
+        if g.burst_report != None:
+            (rows, depth) = g.burst_report
+            for (resolution, mean_iops, iops, peak_iops, ratio, mean_mib, mib, peak_mib) in rows:
+                w.writerow(["burst_iops", interval, resolution, mean_iops, peak_iops, ratio])
+                w.writerow(["burst_mib_s", interval, resolution, mean_mib, peak_mib, ""])
+            if depth != None:
+                w.writerow(["queue_depth", interval, "mean_max", depth[0], depth[2], ""])
+        if g.decay_report != None:
+            (decayed_histogram, current, longterm) = g.decay_report
+            for (gb, io_perc, io_sum_perc) in decayed_histogram:
+                w.writerow(["decayed_histogram_iops", interval, gb, io_perc, io_sum_perc, ""])
+            for (percent, now, decayed) in zip(g.hot_set_percents, current, longterm):
+                w.writerow(["decayed_hot_set", interval, percent, now, decayed, g.half_life])
+        if g.model_report != None:
+            model = g.model_report
+            w.writerow(["model", interval, model['read_percent'], model['theta'], model['iops'], model['fit'][0] if model['fit'] != None else ""])
+            for rw in ('read', 'write'):
+                for (size, percent) in model[rw + '_bssplit']:
+                    w.writerow(["model_bssplit", interval, rw, size, percent, ""])
+        if g.output_buckets:
+            for (bucket, reads, writes) in bucket_totals(g, True):
+                w.writerow(["bucket", interval, bucket, reads, writes, ""])
+    else:
+        fo.write('{"interval": %d' % interval)
+        for (key, value) in summary:
+            fo.write(', %s: %s' % (json.dumps(key), json.dumps(value)))
+        fo.write(', "histogram_iops": ')
+        fo.write(json.dumps([{"gb": gb, "io_percent": io_perc, "cumulative_percent": io_sum_perc} for (gb, io_perc, io_sum_perc) in histogram]))
+        fo.write(', "zipf_theta": ')
+        if g.zipf_theta != None:
+            fo.write(json.dumps(dict(zip(("min", "max", "estimate"), g.zipf_theta))))
+        else:
+            fo.write('null')
+        fo.write(', "stats_iops": ')
+        fo.write(json.dumps([{"size": label, "percent": perc, "ios": count} for (label, perc, count) in g.stats_iops]))
+        fo.write(', "stats_bw": ')
+        fo.write(json.dumps([{"size": label, "percent": perc, "gib": gib} for (label, perc, gib) in g.stats_bw]))
+        fo.write(', "size_histogram": ')
+        fo.write(json.dumps([{"bytes": size_class, "reads": reads, "writes": writes} for (size_class, reads, writes) in g.size_histogram]))
+        fo.write(', "top_files": ')
+        fo.write(json.dumps([{"file": filename, "percent": hit_rate, "ios": hits} for (hit_rate, hits, filename) in g.top_file_hits]))
+        fo.write(', "regions": ')
+        fo.write(json.dumps([{"kind": kind, "name": name, "size_gib": size_gib, "reads": reads, "writes": writes,
+                              "read_sectors": read_sectors, "write_sectors": write_sectors,
+                              "hot_set_gib": dict(zip([str(percent) for percent in g.hot_set_percents], hot_sets)),
+                              "zipf_theta": dict(zip(("min", "max", "estimate"), theta)) if theta else None}
+                             for (kind, name, size_gib, reads, writes, read_sectors, write_sectors, hot_sets, theta) in g.region_report]))
+        fo.write(', "roi": ')
+        fo.write(json.dumps([{"start_lba": start, "end_lba": end, "bucket_size": g.roi_bucket_size, "reads": sum(reads.itervalues()), "writes": sum(writes.itervalues()),
+                              "hot_set_buckets": dict(zip([str(percent) for percent in g.hot_set_percents], hot_sets)),
+                              "zipf_theta": dict(zip(("min", "max", "estimate"), theta)) if theta else None,
+                              "buckets": [[bucket, reads.get(bucket, 0), writes.get(bucket, 0)] for bucket in sorted(set(reads) | set(writes))] if g.output_buckets else None}
+                             for (start, end, reads, writes, hot_sets, theta) in g.roi_report]))
+        fo.write(', "bursts": ')
+        if g.burst_report != None:
+            (rows, depth) = g.burst_report
+            labels = ["p" + str(percent) for percent in g.burst_percentiles]
+            fo.write(json.dumps({"windows": [{"seconds": resolution, "mean_iops": mean_iops, "iops": dict(zip(labels, iops)), "peak_iops": peak_iops,
+                                              "peak_to_mean": ratio, "mean_mib_s": mean_mib, "mib_s": dict(zip(labels, mib)), "peak_mib_s": peak_mib}
+                                             for (resolution, mean_iops, iops, peak_iops, ratio, mean_mib, mib, peak_mib) in rows],
+                                 "queue_depth": {"mean": depth[0], "percentiles": dict(zip(labels, depth[1])), "max": depth[2]} if depth != None else None}))
+        else:
+            fo.write('null')
+        fo.write(', "decayed": ')
+        if g.decay_report != None:
+            (decayed_histogram, current, longterm) = g.decay_report
+            fo.write(json.dumps({"half_life": g.half_life,
+                                 "histogram_iops": [{"gb": gb, "io_percent": io_perc, "cumulative_percent": io_sum_perc} for (gb, io_perc, io_sum_perc) in decayed_histogram],
+                                 "hot_set_buckets": dict(zip([str(percent) for percent in g.hot_set_percents], longterm)),
+                                 "current_hot_set_buckets": dict(zip([str(percent) for percent in g.hot_set_percents], current))}))
+        else:
+            fo.write('null')
+        fo.write(', "model": ')
+        if g.model_report != None:
+            model = g.model_report
+            fo.write(json.dumps({"read_percent": model['read_percent'], "zipf_theta": model['theta'], "iops": model['iops'], "seconds": model['seconds'],
+                                 "queue_depth": model['queue_depth'], "sequential_percent": model['sequential_percent'],
+                                 "bssplit": dict([(rw, [{"bytes": size, "percent": percent} for (size, percent) in model[rw + '_bssplit']]) for rw in ('read', 'write')]),
+                                 "bssplit_variation": dict(zip(('read', 'write'), model['bssplit_variation'])),
+                                 "hot_set_buckets": dict(zip([str(percent) for percent in g.hot_set_percents], model['hot_sets'])),
+                                 "fit": {"rank_variation": model['fit'][0], "hot_set_buckets": dict(zip([str(percent) for percent in g.hot_set_percents], model['fit'][1]))}
+                                        if model['fit'] != None else None,
+                                 "fio_job": g.fio_job_file}))
+        else:
+            fo.write('null')
+        fo.write(', "overwrite": ')
+        if g.overwrite_report != None:
+            (working_set, written, overwrites, percentiles, heat, once) = g.overwrite_report
+            fo.write(json.dumps({"block_size": g.overwrite_block_size, "working_set_blocks": working_set, "written_blocks": written,
+                                 "overwrites": overwrites, "written_once_blocks": once,
+                                 "interval_blocks": dict(zip(["p" + str(percent) for percent in g.percentiles], percentiles)),
+                                 "heat": [{"class": name, "blocks": blocks, "block_writes": block_writes} for (name, blocks, block_writes) in heat]}))
+        else:
+            fo.write('null')
+        if g.output_buckets:
+            fo.write(', "buckets": [')
+            sep = ''
+            for (bucket, reads, writes) in bucket_totals(g, True):
+                fo.write('%s[%d, %d, %d]' % (sep, bucket, reads, writes))
+                sep = ', '
+            fo.write(']')
+        fo.write('}\n')
+    fo.flush()
+    return
+# write_record (DONE)
+
+### Number of hottest buckets covering X% of bucket hits
+def hot_set_buckets(g, counts, percents):
+    hot = sorted([c for c in counts if c], reverse=True)
+    total = sum(hot)
+    sizes = []
+    for percent in percents:
+        target = total * percent / 100.0
+        running = 0
+        buckets = 0
+        for c in hot:
+            if running >= target:
+                break
+            running += c
+            buckets += 1
+        sizes.append(buckets)
+    return sizes
+# hot_set_buckets (DONE)
+
+### Get the events captured and dropped from blktrace's end of run summary (one Total line per device).
+### With piped output (-o -) blktrace writes the summary to /dev/null, and only its "You have N
+### dropped events" warning reaches stderr: that gives the drops, and the events are left at 0
+def blktrace_stats(g, text):
+    events = 0
+    dropped = 0
+    for match in re.finditer("Total:\s+(\d+) events \(dropped (\d+)\)", text):
+        events += int(match.group(1))
+        dropped += int(match.group(2))
+    if events == 0:
+        for match in re.finditer("You have (\d+) (?:\(\s*[\d.]+%\) )?dropped events", text):
+            dropped += int(match.group(1))
+    if g.debug:
+        for match in re.finditer("CPU\s*(\d+):\s+(\d+) events", text):
+            debug_print(g, "blktrace CPU %s: %s events", match.group(1), match.group(2))
+    return (events, dropped)
+# blktrace_stats (DONE)
+
+### Grow the blktrace buffers after an interval that dropped events, then fall back to sampling intervals
+def tune_capture(g, events, dropped):
+    if dropped == 0:
+        if g.sample_every > 1:
+            g.sample_every /= 2 # Back off sampling once the traced intervals stop dropping
+        return
+    message = "blktrace dropped %d of %d events (%.1f%%)" % (dropped, events + dropped, dropped * 100.0 / (events + dropped))
+    if g.buffer_size < g.buffer_size_max or g.buffer_count < g.buffer_count_max:
+        g.buffer_size = min(g.buffer_size * 2, g.buffer_size_max)
+        g.buffer_count = min(g.buffer_count * 2, g.buffer_count_max)
+        message += ": raising buffers to %d x %d KiB per CPU" % (g.buffer_count, g.buffer_size)
+    elif g.sample_every < g.sample_max:
+        g.sample_every *= 2
+        message += ": buffers are at the maximum, now tracing 1 of every %d intervals" % g.sample_every
+    print "\n" + message
+    return
+# tune_capture (DONE)
+
+### Write the per-interval capture log (blktrace buffers, events and drops) that 'post' mode reads
+def write_capture_log(g, filename, rows):
+    try:
+        fo = open(filename, "w")
+    except:
+        print "ERROR: Failed to open " + filename
+        sys.exit(3)
+    fo.write("# ioprof capture log v1: interval traced buffer_size_kib buffer_count events dropped\n")
+    for row in rows:
+        fo.write("%d %d %d %d %d %d\n" % row)
+    fo.close()
+    return
+# write_capture_log (DONE)
+
+### Total the capture log of a trace
+def read_capture_log(g, filename):
+    intervals = 0
+    traced = 0
+    for line in open(filename, "r"):
+        if line.startswith("#"):
+            continue
+        (interval, sampled, buffer_size, buffer_count, events, dropped) = [int(field) for field in line.split()]
+        intervals += 1
+        traced += sampled
+        g.trace_events += events
+        g.trace_dropped += dropped
+    if intervals:
+        g.sample_fraction = float(traced) / intervals
+    return
+# read_capture_log (DONE)
+
+### Percent of blktrace events that were dropped (None if unknown)
+def drop_percent(g):
+    if g.trace_events + g.trace_dropped == 0:
+        return None
+    return g.trace_dropped * 100.0 / (g.trace_events + g.trace_dropped)
+# drop_percent (DONE)
+
+### Prometheus exposition handler: serves the last published snapshot
+class metrics_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        g = self.server.g
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        # Read the front buffer only, publish_metrics never writes to it
+        body = g.metrics_buffers[g.metrics_front]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        debug_print(self.server.g, "metrics: " + format % args)
+# metrics_handler (DONE)
+
+### Start the local metrics endpoint for live mode (--metrics-port)
+def start_metrics_server(g):
+    try:
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", g.metrics_port), metrics_handler)
+    except:
+        print "ERROR: Failed to listen on port " + str(g.metrics_port)
+        sys.exit(3)
+    server.g = g
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print "Serving metrics on http://127.0.0.1:%d/metrics" % g.metrics_port
+    return
+# start_metrics_server (DONE)
+
+### Fold one live interval into the metrics counters and publish a new snapshot.  dropped is the
+### interval's count from blktrace's stderr warning, as its summary is discarded with piped output
+def publish_metrics(g, dropped):
+    totals = g.metrics_totals
+    r_totals = dict(g.r_totals)
+    w_totals = dict(g.w_totals)
+    names = (("read", r_totals), ("write", w_totals))
+    rates = []
+    for (rw, sizes) in names:
+        ios = sum(sizes.values())
+        size_bytes = sum([size * count for (size, count) in sizes.iteritems()]) * g.sector_size
+        totals[('io', rw)] = totals.get(('io', rw), 0) + ios
+        totals[('bytes', rw)] = totals.get(('bytes', rw), 0) + size_bytes
+        rates.append((rw, float(ios) / g.timeout, float(size_bytes) / g.timeout))
+        for size, count in sizes.iteritems():
+            key = ('size', rw, io_size_class(g, size))
+            totals[key] = totals.get(key, 0) + count
+    totals['dropped'] = totals.get('dropped', 0) + dropped
+    totals['intervals'] = totals.get('intervals', 0) + 1
+    hot_sets = hot_set_buckets(g, get_bucket_counts(g), g.hot_set_percents)
+
+    dev = 'device="%s"' % g.device_str
+    lines = []
+    def metric(name, kind, help, samples):
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for (suffix, labels, value) in samples:
+            lines.append("%s%s{%s} %s" % (name, suffix, ",".join([dev] + labels), repr(value) if isinstance(value, float) else value))
+
+    metric("ioprof_io_total", "counter", "I/O's queued since live mode started.",
+           [('', ['rw="%s"' % rw], totals[('io', rw)]) for (rw, sizes) in names])
+    metric("ioprof_bytes_total", "counter", "Bytes queued since live mode started.",
+           [('', ['rw="%s"' % rw], totals[('bytes', rw)]) for (rw, sizes) in names])
+    metric("ioprof_iops", "gauge", "I/O's per second over the last interval.",
+           [('', ['rw="%s"' % rw], iops) for (rw, iops, bw) in rates])
+    metric("ioprof_bandwidth_bytes", "gauge", "Bytes per second over the last interval.",
+           [('', ['rw="%s"' % rw], bw) for (rw, iops, bw) in rates])
+    samples = []
+    classes = sorted(set([key[2] for key in totals if key[0] == 'size']))
+    for (rw, sizes) in names:
+        running = 0
+        for size_class in classes:
+            running += totals.get(('size', rw, size_class), 0)
+            samples.append(('_bucket', ['rw="%s"' % rw, 'le="%d"' % size_class], running))
+        samples.append(('_bucket', ['rw="%s"' % rw, 'le="+Inf"'], totals[('io', rw)]))
+        samples.append(('_sum', ['rw="%s"' % rw], totals[('bytes', rw)]))
+        samples.append(('_count', ['rw="%s"' % rw], totals[('io', rw)]))
+    metric("ioprof_io_size_bytes", "histogram", "I/O size distribution (power-of-two classes) since live mode started.", samples)
+    metric("ioprof_hot_set_bytes", "gauge", "Bytes in the hottest buckets covering the given percent of bucket hits over the last interval.",
+           [('', ['percent="%s"' % percent], buckets * g.bucket_size) for (percent, buckets) in zip(g.hot_set_percents, hot_sets)])
+    if g.decay_report != None:
+        metric("ioprof_decayed_hot_set_bytes", "gauge", "Bytes in the hottest buckets covering the given percent of decayed (half-life) bucket hits.",
+               [('', ['percent="%s"' % percent], buckets * g.bucket_size) for (percent, buckets) in zip(g.hot_set_percents, g.decay_report[2])])
+    if g.zipf_theta != None:
+        metric("ioprof_zipf_theta", "gauge", "Approximate Zipfian theta of bucket hits over the last interval.",
+               [('', ['bound="%s"' % bound], value) for (bound, value) in zip(("min", "max", "estimate"), g.zipf_theta)])
+    metric("ioprof_dropped_events_total", "counter", "Events blktrace warned it dropped since live mode started.",
+           [('', [], totals['dropped'])])
+    metric("ioprof_intervals_total", "counter", "Live mode intervals completed.", [('', [], totals['intervals'])])
+    metric("ioprof_last_interval_timestamp_seconds", "gauge", "Time the last interval was published.", [('', [], time.time())])
+
+    # Fill the back buffer, then flip it to the front so readers never see a partial snapshot
+    back = 1 - g.metrics_front
+    g.metrics_buffers[back] = "\n".join(lines) + "\n"
+    g.metrics_front = back
+    return
+# publish_metrics (DONE)
+
+### Start timing profiled phases in this process (--profile)
+def phase_start(g):
+    if g.profile != '':
+        times = os.times()
+        g.phase_last = (time.time(), times[0] + times[1])
+    return
+# phase_start (DONE)
+
+### Record wall time, CPU time, events and peak memory since the last mark in this process.
+### Worker routines run inline when single threaded, where the main process phases already time them.
+def phase_mark(g, phase, events, worker=False):
+    if g.profile == '' or g.phase_last == None:
+        return
+    if worker and os.getpid() == g.main_pid:
+        return
+    times = os.times()
+    now = (time.time(), times[0] + times[1])
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    g.profile_records.append((phase, worker, now[0] - g.phase_last[0], now[1] - g.phase_last[1], events, max_rss))
+    g.phase_last = now
+    return
+# phase_mark (DONE)
+
+### Run a worker process routine, timed (--profile) and under cProfile (--cprofile)
+def run_worker(g, target, *args):
+    phase_start(g)
+    if g.cprofile == '':
+        target(g, *args)
+        return
+    profile = cProfile.Profile()
+    try:
+        profile.runcall(target, g, *args)
+    finally:
+        profile.dump_stats(os.path.join(g.cprofile, "%s.%d.prof" % (target.__name__, os.getpid())))
+    return
+# run_worker (DONE)
+
+### Start a worker process once fewer than thread_max of plist are running, so no more than
+### thread_max workers (and their --memory shares) are ever alive at once
+def start_worker(g, plist, target, *args):
+    while len(plist) >= g.thread_max:
+        for p in plist[:]:
+            p.join(0)
+            if not p.is_alive():
+                plist.remove(p)
+        if len(plist) >= g.thread_max:
+            time.sleep(0.10)
+    p = Process(target=run_worker, args=(g, target) + args)
+    plist.append(p)
+    p.start()
+    return
+# start_worker (DONE)
+
+### Print the per-phase profile (--profile text|json)
+def print_profile(g):
+    phases = []
+    totals = {}
+    for (phase, worker, wall, cpu, events, max_rss) in list(g.profile_records):
+        key = (phase, worker)
+        if key not in totals:
+            phases.append(key)
+            totals[key] = [0, 0.0, 0.0, 0, 0]
+        total = totals[key]
+        total[0] += 1
+        total[1] += wall
+        total[2] += cpu
+        total[3] += events
+        total[4] = max(total[4], max_rss)
+
+    if g.profile == 'json':
+        rows = []
+        for (phase, worker) in phases:
+            (count, wall, cpu, events, max_rss) = totals[(phase, worker)]
+            rows.append({"phase": phase, "workers": worker, "count": count, "wall": wall, "cpu": cpu, "events": events, "max_rss": max_rss})
+        print json.dumps({"profile": rows})
+        return
+
+    print "--------------------------------------------"
+    print "Profile (worker rows are summed over all worker processes):"
+    print "%-18s %6s %10s %10s %12s %12s %10s" % ("Phase", "Count", "Wall(s)", "CPU(s)", "Events", "Events/s", "Peak RSS")
+    for (phase, worker) in phases:
+        (count, wall, cpu, events, max_rss) = totals[(phase, worker)]
+        rate = "%d" % (events / wall) if wall > 0 and events else "-"
+        print "%-18s %6d %10.3f %10.3f %12d %12s %9.1fM" % (phase + (" (workers)" if worker else ""), count, wall, cpu, events, rate, float(max_rss) / g.MiB)
+    print "--------------------------------------------"
+    return
+# print_profile (DONE)
+
+
+### Write rows (sorted by the caller) to a tab-separated spill run and register it for cleanup
+def write_run(g, kind, rows):
+    g.thread_spill_count += 1
+    name = "spill.%s.%s.%d.%d" % (g.device_str, kind, os.getpid(), g.thread_spill_count)
+    try:
+        fo = open(name, "w")
+    except:
+        print "ERROR: Failed to open " + name
+        sys.exit(3)
+    g.spill_runs.append((kind, name))
+    for row in rows:
+        fo.write("\t".join([str(field) for field in row]) + "\n")
+    fo.close()
+    return name
+# write_run (DONE)
+
+### Stream the rows of a spill run back as typed tuples
+def read_run(g, name, types):
+    fo = open(name, "r")
+    for line in fo:
+        yield tuple([convert(field) for (convert, field) in zip(types, line.rstrip("\n").split("\t"))])
+    fo.close()
+# read_run (DONE)
+
+### Merge sorted runs, combining adjacent rows with the same key (combine=None keeps every row)
+def merge_rows(g, names, types, combine):
+    current = None
+    for row in heapq.merge(*[read_run(g, name, types) for name in names]):
+        if current != None and combine != None and row[0] == current[0]:
+            current = combine(current, row)
+        else:
+            if current != None:
+                yield current
+            current = row
+    if current != None:
+        yield current
+# merge_rows (DONE)
+
+### Merge sorted runs into a single sorted run, at most spill_fanin runs at a time
+def merge_runs(g, kind, names, types, combine):
+    while True:
+        merged = []
+        for i in xrange(0, len(names), g.spill_fanin):
+            group = names[i:i + g.spill_fanin]
+            merged.append(write_run(g, kind, merge_rows(g, group, types, combine)))
+            for name in group:
+                os.remove(name)
+        names = merged
+        if len(names) <= 1:
+            return names[0] if names else ''
+# merge_runs (DONE)
+
+### Spill the thread-local bucket counters to a sorted run (out-of-core mode)
+def spill_buckets(g):
+    buckets = sorted(set(g.thread_reads) | set(g.thread_writes))
+    if buckets:
+        write_run(g, "buckets", [(bucket, g.thread_reads.get(bucket, 0), g.thread_writes.get(bucket, 0)) for bucket in buckets])
+    g.thread_reads.clear()
+    g.thread_writes.clear()
+    return
+# spill_buckets (DONE)
+
+### Translate a filetrace range list ("start:finish start:finish ...") into (start bucket, finish bucket) pairs
+def file_bucket_ranges(g, ranges):
+    for range in ranges.split(' '):
+        try:
+            (start, finish) = range.split(':')
+        except:
+            continue
+        if start == '' or finish == '':
+            continue
+        yield (lba_to_bucket(g, start), lba_to_bucket(g, finish))
+# file_bucket_ranges (DONE)
+
+### Merge the spilled bucket and file range runs once parsing is done (out-of-core mode)
+def merge_spill_runs(g):
+    print "Merging sorted runs.  This will take a few seconds..."
+    runs = list(g.spill_runs)
+    bucket_runs = [name for (kind, name) in runs if kind == "buckets"]
+    file_runs = [name for (kind, name) in runs if kind == "files"]
+    verbose_print(g, "merging %d bucket runs and %d file range runs", len(bucket_runs), len(file_runs))
+    g.bucket_file = merge_runs(g, "buckets", bucket_runs, (int, int, int), lambda a, b: (a[0], a[1] + b[1], a[2] + b[2]))
+    if file_runs:
+        g.trace_files = True
+        g.files_file = merge_runs(g, "files", file_runs, (int, int, str), None)
+    g.bucket_counts = None
     return
-# print_stats (TODO)
+# merge_spill_runs (DONE)
+
+### Count I/O's per file by sweeping the sorted bucket totals against the sorted file ranges
+### (out-of-core mode).  Returns the file hit counts of the top files only
+def sweep_file_hits(g):
+    ranges = read_run(g, g.files_file, (int, int, str))
+    pending = next(ranges, None)
+    active = [] # Heap of (finish bucket, file) for the ranges covering the current bucket
+    hits = {}
+    hit_runs = []
+    for (bucket, reads, writes) in bucket_totals(g, True):
+        if bucket >= g.num_buckets:
+            continue
+        while pending != None and pending[0] <= bucket:
+            heapq.heappush(active, (pending[1], pending[2]))
+            pending = next(ranges, None)
+        while active and active[0][0] < bucket:
+            heapq.heappop(active)
+        # A file with several ranges on the same bucket gets the bucket's I/O's once
+        for file in set([file for (finish, file) in active]):
+            hits[file] = hits.get(file, 0) + reads + writes
+        if len(hits) > g.spill_entries:
+            hit_runs.append(write_run(g, "hits", sorted(hits.iteritems())))
+            hits = {}
+    hit_runs.append(write_run(g, "hits", sorted(hits.iteritems())))
+    merged = merge_rows(g, hit_runs, (str, int), lambda a, b: (a[0], a[1] + b[1]))
+    return dict(heapq.nsmallest(g.top_count_limit + 1, merged, key=lambda (file, count): (-count, file)))
+# sweep_file_hits (DONE)
 
+### Yield (bucket, reads, writes) for every bucket that saw I/O (in bucket order if ordered)
+def bucket_totals(g, ordered=False):
+    if g.bucket_file != '':
+        # Out-of-core mode: stream the merged run, which is already in bucket order
+        for row in read_run(g, g.bucket_file, (int, int, int)):
+            yield row
+        return
+    reads = dict(g.reads)
+    writes = dict(g.writes)
+    buckets = set(reads) | set(writes)
+    if ordered:
+        buckets = sorted(buckets)
+    for bucket in buckets:
+        yield (bucket, reads.get(bucket, 0), writes.get(bucket, 0))
+# bucket_totals (DONE)
 
 ### Combine thread-local counts into global counts
 def total_thread_counts (g, num):
 
     g.max_bucket_hits_semaphore.acquire()
-    debug_print(g, "Thread " + str(num) + " has max_bucket_hits lock t=" + str(g.thread_max_bucket_hits) + " g=" + str(g.max_bucket_hits.value))
+    debug_print(g, "Thread %s has max_bucket_hits lock t=%s g=%s", num, g.thread_max_bucket_hits, g.max_bucket_hits.value)
     if(g.thread_max_bucket_hits > g.max_bucket_hits.value):
         g.max_bucket_hits.value = g.thread_max_bucket_hits
-    debug_print(g, "Thread " + str(num) + " releasing max_bucket_hits lock t=" + str(g.thread_max_bucket_hits) + " g=" + str(g.max_bucket_hits.value))
+    debug_print(g, "Thread %s releasing max_bucket_hits lock t=%s g=%s", num, g.thread_max_bucket_hits, g.max_bucket_hits.value)
     g.max_bucket_hits_semaphore.release()
 
     g.total_blocks_semaphore.acquire()
-    debug_print(g, "Thread " + str(num) + " has total_blocks lock t=" + str(g.thread_total_blocks) + " g=" + str(g.total_blocks.value))
+    debug_print(g, "Thread %s has total_blocks lock t=%s g=%s", num, g.thread_total_blocks, g.total_blocks.value)
     g.total_blocks.value += g.thread_total_blocks
-    debug_print(g, "Thread " + str(num) + " releasing total_blocks lock t=" + str(g.thread_total_blocks) + " g=" + str(g.total_blocks.value))
+    debug_print(g, "Thread %s releasing total_blocks lock t=%s g=%s", num, g.thread_total_blocks, g.total_blocks.value)
     g.total_blocks_semaphore.release()
 
     g.total_semaphore.acquire()
-    debug_print(g, "Thread " + str(num) + " has total lock t=" + str(g.thread_io_total) + " g=" + str(g.io_total.value))
+    debug_print(g, "Thread %s has total lock t=%s g=%s", num, g.thread_io_total, g.io_total.value)
     g.io_total.value += g.thread_io_total
-    debug_print(g, "Thread " + str(num) + " releasing total lock t=" + str(g.thread_io_total) + " g=" + str(g.io_total.value))
+    debug_print(g, "Thread %s releasing total lock t=%s g=%s", num, g.thread_io_total, g.io_total.value)
     g.total_semaphore.release()
 
     g.read_totals_semaphore.acquire()
-    debug_print(g, "Thread " + str(num) + " has read_totals lock t=" + str(g.thread_read_total) + " g=" + str(g.read_total.value))
+    debug_print(g, "Thread %s has read_totals lock t=%s g=%s", num, g.thread_read_total, g.read_total.value)
     g.read_total.value += g.thread_read_total
     for io_size, hits in g.thread_r_totals.iteritems():
         if io_size in g.r_totals:
             g.r_totals[io_size] += hits
         else:
             g.r_totals[io_size] = hits
-    debug_print(g, "Thread " + str(num) + " releasing read_totals lock t=" + str(g.thread_read_total) + " g=" + str(g.read_total.value))
+    debug_print(g, "Thread %s releasing read_totals lock t=%s g=%s", num, g.thread_read_total, g.read_total.value)
     g.read_totals_semaphore.release()
 
     g.write_totals_semaphore.acquire()
-    debug_print(g, "Thread " + str(num) + " has write_totals lock t=" + str(g.thread_write_total) + " g=" + str(g.write_total.value))
+    debug_print(g, "Thread %s has write_totals lock t=%s g=%s", num, g.thread_write_total, g.write_total.value)
     g.write_total.value += g.thread_write_total
     for io_size, hits in g.thread_w_totals.iteritems():
         if io_size in g.w_totals:
             g.w_totals[io_size] += hits
         else:
             g.w_totals[io_size] = hits
-    debug_print(g, "Thread " + str(num) + " releasing write_totals lock t=" + str(g.thread_write_total) + " g=" + str(g.write_total.value))
+    debug_print(g, "Thread %s releasing write_totals lock t=%s g=%s", num, g.thread_write_total, g.write_total.value)
     g.write_totals_semaphore.release()
 
+    if g.spill_entries:
+        # Out-of-core mode: bucket counters go to sorted runs that are merged after parsing
+        spill_buckets(g)
+
     g.read_semaphore.acquire()
-    debug_print(g, "Thread " + str(num) + " has read lock.")
+    debug_print(g, "Thread %s has read lock.", num)
     for bucket,value in g.thread_reads.iteritems():
         try:
             g.reads[bucket] += value
         except:
             g.reads[bucket] = value
-        debug_print(g, "Thread " + str(num) + " has read lock.  Bucket=" + str(bucket) + " Value=" + str(value) + " g.reads[bucket]=" + str(g.reads[bucket]))
+        if g.debug:
+            debug_print(g, "Thread %s has read lock.  Bucket=%s Value=%s g.reads[bucket]=%s", num, bucket, value, g.reads[bucket])
     g.read_semaphore.release()
 
     g.write_semaphore.acquire()
-    debug_print(g, "Thread " + str(num) + " has write lock.")
+    debug_print(g, "Thread %s has write lock.", num)
     for bucket,value in g.thread_writes.iteritems():
         try:
             g.writes[bucket] += value
         except:
             g.writes[bucket] = value
-        debug_print(g, "Thread " + str(num) + " has write lock.  Bucket=" + str(bucket) + " Value=" + str(value) + " g.writes[bucket]=" + str(g.writes[bucket]))
+        if g.debug:
+            debug_print(g, "Thread %s has write lock.  Bucket=%s Value=%s g.writes[bucket]=%s", num, bucket, value, g.writes[bucket])
     g.write_semaphore.release()
 
     g.total_semaphore.acquire()
-    debug_print(g, "Thread " + str(num) + " has total lock t=" + str(g.thread_bucket_hits_total) + " g=" + str(g.bucket_hits_total.value))
+    debug_print(g, "Thread %s has total lock t=%s g=%s", num, g.thread_bucket_hits_total, g.bucket_hits_total.value)
     g.bucket_hits_total.value += g.thread_bucket_hits_total
-    debug_print(g, "Thread " + str(num) + " releasing total lock t=" + str(g.thread_bucket_hits_total) + " g=" + str(g.bucket_hits_total.value))
+    debug_print(g, "Thread %s releasing total lock t=%s g=%s", num, g.thread_bucket_hits_total, g.bucket_hits_total.value)
     g.total_semaphore.release()
 
+    if g.thread_region_stats:
+        g.region_parts.append(g.thread_region_stats)
+        g.thread_region_stats = {}
+    if g.thread_roi != None:
+        g.roi_parts.append(g.thread_roi)
+        g.thread_roi = None
+    if g.thread_write_clock:
+        g.overwrite_parts.append((g.thread_segment, g.thread_write_clock, overwrite_state(g), g.thread_overwrite_hist))
+        g.thread_write_clock = 0
+        g.thread_overwrite_chunks = {}
+        g.thread_overwrite_hist = [0] * g.hdr_size
+
+    if g.thread_stream_head != None:
+        # A byte range of a split trace: the range before it may have left streams open, so ship the
+        # head and the open streams for stream_totals() to stitch in order
+        g.stream_parts.append((g.thread_segment, g.thread_stream_head, g.thread_head_state, g.thread_head_runs,
+                               dict([(rw, streams.items()) for (rw, streams) in g.thread_streams.iteritems()]), dict(g.thread_last_lba)))
+        g.thread_stream_head = None
+        g.thread_head_runs = {}
+        for streams in g.thread_streams.itervalues():
+            streams.clear()
+        g.thread_last_lba = {'R': -1, 'W': -1}
+    else:
+        flush_streams(g)
+    g.stream_semaphore.acquire()
+    debug_print(g, "Thread %s has stream lock.", num)
+    for key, value in g.thread_stream_stats.iteritems():
+        try:
+            g.stream_stats[key] += value
+        except:
+            g.stream_stats[key] = value
+    g.thread_stream_stats = {}
+    g.stream_semaphore.release()
+
     return
 # total_thread_counts (DONE)
 
-### Thread parse routine for blktrace output
-def thread_parse(g, file, num):
-    #print "thread_parse\n"
-    linecount = 0
-    os.system("gunzip " + file + ".gz")
-    debug_print(g, "\nSTART: " +  file + " " + str(num) + "\n")
+### Get the partitions (name, start, end) from fdisk output, in sectors
+def parse_partitions(g, out):
+    partitions = []
+    for line in out.split("\n"):
+        match = re.match("(/dev/\S+)\s+(?:\*\s+)?(\d+)\s+(\d+)\s+\d+", line)
+        if match != None:
+            partitions.append((os.path.basename(match.group(1)), int(match.group(2)), int(match.group(3)) + 1))
+    return partitions
+# parse_partitions (DONE)
+
+### Read a layout file written by write_layout: ({major:minor: (name, dm name, start, sectors, parent)}, [table lines])
+def read_layout(g, filename):
+    devices = {}
+    tables = []
+    for line in open(filename, "r"):
+        fields = line.split()
+        if len(fields) == 7 and fields[0] == "dev":
+            devices[fields[1]] = (fields[2], fields[3], int(fields[4]), int(fields[5]), fields[6])
+        elif len(fields) > 4 and fields[0] == "table":
+            tables.append((fields[1].rstrip(":"), int(fields[2]), int(fields[3]), fields[4], fields[5:]))
+    return (devices, tables)
+# read_layout (DONE)
+
+### Read the trace metadata member: sets the device and its geometry, returns (partitions, layout) for build_regions
+def read_metadata(g, filename):
     try:
-        fo = open(file, "r")
+        meta = json.load(open(filename, "r"))
     except:
-        print "ERROR: Failed to open " + file
+        print "ERROR: Failed to read the trace metadata in " + filename
         sys.exit(3)
-    else:
-        count=0
-        hit_count = 0
-        for line in fo:
-            count += 1
-            result_set = regex_find(g, '(\S+)\s+Q\s+(\S+)\s+(\S+)$', line)
-            if result_set != False:
-                #(a, b, c) = regex_find('.*Q.*', line)
-                hit_count += 1
-                #print len(set)
-                #print "a=" + a + " b=" + b + " c=" + c + "\n"
-                #print set
-                #sys.stdout.flush()
-                try:
-                    parse_me(g, result_set[0], int(result_set[1]), int(result_set[2]))
-                except:
-                    pass
-            #sys.stdout.flush()
-        fo.close()
-        total_thread_counts(g, num)
-        debug_print(g,  "\n FINISH" + file +  " (" + str(count) + " lines) [hit_count=" + str(hit_count) + "]" + str(g.thread_io_total) + "\n")
-        rc = os.system("rm -f " + file)
+    if meta.get("format") != "ioprof-trace" or meta.get("format_version", 0) > g.meta_version:
+        print "ERROR: " + filename + " is format %s v%s, this ioprof reads ioprof-trace up to v%d" % (meta.get("format"), meta.get("format_version"), g.meta_version)
+        sys.exit(11)
+    g.device = meta["device"]
+    g.device_str = meta["device_str"]
+    g.sector_size = meta["sector_size"]
+    g.total_lbas = meta["total_lbas"]
+    capture = meta["capture"]
+    verbose_print(g, "trace of %s by ioprof %s on %s (%s), %s to %s UTC, %d of %d intervals of %ds traced, buffers %d x %d KiB",
+                  g.device, meta["ioprof_version"], meta["host"]["hostname"], meta["host"]["kernel"],
+                  time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(capture["start"])), time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(capture["end"])),
+                  capture["traced_intervals"], capture["intervals"], capture["interval"], capture["buffer_count"], capture["buffer_size_kib"])
+    g.trace_seconds = capture["interval"] * capture["traced_intervals"]
+    partitions = [(entry["name"], entry["start"], entry["end"]) for entry in meta["partitions"]]
+    layout = None
+    if meta["layout"] != None:
+        layout = (dict([(dev, tuple(info)) for (dev, info) in meta["layout"]["devices"].iteritems()]),
+                  [tuple(table) for table in meta["layout"]["tables"]])
+    return (partitions, layout)
+# read_metadata (DONE)
+
+### Build the sorted interval tables that attribute I/O's to partitions, logical volumes and backing devices
+def build_regions(g, partitions, layout):
+    regions = {'partition': [], 'lv': [], 'backing': []}
+    g.region_sizes = {}
+    scale = lambda sectors: sectors * 512 / g.sector_size # dmsetup and sysfs count 512 byte sectors
+    # Leave out extended partitions, their logical partitions are listed too and the table sweep needs disjoint intervals
+    partitions = [(name, start, end) for (name, start, end) in partitions
+                  if not [inner for inner in partitions if inner[0] != name and start <= inner[1] and inner[2] <= end]]
+    for (name, start, end) in partitions:
+        regions['partition'].append((start, end, ('linear', name, -start)))
+        g.region_sizes[('partition', name)] = end - start
+
+    if layout != None:
+        (devices, tables) = layout
+        traced = os.path.basename(g.device)
+        names = dict([(dev, info[0]) for (dev, info) in devices.iteritems()])
+        # Offset of each device on the traced device: the traced device itself and its partitions
+        offsets = {}
+        for (dev, (kname, dm_name, start, sectors, parent)) in devices.iteritems():
+            if traced in (kname, dm_name):
+                offsets[dev] = 0
+            elif parent == traced:
+                offsets[dev] = scale(start)
+        for (dm_name, start, length, target, args) in tables:
+            start = scale(start)
+            length = scale(length)
+            if target == 'linear':
+                stripes = [(args[0], scale(int(args[1])))]
+                chunk = length
+            elif target == 'striped':
+                chunk = scale(int(args[1]))
+                stripes = [(args[i], scale(int(args[i + 1]))) for i in xrange(2, 2 + 2 * int(args[0]), 2)]
+            else:
+                continue # Only linear and striped targets map LBAs directly
+            if traced == dm_name or [dev for (dev, info) in devices.iteritems() if info[0] == traced and info[1] == dm_name]:
+                # Tracing the mapped device: attribute each segment to the devices underneath it
+                names_offsets = [(names.get(dev, dev), offset) for (dev, offset) in stripes]
+                if len(stripes) == 1:
+                    regions['backing'].append((start, start + length, ('linear', names_offsets[0][0], names_offsets[0][1] - start)))
+                else:
+                    regions['backing'].append((start, start + length, ('stripe_out', names_offsets, chunk, start)))
+                for (name, offset) in names_offsets:
+                    g.region_sizes[('backing', name)] = g.region_sizes.get(('backing', name), 0) + length / len(stripes)
+                continue
+            # Tracing a device underneath: attribute the segments that live on it to the logical volume
+            for (index, (dev, offset)) in enumerate(stripes):
+                if dev not in offsets:
+                    continue
+                base = offsets[dev] + offset
+                if len(stripes) == 1:
+                    regions['lv'].append((base, base + length, ('linear', dm_name, start - base)))
+                else:
+                    regions['lv'].append((base, base + length / len(stripes), ('stripe_in', dm_name, chunk, len(stripes), index, start, base)))
+                g.region_sizes[('lv', dm_name)] = g.region_sizes.get(('lv', dm_name), 0) + length / len(stripes)
+
+    g.regions = []
+    for kind in ('partition', 'lv', 'backing'):
+        if regions[kind]:
+            entries = sorted(regions[kind])
+            g.regions.append((kind, [entry[0] for entry in entries], entries))
+            verbose_print(g, "%d %s regions", len(entries), kind)
     return
+# build_regions (DONE)
 
-# thread_parse (DONE)
+### Region and region-relative LBA of an LBA inside a region table entry
+def region_lookup(g, entry, lba):
+    mapping = entry[2]
+    if mapping[0] == 'linear':
+        return (mapping[1], lba + mapping[2])
+    if mapping[0] == 'stripe_out':
+        (kind, names_offsets, chunk, start) = mapping
+        rel = lba - start
+        stripe = (rel / chunk) % len(names_offsets)
+        (name, offset) = names_offsets[stripe]
+        return (name, offset + (rel / chunk / len(names_offsets)) * chunk + rel % chunk)
+    (kind, name, chunk, stripes, index, start, base) = mapping
+    rel = lba - base
+    return (name, start + ((rel / chunk) * stripes + index) * chunk + rel % chunk)
+# region_lookup (DONE)
 
-### Parse blktrace output
-def parse_me(g, rw, lba, size):
-    debug_print(g,  "rw=" + rw + " lba=" + str(lba) + " size=" + str(size))
-    if (rw == 'R') or (rw == 'RW'):
-        # Read
+### Attribute a batch of (rw, lba, size) I/O's to the regions: sort once, then walk each interval table
+def attribute_batch(g, batch):
+    batch.sort(key=lambda io: io[1])
+    for (kind, starts, entries) in g.regions:
+        i = max(0, bisect.bisect_right(starts, batch[0][1]) - 1)
+        for (rw, lba, size) in batch:
+            while i + 1 < len(entries) and entries[i + 1][0] <= lba:
+                i += 1
+            if lba < entries[i][0] or lba >= entries[i][1]:
+                continue
+            (name, rel) = region_lookup(g, entries[i], lba)
+            try:
+                stats = g.thread_region_stats[(kind, name)]
+            except KeyError:
+                stats = g.thread_region_stats[(kind, name)] = [0, 0, 0, 0, {}, {}]
+            read = 0 if rw in ('R', 'RW') else 1
+            stats[read] += 1
+            stats[2 + read] += size
+            stats[5][size] = stats[5].get(size, 0) + 1
+            first = (rel * g.sector_size) / g.bucket_size
+            for bucket in xrange(first, ((rel + max(size, 1)) * g.sector_size - 1) / g.bucket_size + 1):
+                stats[4][bucket] = stats[4].get(bucket, 0) + 1
+    return
+# attribute_batch (DONE)
+
+### Merge the region counters of all workers: {(kind, name): [reads, writes, read sectors, write sectors, {bucket: hits}, {size: I/O's}]}
+def region_totals(g):
+    totals = {}
+    for part in g.region_parts:
+        for (key, stats) in part.iteritems():
+            if key not in totals:
+                totals[key] = [0, 0, 0, 0, {}, {}]
+            total = totals[key]
+            for i in xrange(4):
+                total[i] += stats[i]
+            for i in (4, 5):
+                for (item, count) in stats[i].iteritems():
+                    total[i][item] = total[i].get(item, 0) + count
+    return totals
+# region_totals (DONE)
+
+### Print I/O stats, hot-set sizes and Zipf estimates per partition, logical volume and backing device
+def print_regions(g):
+    g.region_report = []
+    if not g.regions:
+        return
+    totals = region_totals(g)
+    titles = {'partition': "partition", 'lv': "logical volume", 'backing': "backing device"}
+    for (kind, starts, entries) in g.regions:
+        names = sorted(set([name for (k, name) in totals if k == kind]) | set([name for (k, name) in g.region_sizes if k == kind]))
+        print "--------------------------------------------"
+        print "I/O by " + titles[kind] + ":"
+        printf("%-20s %9s %7s %10s %10s %6s %8s %s %s\n", "Name", "Size GiB", "IOPS%", "Reads", "Writes", "Read%", "Avg KiB",
+               "Hot set GiB (" + "/".join(["%d%%" % percent for percent in g.hot_set_percents]) + ")", "Zipf theta")
+        for name in names:
+            (reads, writes, read_sectors, write_sectors, buckets, sizes) = totals.get((kind, name), [0, 0, 0, 0, {}, {}])
+            ios = reads + writes
+            size_gib = float(g.region_sizes.get((kind, name), 0)) * g.sector_size / g.GiB
+            hot_sets = [float(count) * g.bucket_size / g.GiB for count in hot_set_buckets(g, buckets.values(), g.hot_set_percents)]
+            counts = {}
+            for hits in buckets.itervalues():
+                counts[hits] = counts.get(hits, 0) + 1
+            theta = zipf_theta(g, counts) if ios else None
+            g.region_report.append((kind, name, size_gib, reads, writes, read_sectors, write_sectors, hot_sets, theta))
+            if ios == 0:
+                printf("%-20s %9.1f %7s\n", name, size_gib, "-")
+                continue
+            printf("%-20s %9.1f %6.2f%% %10d %10d %5.1f%% %8.1f %s %s\n", name, size_gib,
+                   ios * 100.0 / max(1, g.io_total.value), reads, writes, reads * 100.0 / ios,
+                   float(read_sectors + write_sectors) * g.sector_size / g.KiB / ios,
+                   "/".join(["%.2f" % gib for gib in hot_sets]), "%.4f" % theta[2])
+    print "--------------------------------------------"
+    return
+# print_regions (DONE)
+
+### Record the write clock of every block a write covers; a block written before in this
+### segment of the trace adds its overwrite interval (blocks written in between) to the histogram
+def track_overwrite(g, lba, size):
+    stamp = g.thread_write_clock + 1
+    first = (lba * g.sector_size) / g.overwrite_block_size
+    last = ((lba + size) * g.sector_size - 1) / g.overwrite_block_size
+    chunks = g.thread_overwrite_chunks
+    hist = g.thread_overwrite_hist
+    width = g.overwrite_chunk
+    seen = index = 0
+    block = first
+    while block <= last:
+        chunk = block / width
+        base = chunk * width
+        state = chunks.get(chunk)
+        if state == None:
+            if g.overwrite_max_chunks and len(chunks) >= g.overwrite_max_chunks:
+                # Over this process' share of --memory: give up on the analysis rather than the ceiling
+                g.overwrite = False
+                g.thread_overwrite_chunks = None
+                return
+            # (last stamp, writes, first stamp) per block, stamps are clock + 1 so 0 is never written.
+            # First stamps only stitch a segment onto the ones before it, so the head segment has none.
+            # Stamps are 'L' as the clock passes 2^32 after 16 TiB of 4 KiB blocks
+            state = chunks[chunk] = (array.array('L', [0]) * width, array.array('I', [0]) * width,
+                                     None if g.thread_segment == g.overwrite_head else array.array('L', [0]) * width)
+        (lasts, counts, firsts) = state
+        for i in xrange(block - base, min(last + 1 - base, width)):
+            previous = lasts[i]
+            if previous:
+                if previous != seen:
+                    # The blocks of one earlier write share its stamp
+                    seen = previous
+                    index = hdr_index(g, stamp - previous)
+                hist[index] += 1
+            elif firsts != None:
+                firsts[i] = stamp
+            lasts[i] = stamp
+            counts[i] += 1
+        block = base + width
+    g.thread_write_clock += last - first + 1
+    return
+# track_overwrite (DONE)
+
+### Pack this process' overwrite state into the blocks it wrote, in block order:
+### (blocks, last stamps, writes, first stamps or None), or None if it went over its --memory share
+def overwrite_state(g):
+    chunks = g.thread_overwrite_chunks
+    g.thread_overwrite_chunks = {}
+    if chunks == None:
+        return None
+    width = g.overwrite_chunk
+    (blocks, lasts, counts) = (array.array('L'), array.array('L'), array.array('I'))
+    firsts = None if g.thread_segment == g.overwrite_head else array.array('L')
+    for chunk in sorted(chunks):
+        (chunk_lasts, chunk_counts, chunk_firsts) = chunks[chunk]
+        base = chunk * width
+        for i in itertools.compress(xrange(width), chunk_counts):
+            blocks.append(base + i)
+            lasts.append(chunk_lasts[i])
+            counts.append(chunk_counts[i])
+            if firsts != None:
+                firsts.append(chunk_firsts[i])
+    return (blocks, lasts, counts, firsts)
+# overwrite_state (DONE)
+
+### Stitch the per-segment overwrite state together in trace order: the first write of a block
+### in a segment overwrites its last write in the segments before it.  Returns None if a process
+### (or the stitched state) went over its --memory share
+def overwrite_totals(g):
+    hist = [0] * g.hdr_size
+    lasts = {}
+    counts = {}
+    clock = 0
+    width = g.overwrite_chunk
+    for (segment, written, state, part_hist) in sorted(g.overwrite_parts, key=lambda part: part[0]):
+        if state == None:
+            return None
+        for index in xrange(g.hdr_size):
+            hist[index] += part_hist[index]
+        (blocks, part_lasts, part_counts, part_firsts) = state
+        for (j, block) in enumerate(blocks):
+            chunk = block / width
+            i = block - chunk * width
+            if chunk not in lasts:
+                if g.overwrite_max_chunks and len(lasts) >= g.overwrite_max_chunks * g.parse_workers:
+                    return None
+                lasts[chunk] = array.array('L', [0]) * width
+                counts[chunk] = array.array('I', [0]) * width
+            chunk_lasts = lasts[chunk]
+            if chunk_lasts[i] and part_firsts != None:
+                hist[hdr_index(g, clock + part_firsts[j] - chunk_lasts[i])] += 1
+            chunk_lasts[i] = clock + part_lasts[j]
+            counts[chunk][i] += part_counts[j]
+        clock += written
+    # Blocks by write count: {writes: blocks}
+    writes = {}
+    for chunk_counts in counts.itervalues():
+        for count in chunk_counts:
+            if count:
+                writes[count] = writes.get(count, 0) + 1
+    return (clock, hist, writes)
+# overwrite_totals (DONE)
+
+### Print the write working set, overwrite intervals and hot/cold write split
+def print_overwrites(g):
+    g.overwrite_report = None
+    if not g.overwrite_parts:
+        return
+    totals = overwrite_totals(g)
+    if totals == None:
+        print "--------------------------------------------"
+        print "WARNING: the overwrite analysis needs more than its share of --memory, so it was skipped"
+        print "--------------------------------------------"
+        return
+    (written, hist, writes) = totals
+    if written == 0:
+        return
+    block = g.overwrite_block_size
+    working_set = sum(writes.values())
+    overwrites = sum(hist)
+    percentiles = [hdr_percentile(g, hist, percent) for percent in g.percentiles]
+
+    # Hottest blocks covering each heat class' share of block writes, the rest are cold
+    ranked = [(count, writes[count]) for count in sorted(writes, reverse=True)]
+    heat = []
+    running = 0
+    position = 0
+    remaining = ranked[0][1]
+    for (name, percent) in g.heat_classes + [('cold', 100)]:
+        target = written * percent / 100.0
+        blocks = block_writes = 0
+        while position < len(ranked) and running < target:
+            count = ranked[position][0]
+            take = min(remaining, int(math.ceil((target - running) / count)))
+            blocks += take
+            block_writes += take * count
+            running += take * count
+            remaining -= take
+            if remaining == 0:
+                position += 1
+                if position < len(ranked):
+                    remaining = ranked[position][1]
+        heat.append((name, blocks, block_writes))
+    g.overwrite_report = (working_set, written, overwrites, percentiles, heat, writes.get(1, 0))
+
+    print "--------------------------------------------"
+    printf("Write working set: %s in %s blocks (%.2f%% of the device), %s written (%.2fx the working set)\n",
+           size_label(g, working_set * block), size_label(g, block), working_set * block * 100.0 / max(1, g.total_lbas * g.sector_size),
+           size_label(g, written * block), float(written) / working_set)
+    printf("Overwrites: %d of %d block writes (%.2f%%) rewrite a block written earlier in the trace\n", overwrites, written, overwrites * 100.0 / written)
+    if overwrites:
+        line = "%-20s" % "Overwrite interval:"
+        for percent in g.percentiles:
+            line += "%10s" % ("p" + str(percent))
+        print line
+        line = "%-20s" % "  data written"
+        for value in percentiles:
+            line += "%10s" % size_label(g, value * block)
+        print line
+    print "Write heat (hottest blocks by writes):"
+    for (name, blocks, block_writes) in heat:
+        if blocks:
+            printf("  %-6s %6.2f%% of block writes to %s (%.2f%% of the working set)\n", name, block_writes * 100.0 / written,
+                   size_label(g, blocks * block), blocks * 100.0 / working_set)
+    printf("  Written once: %s (%.2f%% of the working set)\n", size_label(g, writes.get(1, 0) * block), writes.get(1, 0) * 100.0 / working_set)
+    print "--------------------------------------------"
+    return
+# print_overwrites (DONE)
+
+### Pick the hottest of the hit buckets covering percent% of bucket hits, or at most limit buckets,
+### without sorting them: returns (threshold, ties) where every bucket above threshold is hot, plus
+### the first ties buckets (in LBA order) that have exactly threshold hits
+def hot_threshold(g, counts, hit, percent, limit):
+    hist = {}
+    for bucket in hit:
+        c = counts[bucket]
+        hist[c] = hist.get(c, 0) + 1
+    target = sum([c * n for (c, n) in hist.iteritems()]) * percent / 100.0
+    running = 0
+    buckets = 0
+    for c in sorted(hist, reverse=True):
+        take = hist[c]
+        if limit and buckets + take > limit:
+            take = limit - buckets
+        if running + c * take >= target:
+            take = min(take, int(math.ceil((target - running) / c)))
+            return (c, take)
+        running += c * take
+        buckets += take
+        if take < hist[c]:
+            return (c, take)
+    return (1, 0)
+# hot_threshold (DONE)
+
+### Merge the hot buckets into contiguous extents: [(first bucket, last bucket, hits)]
+def hot_extents(g, counts, hit, threshold, ties):
+    extents = []
+    for bucket in hit:
+        hits = counts[bucket]
+        if hits < threshold:
+            continue
+        if hits == threshold:
+            if ties == 0:
+                continue
+            ties -= 1
+        if extents and extents[-1][1] == bucket - 1:
+            extents[-1][1] = bucket
+            extents[-1][2] += hits
+        else:
+            extents.append([bucket, bucket, hits])
+    return extents
+# hot_extents (DONE)
+
+### Split device extents (in sectors) at partition boundaries: [(partition or '-', start, length, hits)]
+def partition_extents(g, extents, counts):
+    parts = []
+    entries = [entries for (kind, starts, entries) in g.regions if kind == 'partition']
+    entries = entries[0] if entries else []
+    sectors = g.bucket_size / g.sector_size
+    i = 0
+    for (first, last, hits) in extents:
+        start = first * sectors
+        end = (last + 1) * sectors
+        while start < end:
+            while i < len(entries) and entries[i][1] <= start:
+                i += 1
+            if i < len(entries) and entries[i][0] <= start:
+                (name, offset) = region_lookup(g, entries[i], start)
+                piece = min(end, entries[i][1])
+            else:
+                # Outside every partition: device-relative
+                (name, offset) = ('-', start)
+                piece = min(end, entries[i][0]) if i < len(entries) else end
+            # A bucket split by a boundary counts its hits once, in the piece holding its first sector
+            parts.append((name, offset, piece - start, sum(counts[(start + sectors - 1) / sectors:(piece + sectors - 1) / sectors])))
+            start = piece
+    return parts
+# partition_extents (DONE)
+
+### Write the hottest LBA extents (--hot-extents) for cache pinning and data placement
+def export_hot_extents(g):
+    counts = get_bucket_counts(g)
+    limit = int(g.hot_gib * g.GiB / g.bucket_size)
+    if g.hot_gib and limit == 0:
+        print "ERROR: --hot-gib is smaller than one bucket (" + size_label(g, g.bucket_size) + ")"
+        sys.exit(11)
+    # Buckets that saw I/O, in LBA order, found with one C-level pass over the counts
+    hit = list(itertools.compress(itertools.count(), counts))
+    (threshold, ties) = hot_threshold(g, counts, hit, g.hot_percent, limit)
+    extents = hot_extents(g, counts, hit, threshold, ties)
+    buckets = sum([last - first + 1 for (first, last, hits) in extents])
+    hits = sum([extent[2] for extent in extents])
+    sectors = g.bucket_size / g.sector_size
+    try:
+        fo = open(g.hot_file, "w")
+    except:
+        print "ERROR: Failed to open " + g.hot_file
+        sys.exit(3)
+    fo.write("# ioprof hot extents v1: %s %.2f%% of %d bucket hits in %s, bucket size %d bytes, %s-relative sectors of %d bytes\n" %
+             (g.device_str, hits * 100.0 / max(1, g.bucket_hits_total.value), g.bucket_hits_total.value, size_label(g, buckets * g.bucket_size),
+              g.bucket_size, g.extent_units, g.sector_size))
+    if g.extent_units == 'partition':
+        fo.write("# partition start length hits\n")
+        for extent in partition_extents(g, extents, counts):
+            fo.write("%s %d %d %d\n" % extent)
+    else:
+        fo.write("# start length hits\n")
+        for (first, last, extent_hits) in extents:
+            fo.write("%d %d %d\n" % (first * sectors, (last - first + 1) * sectors, extent_hits))
+    fo.close()
+    printf("Wrote %d hot extents (%s, %.2f%% of bucket hits) to %s\n", len(extents), size_label(g, buckets * g.bucket_size),
+           hits * 100.0 / max(1, g.bucket_hits_total.value), g.hot_file)
+    return
+# export_hot_extents (DONE)
+
+### Load one side of a diff: the JSON record of a post run with --buckets, or a trace tarball
+### (post-processed by a child ioprof run into such a record)
+def load_diff_input(g, name):
+    if name.endswith(".tar"):
+        output = os.path.abspath("diff.%d.%d.json" % (os.getpid(), len(g.cleanup)))
+        g.cleanup.append(output)
+        print "Post-processing " + name + ".  Please wait..."
+        p = subprocess.Popen([sys.executable, os.path.abspath(__file__), "-m", "post", "-t", os.path.basename(name), "--format", "json",
+                              "--buckets", "--output", output], cwd=os.path.dirname(os.path.abspath(name)), stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        out = p.communicate()[0]
+        verbose_print(g, out)
+        if p.returncode != 0 or not os.path.exists(output):
+            print out
+            print "ERROR: Failed to post-process " + name
+            sys.exit(3)
+        path = output
+    else:
+        path = name
+    try:
+        lines = [line for line in open(path, "r") if line.strip()]
+    except:
+        print "ERROR: Failed to open " + path
+        sys.exit(3)
+    try:
+        record = json.loads(lines[-1])
+    except:
+        print "ERROR: " + name + " is not a trace tarball or '--format json' output"
+        sys.exit(11)
+    if record.get("buckets") == None:
+        print "ERROR: " + name + " was written without --buckets, so it can't be compared"
+        sys.exit(11)
+    return record
+# load_diff_input (DONE)
+
+### Distances between the two bucket distributions, in one pass over the buckets either side hit:
+### (total variation, Jensen-Shannon divergence in bits, {range: [before hits, after hits]})
+def diff_distributions(g, before, after, range_buckets):
+    total_before = float(max(1, sum(before.itervalues())))
+    total_after = float(max(1, sum(after.itervalues())))
+    variation = 0.0
+    divergence = 0.0
+    ranges = {}
+    for bucket in set(before) | set(after):
+        hits_before = before.get(bucket, 0)
+        hits_after = after.get(bucket, 0)
+        p = hits_before / total_before
+        q = hits_after / total_after
+        m = (p + q) / 2
+        variation += abs(p - q)
+        if p:
+            divergence += p * math.log(p / m, 2)
+        if q:
+            divergence += q * math.log(q / m, 2)
+        counts = ranges.setdefault(bucket / range_buckets, [0, 0])
+        counts[0] += hits_before
+        counts[1] += hits_after
+    return (variation / 2, divergence / 2, ranges)
+# diff_distributions (DONE)
+
+### Compare two traces or saved post records (-m diff)
+def print_diff(g, before, after):
+    for key in ("bucket_size", "num_buckets", "sector_size"):
+        if before.get(key) != after.get(key):
+            print "ERROR: The inputs have different geometry (%s %s vs %s), only traces of the same device layout can be compared" % (key, before.get(key), after.get(key))
+            sys.exit(11)
+    g.bucket_size = before["bucket_size"]
+    g.num_buckets = before["num_buckets"]
+    g.sector_size = before["sector_size"]
+    buckets = []
+    for record in (before, after):
+        buckets.append(dict([(bucket, reads + writes) for (bucket, reads, writes) in record["buckets"]]))
+    range_buckets = max(1, g.num_buckets / g.diff_ranges)
+    (variation, divergence, ranges) = diff_distributions(g, buckets[0], buckets[1], range_buckets)
+
+    rows = []
+    for (label, values, unit) in (("I/O's", [r["io_total"] for r in (before, after)], "%d"),
+                                  ("Read %", [r["read_total"] * 100.0 / max(1, r["io_total"]) for r in (before, after)], "%.2f"),
+                                  ("GiB transferred", [float(r["total_blocks"]) * g.sector_size / g.GiB for r in (before, after)], "%.2f"),
+                                  ("Bucket hits", [r["bucket_hits_total"] for r in (before, after)], "%d")):
+        rows.append((label, values, unit))
+    hot_sets = [hot_set_buckets(g, counts.values(), g.hot_set_percents) for counts in buckets]
+    for (i, percent) in enumerate(g.hot_set_percents):
+        rows.append(("Hot set %d%% GiB" % percent, [float(sizes[i]) * g.bucket_size / g.GiB for sizes in hot_sets], "%.3f"))
+    thetas = [r["zipf_theta"]["estimate"] if r.get("zipf_theta") else None for r in (before, after)]
+    if None not in thetas:
+        rows.append(("Zipf theta (est.)", thetas, "%.4f"))
+
+    print "--------------------------------------------"
+    print "Before: " + g.diff_inputs[0]
+    print "After:  " + g.diff_inputs[1]
+    print "%-20s %14s %14s %10s" % ("", "before", "after", "change")
+    for (label, (value_before, value_after), unit) in rows:
+        change = "%+.1f%%" % ((value_after - value_before) * 100.0 / value_before) if value_before else "-"
+        print "%-20s %14s %14s %10s" % (label, unit % value_before, unit % value_after, change)
+
+    # I/O size mix
+    mixes = []
+    for record in (before, after):
+        total = float(max(1, sum([entry["reads"] + entry["writes"] for entry in record["size_histogram"]])))
+        mixes.append(dict([(entry["bytes"], (entry["reads"] + entry["writes"]) / total) for entry in record["size_histogram"]]))
+    sizes = sorted(set(mixes[0]) | set(mixes[1]))
+    print "--------------------------------------------"
+    print "I/O size mix:        %14s %14s %10s" % ("before", "after", "change")
+    for size in sizes:
+        (share_before, share_after) = (mixes[0].get(size, 0) * 100, mixes[1].get(size, 0) * 100)
+        print "%-20s %13.2f%% %13.2f%% %+9.2f%%" % (size_label(g, size), share_before, share_after, share_after - share_before)
+    printf("Size mix total variation: %.4f\n", sum([abs(mixes[0].get(size, 0) - mixes[1].get(size, 0)) for size in sizes]) / 2)
+
+    # Where the heat moved
+    print "--------------------------------------------"
+    printf("Bucket distribution: total variation %.4f, Jensen-Shannon divergence %.4f bits (distance %.4f)\n",
+           variation, divergence, math.sqrt(max(0, divergence)))
+    totals = [float(max(1, sum(counts.itervalues()))) for counts in buckets]
+    shares = dict([(key, (hits[0] * 100 / totals[0], hits[1] * 100 / totals[1])) for (key, hits) in ranges.iteritems()])
+    top = heapq.nlargest(g.top_count_limit, shares, key=lambda key: abs(shares[key][1] - shares[key][0]))
+    sectors = range_buckets * g.bucket_size / g.sector_size
+    print "LBA ranges with the largest change in share of bucket hits:"
+    print "%-28s %10s %10s %10s" % ("LBA range", "before", "after", "change")
+    for key in top:
+        (share_before, share_after) = shares[key]
+        print "%-28s %9.2f%% %9.2f%% %+9.2f%%" % ("%d-%d" % (key * sectors, (key + 1) * sectors), share_before, share_after, share_after - share_before)
+
+    files = [dict([(entry["file"], entry["percent"]) for entry in record.get("top_files", [])]) for record in (before, after)]
+    if files[0] or files[1]:
+        names = heapq.nlargest(g.top_count_limit, set(files[0]) | set(files[1]), key=lambda name: abs(files[1].get(name, 0) - files[0].get(name, 0)))
+        print "Top files with the largest change in share of I/O (0 = not in that run's top files):"
+        print "%10s %10s %10s  %s" % ("before", "after", "change", "File")
+        for name in names:
+            (share_before, share_after) = (files[0].get(name, 0), files[1].get(name, 0))
+            print "%9.2f%% %9.2f%% %+9.2f%%  %s" % (share_before, share_after, share_after - share_before, name)
+    print "--------------------------------------------"
+    return
+# print_diff (DONE)
+
+### Generalized harmonic numbers H(n, theta) are summed exactly for the first harmonic_terms terms, then the
+### Euler-Maclaurin integral estimates the tail, so device-sized n stays cheap: H(n) - H(exact)
+def harmonic_tail(g, exact, n, theta):
+    if n <= exact:
+        return 0.0
+    a = exact + 0.5
+    b = n + 0.5
+    if abs(theta - 1) < 1e-9:
+        return math.log(b / a)
+    return (b ** (1 - theta) - a ** (1 - theta)) / (1 - theta)
+# harmonic_tail (DONE)
+
+### Partial sums H(1, theta) .. H(n, theta) of the exact part of a harmonic number, for bisecting over
+def harmonic_sums(g, n, theta):
+    sums = array.array('d', [0.0]) * min(n, g.harmonic_terms)
+    running = 0.0
+    for i in xrange(len(sums)):
+        running += (i + 1) ** -theta
+        sums[i] = running
+    return sums
+# harmonic_sums (DONE)
+
+### Integer percentages of a {value: count} mix that add up to 100, largest first: [(value, percent)]
+def percent_split(g, counts):
+    total = sum(counts.itervalues())
+    if total == 0:
+        return []
+    split = [[value, counts[value] * 100 / total] for value in sorted(counts, key=lambda value: -counts[value])]
+    split[0][1] += 100 - sum([percent for (value, percent) in split])
+    return [(value, percent) for (value, percent) in split if percent > 0]
+# percent_split (DONE)
+
+### Fit a compact workload model to the aggregates of this run
+def fit_workload(g):
+    model = {}
+    ios = g.io_total.value
+    model['ios'] = ios
+    model['read_percent'] = g.read_total.value * 100.0 / ios
+    # I/O size mix in bytes, per direction
+    for (rw, totals) in (('read', dict(g.r_totals)), ('write', dict(g.w_totals))):
+        mix = {}
+        for (size, count) in totals.iteritems():
+            mix[int(size) * g.sector_size] = mix.get(int(size) * g.sector_size, 0) + count
+        model[rw + '_sizes'] = mix
+        model[rw + '_bssplit'] = percent_split(g, mix)
+    stats = dict(g.stream_stats)
+    model['sequential_percent'] = {}
+    for (rw, name) in (('R', 'read'), ('W', 'write')):
+        if stats.get((rw, 'ios', 0)):
+            model['sequential_percent'][name] = stats.get((rw, 'seq', 0), 0) * 100.0 / stats[(rw, 'ios', 0)]
+    model['theta'] = g.zipf_theta[2] if g.zipf_theta != None else None
+    counts = [reads + writes for (bucket, reads, writes) in bucket_totals(g) if reads + writes]
+    model['hot_sets'] = hot_set_buckets(g, counts, g.hot_set_percents)
+    seconds = g.trace_seconds
+    if seconds == 0 and g.burst_report != None:
+        # Traces without metadata: the 1 second windows of a timestamped trace give the duration
+        for (resolution, mean_iops, iops, peak_iops, ratio, mean_mib, mib, peak_mib) in g.burst_report[0]:
+            if resolution == 1.0 and mean_iops:
+                seconds = ios / mean_iops
+    model['seconds'] = seconds
+    model['iops'] = ios / float(seconds) if seconds else None
+    model['queue_depth'] = None
+    if g.burst_report != None and g.burst_report[1] != None:
+        model['queue_depth'] = max(1, int(math.ceil(g.burst_report[1][1][-1])))
+
+    # How closely a zipf(theta) workload over the device's buckets reproduces the bucket histogram:
+    # total variation between the rank-frequency curves, and the model's hot-set sizes
+    model['fit'] = None
+    if model['theta'] != None and counts:
+        theta = model['theta']
+        total = float(sum(counts))
+        sums = harmonic_sums(g, g.num_buckets, theta)
+        exact = len(sums)
+        norm = sums[-1] + harmonic_tail(g, exact, g.num_buckets, theta)
+        variation = 0.0
+        running = 0.0
+        for (rank, count) in enumerate(sorted(counts, reverse=True), 1):
+            share = rank ** -theta / norm
+            running += share
+            variation += abs(count / total - share)
+        variation += 1 - running # The model's buckets beyond the ones that saw I/O
+        model_hot_sets = []
+        for percent in g.hot_set_percents:
+            # Smallest k with H(k) / H(N) >= percent: a lookup in the partial sums, else bisection over the integral tail
+            target = norm * percent / 100.0
+            if target <= sums[-1]:
+                model_hot_sets.append(bisect.bisect_left(sums, target) + 1)
+                continue
+            (low, high) = (exact + 1, g.num_buckets)
+            while low < high:
+                middle = (low + high) / 2
+                if sums[-1] + harmonic_tail(g, exact, middle, theta) >= target:
+                    high = middle
+                else:
+                    low = middle + 1
+            model_hot_sets.append(low)
+        model['fit'] = (variation / 2, model_hot_sets)
+    return model
+# fit_workload (DONE)
+
+### Write an fio job file that reproduces the fitted workload model
+def write_fio_job(g, model):
+    try:
+        fo = open(g.fio_job_file, "w")
+    except:
+        print "ERROR: Failed to open " + g.fio_job_file
+        sys.exit(3)
+    size_split = lambda split: ":".join(["%d/%d" % (size, percent) for (size, percent) in split])
+    fo.write("# Synthetic workload fitted by ioprof %s to %s\n" % (g.version, g.tarfile or g.store))
+    fo.write("# %d I/O's, %.1f%% reads, zipf theta %s, hot set %s\n" % (model['ios'], model['read_percent'],
+             "%.4f" % model['theta'] if model['theta'] != None else "unknown",
+             ", ".join(["%d%% in %s" % (percent, size_label(g, count * g.bucket_size)) for (percent, count) in zip(g.hot_set_percents, model['hot_sets'])])))
+    fo.write("[global]\nioengine=libaio\ndirect=1\nrandrepeat=0\ngroup_reporting\n")
+    fo.write("\n[%s]\n" % (g.device_str or "workload"))
+    fo.write("filename=%s\n" % (g.device or "/dev/" + g.device_str))
+    fo.write("rw=randrw\nrwmixread=%d\n" % round(model['read_percent']))
+    fo.write("bssplit=%s,%s\n" % (size_split(model['read_bssplit']) or "4k/100", size_split(model['write_bssplit']) or "4k/100"))
+    if model['theta'] != None:
+        # fio needs theta > 0 and != 1
+        theta = max(0.0001, model['theta'])
+        if abs(theta - 1) < 0.0001:
+            theta = 1.0001
+        fo.write("random_distribution=zipf:%.4f\n" % theta)
+    if model['sequential_percent']:
+        fo.write("percentage_random=%d,%d\n" % tuple([100 - round(model['sequential_percent'].get(name, 0)) for name in ('read', 'write')]))
+    if model['iops'] != None:
+        fo.write("rate_iops=%d,%d\n" % (max(1, round(model['iops'] * model['read_percent'] / 100)), max(1, round(model['iops'] * (100 - model['read_percent']) / 100))))
+        fo.write("runtime=%d\ntime_based\n" % max(1, round(model['seconds'])))
+    else:
+        fo.write("# The capture time is unknown (trace without metadata or timestamps), so the rate isn't limited\nruntime=60\ntime_based\n")
+    if model['queue_depth'] != None:
+        fo.write("iodepth=%d\n" % model['queue_depth'])
+    else:
+        fo.write("# Queue depth needs a --latency trace\niodepth=1\n")
+    fo.close()
+    return
+# write_fio_job (DONE)
+
+### Print the fitted workload model and how closely it reproduces this run, and write its fio job (--fio-job)
+def print_model(g):
+    g.model_report = None
+    if g.io_total.value == 0:
+        return
+    model = fit_workload(g)
+    write_fio_job(g, model)
+    mix_variation = lambda sizes, split: sum([abs(sizes.get(size, 0) * 1.0 / max(1, sum(sizes.values())) - percent / 100.0)
+                                              for (size, percent) in split + [(size, 0) for size in sizes if size not in dict(split)]]) / 2
+    model['bssplit_variation'] = (mix_variation(model['read_sizes'], model['read_bssplit']), mix_variation(model['write_sizes'], model['write_bssplit']))
+    g.model_report = model
+    print "--------------------------------------------"
+    print "Workload model (written to " + g.fio_job_file + "):"
+    printf("  Reads: %.1f%%, zipf theta: %s, arrival rate: %s\n", model['read_percent'], "%.4f" % model['theta'] if model['theta'] != None else "unknown",
+           "%.3g IOPS" % model['iops'] if model['iops'] != None else "unknown")
+    for rw in ('read', 'write'):
+        if model[rw + '_bssplit']:
+            sequential = " (%.1f%% sequential)" % model['sequential_percent'][rw] if rw in model['sequential_percent'] else ""
+            print "  %s sizes: %s%s" % (rw.capitalize(), ", ".join(["%s %d%%" % (size_label(g, size), percent) for (size, percent) in model[rw + '_bssplit']]), sequential)
+    if model['fit'] != None:
+        (variation, model_hot_sets) = model['fit']
+        print "  Fit: bucket rank-frequency total variation %.4f (0 = identical, 1 = disjoint)" % variation
+        for (percent, actual, fitted) in zip(g.hot_set_percents, model['hot_sets'], model_hot_sets):
+            print "    Hot set %d%%: %s traced, %s modelled" % (percent, size_label(g, actual * g.bucket_size), size_label(g, fitted * g.bucket_size))
+    printf("  Size mix rounding total variation: read %.4f, write %.4f\n", model['bssplit_variation'][0], model['bssplit_variation'][1])
+    print "--------------------------------------------"
+    return
+# print_model (DONE)
+
+### Stream the queue events of a trace tarball in trace order, straight from its compressed members:
+### yields (seconds since the start of the trace, rw, lba, size).  blktrace restarts its clock every
+### capture interval, so each trace continues where the previous one ended
+def trace_events(g, tar):
+    members = [member for member in tar.getmembers() if re.match("blk\.out\..+\.blkparse\.gz$", member.name)]
+    pattern = re.compile('\s*(?:(\d+\.\d+)\s+)?(?:\d+\s+.+?\s+)?(\S+)\s+Q\s+(\d+)\s+(\d+)$')
+    offset = 0.0
+    for member in sorted(members, key=lambda member: trace_number(g, member.name)):
+        last = 0.0
+        for line in gzip.GzipFile(fileobj=tar.extractfile(member)):
+            match = pattern.match(line)
+            if match == None:
+                continue
+            (timestamp, rw, lba, size) = match.groups()
+            if timestamp != None:
+                last = float(timestamp)
+            yield (offset + last, rw, int(lba), int(size))
+        offset += last
+    return
+# trace_events (DONE)
+
+### Convert the queue events of a trace tarball into a fio iolog (--fio-iolog), for replay with read_iolog=
+def export_iolog(g):
+    try:
+        tar = tarfile.open(g.tarfile, "r")
+    except:
+        print "ERROR: Failed to open " + g.tarfile
+        sys.exit(9)
+    names = tar.getnames()
+    # Only the small geometry member is unpacked, the traces are streamed
+    if g.meta_file in names:
+        tar.extract(g.meta_file)
+        g.cleanup.append(g.meta_file)
+        read_metadata(g, g.meta_file)
+    elif g.fdisk_file in names:
+        tar.extract(g.fdisk_file)
+        parse_fdisk(g, open(g.fdisk_file, "r").read())
+    else:
+        print "ERROR: " + g.tarfile + " has no " + g.meta_file + " or " + g.fdisk_file + " member"
+        sys.exit(9)
+    device = g.iolog_device or g.device
+    source_bytes = g.total_lbas * g.sector_size
+    target_bytes = int(g.iolog_remap_gib * g.GiB) or source_bytes
+    try:
+        fo = open(g.iolog_file, "w")
+    except:
+        print "ERROR: Failed to open " + g.iolog_file
+        sys.exit(3)
+    print "Writing fio iolog v%d of %s to %s" % (g.iolog_version, g.tarfile, g.iolog_file)
+    # v3 puts a timestamp (nsec) in front of every line, v2 has 'wait' actions (usec since the last wait)
+    stamp = lambda seconds: "%d " % round(seconds * 1e9) if g.iolog_version == 3 else ""
+    fo.write("fio version %d iolog\n" % g.iolog_version)
+    fo.write(stamp(0) + device + " add\n")
+    fo.write(stamp(0) + device + " open\n")
+    actions = {'R': "read", 'W': "write", 'D': "trim"}
+    count = 0
+    skipped = 0
+    start = None
+    waited = 0.0
+    now = 0.0
+    for (timestamp, rw, lba, size) in trace_events(g, tar):
+        if start == None:
+            start = timestamp
+        action = actions.get(rw[0])
+        if action == None or size == 0 or (g.iolog_rw != 'all' and action != g.iolog_rw):
+            skipped += 1
+            continue
+        now = (timestamp - start) * g.iolog_time_scale
+        offset = lba * g.sector_size
+        length = size * g.sector_size
+        if target_bytes != source_bytes:
+            # Keep the relative position on a differently sized device, 4 KiB aligned
+            offset = min(offset * target_bytes / source_bytes, max(0, target_bytes - length)) / 4096 * 4096
+        if g.iolog_version == 2 and now - waited >= 0.0001:
+            # fio only parses four field actions, a wait's microseconds go in the offset slot
+            fo.write("%s wait %d 0\n" % (device, round((now - waited) * 1e6)))
+            waited = now
+        fo.write("%s%s %s %d %d\n" % (stamp(now), device, action, offset, length))
+        count += 1
+        if count % 1000000 == 0:
+            printf("\rExported %d I/O's", count)
+            sys.stdout.flush()
+    fo.write(stamp(now) + device + " close\n")
+    fo.close()
+    tar.close()
+    printf("\rExported %d I/O's (%d filtered out) over %.3f seconds to %s\n", count, skipped, now, g.iolog_file)
+    print "Replay with: fio --name=replay --ioengine=libaio --direct=1 --read_iolog=" + g.iolog_file
+    return
+# export_iolog (DONE)
+
+### Parse --lba-range start:end (sectors, end exclusive)
+def parse_lba_range(g, text):
+    match = re.match("^(\d+):(\d+)$", text)
+    if match == None or int(match.group(1)) >= int(match.group(2)):
+        print "ERROR: --lba-range must be <start>:<end> in sectors, with start < end"
+        sys.exit(11)
+    return (int(match.group(1)), int(match.group(2)))
+# parse_lba_range (DONE)
+
+### Sort and merge the regions of interest, and size their fine buckets
+def setup_roi(g):
+    ranges = []
+    for (start, end) in sorted(g.roi_ranges):
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(end, ranges[-1][1]))
+        else:
+            ranges.append((start, end))
+    g.roi_ranges = ranges
+    g.roi_starts = [start for (start, end) in ranges]
+    g.roi_min = ranges[0][0]
+    g.roi_max = ranges[-1][1]
+    g.roi_buckets = [((end - start) * g.sector_size + g.roi_bucket_size - 1) / g.roi_bucket_size for (start, end) in ranges]
+    if sum(g.roi_buckets) > g.roi_buckets_max:
+        print "ERROR: --lba-range covers %d buckets of %s, the limit is %d.  Use a narrower range or a larger --roi-bucket" % (sum(g.roi_buckets), size_label(g, g.roi_bucket_size), g.roi_buckets_max)
+        sys.exit(11)
+    verbose_print(g, "regions of interest: %s in %d buckets of %s", ranges, sum(g.roi_buckets), size_label(g, g.roi_bucket_size))
+    return
+# setup_roi (DONE)
+
+### Count an I/O that overlaps the regions of interest in their fine buckets
+def roi_hit(g, rw, lba, size):
+    if g.thread_roi == None:
+        # Per-range read and write counters of the touched fine buckets, allocated by the first I/O in a region of interest
+        g.thread_roi = [({}, {}) for n in g.roi_buckets]
+    write = 0 if rw in ('R', 'RW') else 1
+    i = max(0, bisect.bisect_right(g.roi_starts, lba) - 1)
+    while i < len(g.roi_ranges) and g.roi_ranges[i][0] < lba + size:
+        (start, end) = g.roi_ranges[i]
+        first = max(lba, start)
+        last = min(lba + size, end)
+        if first < last:
+            counts = g.thread_roi[i][write]
+            for bucket in xrange(((first - start) * g.sector_size) / g.roi_bucket_size, ((last - start) * g.sector_size - 1) / g.roi_bucket_size + 1):
+                counts[bucket] = counts.get(bucket, 0) + 1
+        i += 1
+    return
+# roi_hit (DONE)
+
+### Merge the region of interest counters of all workers: [(reads dict, writes dict)] of touched buckets per range
+def roi_totals(g):
+    totals = [({}, {}) for n in g.roi_buckets]
+    for part in g.roi_parts:
+        for (total, counts) in zip(totals, part):
+            for rw in (0, 1):
+                merged = total[rw]
+                for (bucket, hits) in counts[rw].iteritems():
+                    merged[bucket] = merged.get(bucket, 0) + hits
+    return totals
+# roi_totals (DONE)
+
+### Print the stats and a zoomed heatmap of each region of interest
+def print_roi(g):
+    g.roi_report = []
+    if not g.roi_ranges:
+        return
+    for ((start, end), (reads, writes), n) in zip(g.roi_ranges, roi_totals(g), g.roi_buckets):
+        counts = dict(reads)
+        for (bucket, hits) in writes.iteritems():
+            counts[bucket] = counts.get(bucket, 0) + hits
+        hits = sum(counts.itervalues())
+        hot_sets = hot_set_buckets(g, counts.itervalues(), g.hot_set_percents)
+        histogram = {0: n - len(counts)}
+        for c in counts.itervalues():
+            histogram[c] = histogram.get(c, 0) + 1
+        theta = zipf_theta(g, histogram) if hits else None
+        hottest = sorted(counts, key=lambda bucket: (-counts[bucket], bucket))[:g.top_count_limit]
+        g.roi_report.append((start, end, reads, writes, hot_sets, theta))
+
+        print "--------------------------------------------"
+        printf("Region of interest: LBA %d-%d (%s) in %d buckets of %s\n", start, end, size_label(g, (end - start) * g.sector_size), n, size_label(g, g.roi_bucket_size))
+        printf("Bucket hits: %d (reads %d, writes %d)\n", hits, sum(reads.itervalues()), sum(writes.itervalues()))
+        if hits == 0:
+            continue
+        print "Hot set: " + ", ".join(["%d%% in %s" % (percent, size_label(g, count * g.roi_bucket_size)) for (percent, count) in zip(g.hot_set_percents, hot_sets)])
+        printf("Approximate Zipfian Theta Range: %0.4f-%0.4f (est. %0.4f).\n", theta[0], theta[1], theta[2])
+        print "Hottest buckets: " + ", ".join(["LBA %d (%d)" % (start + bucket * g.roi_bucket_size / g.sector_size, counts[bucket]) for bucket in hottest])
+        draw_heatmap_cells(g, [(bucket, reads.get(bucket, 0), writes.get(bucket, 0)) for bucket in counts], n, g.roi_bucket_size,
+                           "Heatmap of LBA %d-%d" % (start, end))
+    print "--------------------------------------------"
+    return
+# print_roi (DONE)
+
+### Parse blkparse output lines (Q events) into the thread-local counters
+def parse_lines(g, lines):
+    hit_count = 0
+    batch = []
+    pattern = re.compile('(\S+)\s+Q\s+(\S+)\s+(\S+)$')
+    for line in lines:
+        match = pattern.search(line)
+        if match != None:
+            hit_count += 1
+            try:
+                parse_me(g, match.group(1), int(match.group(2)), int(match.group(3)))
+            except:
+                pass
+            if g.roi_ranges and match.group(1) in ('R', 'RW', 'W', 'WS'):
+                lba = int(match.group(2))
+                if lba < g.roi_max and lba + int(match.group(3)) > g.roi_min:
+                    roi_hit(g, match.group(1), lba, int(match.group(3)))
+            if g.overwrite and match.group(1) in ('W', 'WS') and int(match.group(3)) > 0:
+                track_overwrite(g, int(match.group(2)), int(match.group(3)))
+            if g.regions and match.group(1) in ('R', 'RW', 'W', 'WS'):
+                batch.append((match.group(1), int(match.group(2)), int(match.group(3))))
+                if len(batch) >= g.region_batch:
+                    attribute_batch(g, batch)
+                    batch = []
+            if g.spill_entries and hit_count % 4096 == 0 and len(g.thread_reads) + len(g.thread_writes) > g.spill_entries:
+                spill_buckets(g)
+    if batch:
+        attribute_batch(g, batch)
+    return hit_count
+# parse_lines (DONE)
+
+### Compress lines into one gzip member
+def write_trace_block(g, fo, lines):
+    data = "".join(lines)
+    compressor = zlib.compressobj(g.trace_block_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    member = compressor.compress(data) + compressor.flush()
+    fo.write(member)
+    return (len(member), len(data))
+# write_trace_block (DONE)
+
+### Write blkparse output as independently decompressible gzip members of ~trace_block_size
+### bytes each, plus a <file>.idx offset index.  The members concatenate into a valid .gz file,
+### so gunzip (and thread_parse) can still read it as a single stream
+def write_block_trace(g, source, filename):
+    try:
+        fo = open(filename, "wb")
+    except:
+        print "ERROR: Failed to open " + filename
+        sys.exit(3)
+    index = []
+    offset = 0
+    lines = []
+    size = 0
+    for line in source:
+        lines.append(line)
+        size += len(line)
+        if size >= g.trace_block_size:
+            (compressed, uncompressed) = write_trace_block(g, fo, lines)
+            index.append((offset, compressed, uncompressed, len(lines)))
+            offset += compressed
+            lines = []
+            size = 0
+    if lines or not index:
+        (compressed, uncompressed) = write_trace_block(g, fo, lines)
+        index.append((offset, compressed, uncompressed, len(lines)))
+    fo.close()
+
+    fo = open(filename + ".idx", "w")
+    fo.write("# ioprof block index v1: offset compressed_bytes uncompressed_bytes lines\n")
+    for entry in index:
+        fo.write("%d %d %d %d\n" % entry)
+    fo.close()
+    return index
+# write_block_trace (DONE)
+
+### Read the offset index of a block-compressed trace (None for a single-stream trace)
+def read_block_index(g, filename):
+    if not os.path.exists(filename + ".idx"):
+        return None
+    index = []
+    fo = open(filename + ".idx", "r")
+    for line in fo:
+        fields = line.split()
+        if len(fields) == 4 and not line.startswith("#"):
+            index.append(tuple([int(field) for field in fields]))
+    fo.close()
+    return index
+# read_block_index (DONE)
+
+### Decompress one gzip member of a block-compressed trace
+def read_trace_block(g, fo, entry):
+    fo.seek(entry[0])
+    return zlib.decompress(fo.read(entry[1]), 16 + zlib.MAX_WBITS)
+# read_trace_block (DONE)
+
+### Decompress just the first line of one gzip member of a block-compressed trace
+def read_trace_line(g, fo, entry):
+    fo.seek(entry[0])
+    inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    text = ""
+    remaining = entry[1]
+    while remaining > 0 and "\n" not in text:
+        data = fo.read(min(remaining, 65536))
+        if data == "":
+            break
+        remaining -= len(data)
+        text += inflate.decompress(data)
+    return text.split("\n", 1)[0]
+# read_trace_line (DONE)
+
+### Split a block index into contiguous runs of members with about the same number of bytes
+def split_blocks(g, index, workers):
+    total = sum([entry[2] for entry in index])
+    runs = [[]]
+    running = 0
+    for entry in index:
+        if runs[-1] and len(runs) < workers and running >= total * len(runs) / workers:
+            runs.append([])
+        runs[-1].append(entry)
+        running += entry[2]
+    return runs
+# split_blocks (DONE)
+
+### Thread parse routine for a byte range (a run of gzip members) of a block-compressed trace
+def thread_parse_range(g, file, blocks, num):
+    debug_print(g, "\nSTART: %s %d (%d blocks at offset %d)\n", file, num, len(blocks), blocks[0][0])
+    try:
+        fo = open(file, "rb")
+    except:
+        print "ERROR: Failed to open " + file
+        sys.exit(3)
+    hit_count = 0
+    g.thread_segment = (trace_number(g, file), blocks[0][0])
+    g.thread_stream_head = {'R': [], 'W': []}
+    g.thread_head_runs = {'R': {}, 'W': {}}
+    g.thread_head_state = {'R': 'open', 'W': 'open'}
+    if blocks[0][0] == 0:
+        # The first range has nothing to stitch onto: only its open streams are shipped
+        g.thread_head_state = {'R': 'full', 'W': 'full'}
+    for entry in blocks:
+        hit_count += parse_lines(g, read_trace_block(g, fo, entry).splitlines())
+    fo.close()
+    phase_mark(g, 'parse', hit_count, True)
+    total_thread_counts(g, num)
+    phase_mark(g, 'merge', hit_count, True)
+    debug_print(g, "\n FINISH %s [hit_count=%d]\n", file, hit_count)
+    return
+# thread_parse_range (DONE)
+
+### Capture interval number of a blk.out.<dev>.<N>.blkparse trace, for ordering it in time
+def trace_number(g, file):
+    match = re.search("\.(\d+)\.blkparse", file)
+    if match == None:
+        return 0
+    return int(match.group(1))
+# trace_number (DONE)
+
+### Thread parse routine for blktrace output
+def thread_parse(g, file, num):
+    #print "thread_parse\n"
+    linecount = 0
+    os.system("gunzip " + file + ".gz")
+    debug_print(g, "\nSTART: " +  file + " " + str(num) + "\n")
+    try:
+        fo = open(file, "r")
+    except:
+        print "ERROR: Failed to open " + file
+        sys.exit(3)
+    else:
+        # Traces with extra fields (--latency, --procs) are kept for the detail pass
+        detail = len(fo.readline().split()) > 4
+        fo.seek(0)
+        g.thread_segment = (trace_number(g, file), 0)
+        hit_count = parse_lines(g, fo)
+        fo.close()
+        phase_mark(g, 'parse', hit_count, True)
+        total_thread_counts(g, num)
+        phase_mark(g, 'merge', hit_count, True)
+        debug_print(g, "\n FINISH %s [hit_count=%d]%d\n", file, hit_count, g.thread_io_total)
+        if detail:
+            g.detail_trace.value = 1
+        else:
+            rc = os.system("rm -f " + file)
+    return
+
+# thread_parse (DONE)
+
+### Signed power-of-two class of an LBA distance, in bytes
+def stride_class(g, sectors):
+    if sectors == 0:
+        return 0
+    size_class = io_size_class(g, abs(sectors))
+    if sectors < 0:
+        return -size_class
+    return size_class
+# stride_class (DONE)
+
+### Classify an I/O as sequential or random against the interleaved streams.  In the head of a byte
+### range (until its stream table fills) streams the range before it left open may still be continued,
+### so the I/O's are recorded, and the strides and runs of the new streams are left to stream_totals()
+def track_stream(g, rw, lba, size):
+    streams = g.thread_streams[rw]
+    stats = g.thread_stream_stats
+    head = g.thread_stream_head[rw] if g.thread_stream_head != None and g.thread_head_state[rw] == 'open' else None
+    key = (rw, 'ios', 0)
+    stats[key] = stats.get(key, 0) + 1
+    run = streams.pop(lba, None)
+    tag = None
+    if run != None:
+        # Continues a stream where it left off
+        run[0] += 1
+        run[1] += size
+        key = (rw, 'seq', 0)
+        stats[key] = stats.get(key, 0) + 1
+    elif head != None:
+        tag = len(head)
+        run = [1, size, tag]
+    else:
+        run = [1, size]
+        key = (rw, 'stride', stride_class(g, lba - g.thread_last_lba[rw]))
+        stats[key] = stats.get(key, 0) + 1
+        if len(streams) >= g.stream_max:
+            end_run(g, rw, streams.popitem(last=False)[1])
+    if head != None:
+        head.append((tag, lba, lba + size, len(streams), g.thread_last_lba[rw]))
+    displaced = streams.pop(lba + size, None)
+    if displaced != None:
+        end_run(g, rw, displaced)
+    streams[lba + size] = run
+    g.thread_last_lba[rw] = lba + size
+    if head != None:
+        if len(streams) >= g.stream_max:
+            # A full table holds no stream from before this range any more
+            g.thread_head_state[rw] = 'full'
+        elif len(head) >= g.stream_head_max:
+            g.thread_head_state[rw] = 'cut'
+    return
+# track_stream (DONE)
+
+### Power-of-two class of a run length in I/O's (1, 2, 4, 8, ...)
+def run_length_class(g, ios):
+    if ios <= 1:
+        return 1
+    return 1 << (ios - 1).bit_length()
+# run_length_class (DONE)
+
+### Add a finished sequential run to stream counters
+def run_stats(g, stats, rw, run):
+    key = (rw, 'run', run_length_class(g, run[0]))
+    stats[key] = stats.get(key, 0) + 1
+    key = (rw, 'run_sectors', 0)
+    stats[key] = stats.get(key, 0) + run[1]
+    return
+# run_stats (DONE)
+
+### Record the length of a finished sequential run (runs opened in a byte range's head wait for stitching)
+def end_run(g, rw, run):
+    if len(run) > 2:
+        g.thread_head_runs[rw][run[2]] = (run[0], run[1])
+        return
+    run_stats(g, g.thread_stream_stats, rw, run)
+    return
+# end_run (DONE)
+
+### Close out all open streams (end of input)
+def flush_streams(g):
+    for rw, streams in g.thread_streams.iteritems():
+        for run in streams.itervalues():
+            end_run(g, rw, run)
+        streams.clear()
+        g.thread_last_lba[rw] = -1
+    return
+# flush_streams (DONE)
+
+### Stitch the byte ranges of each split trace together in order: replay each range's head against
+### the streams the ranges before it left open, as a single parse of the trace would have seen them
+def stream_totals(g):
+    stats = {}
+    traces = {}
+    for part in g.stream_parts:
+        traces.setdefault(part[0][0], []).append(part)
+    for trace in traces.itervalues():
+        opened = {'R': collections.OrderedDict(), 'W': collections.OrderedDict()}
+        last_lba = {'R': -1, 'W': -1}
+        for (segment, heads, states, head_runs, tails, lasts) in sorted(trace, key=lambda part: part[0]):
+            for rw in ('R', 'W'):
+                older = opened[rw]
+                continued = {}
+                for (tag, lba, end, streams, last) in heads[rw]:
+                    if tag != None:
+                        run = older.pop(lba, None)
+                        if run != None:
+                            continued[tag] = run
+                            stats[(rw, 'seq', 0)] = stats.get((rw, 'seq', 0), 0) + 1
+                        else:
+                            key = (rw, 'stride', stride_class(g, lba - (last if last != -1 else last_lba[rw])))
+                            stats[key] = stats.get(key, 0) + 1
+                            if older and len(older) + streams >= g.stream_max:
+                                run_stats(g, stats, rw, older.popitem(last=False)[1])
+                    displaced = older.pop(end, None)
+                    if displaced != None:
+                        run_stats(g, stats, rw, displaced)
+                if states[rw] != 'open':
+                    # The range's stream table filled, so nothing older is open.  A head cut short at
+                    # stream_head_max I/O's ends the older streams here, which a single parse may not have
+                    for run in older.itervalues():
+                        run_stats(g, stats, rw, run)
+                    older.clear()
+                for (tag, run) in head_runs.get(rw, {}).iteritems():
+                    extra = continued.get(tag, [0, 0])
+                    run_stats(g, stats, rw, [run[0] + extra[0], run[1] + extra[1]])
+                for (key, run) in tails[rw]:
+                    extra = continued.get(run[2], [0, 0]) if len(run) > 2 else [0, 0]
+                    older[key] = [run[0] + extra[0], run[1] + extra[1]]
+                if lasts[rw] != -1:
+                    last_lba[rw] = lasts[rw]
+        for (rw, older) in opened.iteritems():
+            for run in older.itervalues():
+                run_stats(g, stats, rw, run)
+    for (key, value) in stats.iteritems():
+        g.stream_stats[key] = g.stream_stats.get(key, 0) + value
+    del g.stream_parts[:]
+    return
+# stream_totals (DONE)
+
+### Print sequential vs random statistics
+def print_streams(g):
+    if len(g.stream_parts):
+        stream_totals(g)
+    stats = dict(g.stream_stats)
+    if len(stats) == 0:
+        return
+    print "--------------------------------------------"
+    print "Sequential I/O:"
+    for (rw, name) in (('R', "READ"), ('W', "WRITE")):
+        ios = stats.get((rw, 'ios', 0), 0)
+        if ios == 0:
+            continue
+        seq = stats.get((rw, 'seq', 0), 0)
+        runs = dict([(k[2], v) for (k, v) in stats.iteritems() if k[0] == rw and k[1] == 'run'])
+        strides = dict([(k[2], v) for (k, v) in stats.iteritems() if k[0] == rw and k[1] == 'stride'])
+        run_count = sum(runs.values())
+        print "%s: %0.2f%% sequential (%d of %d I/O's), %d runs, avg run %0.1f I/O's (%0.1f KiB)" % (name, seq * 100.0 / ios, seq, ios,
+            run_count, float(ios) / run_count if run_count else 0, float(stats.get((rw, 'run_sectors', 0), 0)) * g.sector_size / g.KiB / run_count if run_count else 0)
+        line = "  Run length (I/O's):"
+        for length in sorted(runs):
+            label = str(length) if length <= 2 else "%d-%d" % (length / 2 + 1, length)
+            line += " %s: %0.1f%%" % (label, runs[length] * 100.0 / run_count)
+        print line
+        line = "  Top strides:"
+        for stride in sorted(strides, reverse=True, key=strides.get)[:8]:
+            label = "0" if stride == 0 else ("+" if stride > 0 else "") + size_label(g, stride)
+            line += " %s: %0.1f%%" % (label, strides[stride] * 100.0 / ios)
+        print line
+    print "--------------------------------------------"
+    return
+# print_streams (DONE)
+
+### Parse blktrace output
+def parse_me(g, rw, lba, size):
+    if g.debug:
+        debug_print(g, "rw=%s lba=%d size=%d", rw, lba, size)
+    if (rw == 'R') or (rw == 'RW'):
+        # Read
         g.thread_total_blocks += int(size)
         g.thread_io_total += 1
         g.thread_read_total += 1
@@ -1041,6 +3519,7 @@ def parse_me(g, rw, lba, size):
             g.thread_r_totals[size] += 1
         else:
             g.thread_r_totals[size] = 1
+        track_stream(g, 'R', lba, size)
         bucket_hits = (size * g.sector_size) / g.bucket_size
         if ((size * g.sector_size) % g.bucket_size) != 0:
             bucket_hits += 1
@@ -1071,6 +3550,7 @@ def parse_me(g, rw, lba, size):
             g.thread_w_totals[size] += 1
         else:
             g.thread_w_totals[size] = 1
+        track_stream(g, 'W', lba, size)
         bucket_hits = (size * g.sector_size) / g.bucket_size
         if ((size * g.sector_size) % g.bucket_size) != 0:
             bucket_hits += 1
@@ -1095,6 +3575,500 @@ def parse_me(g, rw, lba, size):
     return
 # parse_me (DONE)
 
+### Map a value to its log-bucketed (HDR-style) histogram index
+def hdr_index(g, value):
+    value = int(value)
+    if value < 0:
+        value = 0
+    exp = value.bit_length() - g.hdr_sub_bits
+    if exp <= 0:
+        return value
+    index = (exp << (g.hdr_sub_bits - 1)) + (value >> exp)
+    if index >= g.hdr_size:
+        index = g.hdr_size - 1
+    return index
+# hdr_index (DONE)
+
+### Largest value that maps to an HDR histogram index
+def hdr_value(g, index):
+    half = 1 << (g.hdr_sub_bits - 1)
+    if index < (half * 2):
+        return index
+    exp = (index / half) - 1
+    return ((index - (exp * half) + 1) << exp) - 1
+# hdr_value (DONE)
+
+### Get a percentile from an HDR histogram (exact to the bucket)
+def hdr_percentile(g, hist, percent):
+    total = sum(hist)
+    if total == 0:
+        return 0
+    target = int(math.ceil(total * percent / 100.0))
+    count = 0
+    for index in xrange(len(hist)):
+        count += hist[index]
+        if count >= target:
+            return hdr_value(g, index)
+    return hdr_value(g, len(hist) - 1)
+# hdr_percentile (DONE)
+
+### Round an I/O size (sectors) up to a power-of-two byte class
+def io_size_class(g, size):
+    size_bytes = int(size) * g.sector_size
+    if size_bytes <= 1:
+        return size_bytes
+    return 1 << (size_bytes - 1).bit_length()
+# io_size_class (DONE)
+
+### Short label for a byte count (e.g. 512B, 4K, 1M)
+def size_label(g, size_bytes):
+    sign = "-" if size_bytes < 0 else ""
+    size_bytes = abs(size_bytes)
+    for (unit, scale) in (("T", g.GiB * 1024), ("G", g.GiB), ("M", g.MiB), ("K", g.KiB)):
+        if size_bytes >= scale:
+            return "%s%.4g%s" % (sign, float(size_bytes) / scale, unit)
+    return "%s%dB" % (sign, size_bytes)
+# size_label (DONE)
+
+### Build the merged per-bucket I/O count array (reads + writes).  It holds every bucket of the device,
+### so --memory doesn't bound it: the HTML report, --hot-extents and the detail pass still need it
+def get_bucket_counts(g):
+    if g.bucket_counts == None:
+        if g.memory_limit:
+            print "NOTE: building the per-bucket count array (%s), which --memory doesn't cover" % size_label(g, g.num_buckets * array.array('L').itemsize)
+        counts = array.array('L', [0]) * g.num_buckets
+        for (bucket, reads, writes) in bucket_totals(g):
+            if bucket >= g.num_buckets:
+                bucket = g.num_buckets - 1
+            counts[bucket] += reads + writes
+        g.bucket_counts = counts
+    return g.bucket_counts
+# get_bucket_counts (DONE)
+
+### Minimum bucket hit count for the hottest buckets covering X% of bucket hits
+def heat_thresholds(g, counts, percents):
+    hot = sorted([c for c in counts if c], reverse=True)
+    total = sum(hot)
+    thresholds = []
+    for percent in percents:
+        target = total * percent / 100.0
+        running = 0
+        threshold = 1
+        for c in hot:
+            running += c
+            threshold = c
+            if running >= target:
+                break
+        thresholds.append(threshold)
+    return thresholds
+# heat_thresholds (DONE)
+
+### Name the heat class of a bucket hit count
+def heat_class(g, thresholds, count):
+    for i in xrange(len(thresholds)):
+        if count >= thresholds[i]:
+            return g.heat_classes[i][0]
+    return 'cold'
+# heat_class (DONE)
+
+### Record Q2D, D2C and Q2C latency for one completed I/O
+def record_latency(g, rw, lba, size, q_time, d_time, c_time, counts, thresholds):
+    if (rw == 'R') or (rw == 'RW'):
+        rw = 'R'
+    elif (rw == 'W') or (rw == 'WS'):
+        rw = 'W'
+    else:
+        return
+    bucket = (lba * g.sector_size) / g.bucket_size
+    if bucket >= g.num_buckets:
+        bucket = g.num_buckets - 1
+    heat = heat_class(g, thresholds, counts[bucket])
+    size_class = io_size_class(g, size)
+    for (metric, usec) in (('Q2D', (d_time - q_time) * 1000000), ('D2C', (c_time - d_time) * 1000000), ('Q2C', (c_time - q_time) * 1000000)):
+        index = hdr_index(g, usec)
+        for key in ((metric, rw, 'all', ''), (metric, rw, 'size', size_class), (metric, rw, 'heat', heat)):
+            hist = g.thread_latency_hists.get(key)
+            if hist == None:
+                hist = g.thread_latency_hists[key] = [0] * g.hdr_size
+            hist[index] += 1
+    return
+# record_latency (DONE)
+
+### Intern a (pid, command) pair into a compact per-worker process ID
+def process_id(g, pid, command):
+    key = (pid, command)
+    if key not in g.thread_proc_ids:
+        if len(g.thread_proc_ids) >= g.proc_max:
+            # Too many short-lived processes, fold them by command name (a pid of None, real pids start at 0)
+            key = (None, command)
+            if key not in g.thread_proc_ids and len(g.thread_proc_ids) >= (g.proc_max * 2):
+                key = (None, "[other]")
+            if key in g.thread_proc_ids:
+                return g.thread_proc_ids[key]
+        g.thread_proc_ids[key] = len(g.thread_proc_ids)
+        g.thread_proc_counters.extend([0] * g.proc_stride)
+    return g.thread_proc_ids[key]
+# process_id (DONE)
+
+### Record one queued I/O against the process that issued it
+def record_process(g, pid, command, rw, lba, size, counts, thresholds):
+    if (rw == 'R') or (rw == 'RW'):
+        field = 0
+    elif (rw == 'W') or (rw == 'WS'):
+        field = 1
+    else:
+        return
+    base = process_id(g, pid, command) * g.proc_stride
+    counters = g.thread_proc_counters
+    counters[base + field] += 1
+    counters[base + 2 + field] += size
+    bucket = (lba * g.sector_size) / g.bucket_size
+    bucket_hits = (size * g.sector_size) / g.bucket_size
+    if ((size * g.sector_size) % g.bucket_size) != 0:
+        bucket_hits += 1
+    for i in xrange(bucket, bucket + bucket_hits):
+        if i >= g.num_buckets:
+            i = g.num_buckets - 1
+        counters[base + 4] += 1
+        if counts[i] >= thresholds[0]:
+            counters[base + 5] += 1
+    size_index = io_size_class(g, size).bit_length() - 10
+    if size_index < 0:
+        size_index = 0
+    elif size_index >= g.proc_size_classes:
+        size_index = g.proc_size_classes - 1
+    counters[base + 6 + size_index] += 1
+    return
+# record_process (DONE)
+
+### Combine thread-local process counters into global process counters
+def total_process_counts(g, num):
+    if len(g.thread_proc_ids) == 0:
+        return
+    g.proc_semaphore.acquire()
+    debug_print(g, "Thread " + str(num) + " has proc lock (" + str(len(g.thread_proc_ids)) + " processes)")
+    for key, proc_id in g.thread_proc_ids.iteritems():
+        local = g.thread_proc_counters[proc_id * g.proc_stride:(proc_id + 1) * g.proc_stride]
+        if key in g.proc_stats:
+            merged = g.proc_stats[key]
+            for i in xrange(g.proc_stride):
+                merged[i] += local[i]
+            g.proc_stats[key] = merged
+        else:
+            g.proc_stats[key] = local.tolist()
+    g.proc_semaphore.release()
+    return
+# total_process_counts (DONE)
+
+### Print top processes and commands by IOPS
+def print_top_processes(g):
+    if len(g.proc_stats) == 0:
+        return
+    stats = dict(g.proc_stats)
+    commands = {}
+    for (pid, command), counters in stats.iteritems():
+        if command in commands:
+            commands[command] = [a + b for (a, b) in zip(commands[command], counters)]
+        else:
+            commands[command] = list(counters)
+    total = sum([c[0] + c[1] for c in stats.itervalues()])
+    if total == 0:
+        return
+
+    print "--------------------------------------------"
+    for (title, table) in (("Top processes by IOPS:", stats), ("Top commands by IOPS:", commands)):
+        print title
+        print "%8s %12s %6s %10s %8s %6s  %s" % ("IOPS%", "I/O's", "Read%", "GiB", "TopSize", "Hot%", "PID/Command" if table is stats else "Command")
+        top_count = 0
+        for key in sorted(table, reverse=True, key=lambda k: table[k][0] + table[k][1]):
+            c = table[key]
+            ios = c[0] + c[1]
+            sizes = c[6:]
+            top_size = size_label(g, 1 << (sizes.index(max(sizes)) + 9))
+            if table is stats:
+                name = "%d %s" % key if key[0] != None else "* " + key[1]
+            else:
+                name = key
+            print "%7.2f%% %12d %5.1f%% %10.2f %8s %5.1f%%  %s" % (ios * 100.0 / total, ios, c[0] * 100.0 / ios if ios else 0,
+                float(c[2] + c[3]) * g.sector_size / g.GiB, top_size, c[5] * 100.0 / c[4] if c[4] else 0, name)
+            top_count += 1
+            if top_count >= g.top_count_limit:
+                break
+    print "--------------------------------------------"
+    return
+# print_top_processes (DONE)
+
+### Combine thread-local latency histograms into global histograms
+def total_latency_counts(g, num):
+    g.latency_semaphore.acquire()
+    debug_print(g, "Thread " + str(num) + " has latency lock")
+    for key, hist in g.thread_latency_hists.iteritems():
+        if key in g.latency_hists:
+            merged = g.latency_hists[key]
+            for i in xrange(len(hist)):
+                merged[i] += hist[i]
+            g.latency_hists[key] = merged
+        else:
+            g.latency_hists[key] = hist
+    g.inflight_dropped.value += g.thread_inflight_dropped
+    g.latency_semaphore.release()
+    return
+# total_latency_counts (DONE)
+
+### Detail parse routine: match Q/D/C events of a timestamped trace
+def thread_parse_detail(g, file, num, counts, thresholds):
+    inflight = collections.OrderedDict() # (lba, size) -> [queue time, dispatch time]
+    states = [burst_state(g, resolution) for resolution in g.burst_resolutions]
+    depth_time = {} # Queue depth -> seconds spent at that depth
+    depth = 0
+    last_time = None
+    pattern = re.compile('\s*(?:(\d+\.\d+)\s+)?(?:(\d+)\s+(.+?)\s+)?(\S+)\s+([QDC])\s+(\d+)\s+(\d+)$')
+    debug_print(g, "\nDETAIL START: %s %d\n", file, num)
+    events = 0
+    try:
+        fo = open(file, "r")
+    except:
+        print "ERROR: Failed to open " + file
+        sys.exit(3)
+    else:
+        for line in fo:
+            match = pattern.match(line)
+            if match == None:
+                continue
+            events += 1
+            (timestamp, pid, command, rw, action, lba, size) = match.groups()
+            if action == 'Q' and pid != None:
+                record_process(g, int(pid), command, rw, int(lba), int(size), counts, thresholds)
+            if timestamp == None:
+                continue
+            key = (lba, size)
+            now = float(timestamp)
+            if last_time != None:
+                depth_time[depth] = depth_time.get(depth, 0) + max(0, now - last_time)
+            last_time = now
+            if action == 'Q':
+                for state in states:
+                    burst_add(g, state, now, int(size))
+                inflight[key] = [now, None]
+                if len(inflight) > g.inflight_max:
+                    if inflight.popitem(last=False)[1][1] != None:
+                        depth -= 1
+                    g.thread_inflight_dropped += 1
+            elif action == 'D':
+                entry = inflight.get(key)
+                if entry != None and entry[1] == None:
+                    entry[1] = now
+                    depth += 1
+            else:
+                entry = inflight.pop(key, None)
+                if entry != None and entry[1] != None:
+                    depth -= 1
+                    record_latency(g, rw, int(lba), int(size), entry[0], entry[1], now, counts, thresholds)
+        fo.close()
+        phase_mark(g, 'detail', events, True)
+        total_latency_counts(g, num)
+        total_process_counts(g, num)
+        total_burst_counts(g, num, states, depth_time)
+        phase_mark(g, 'detail merge', events, True)
+        rc = os.system("rm -f " + file)
+    return
+# thread_parse_detail (DONE)
+
+### Second pass over timestamped traces, once bucket heat is known
+def detail_pass(g, file_list):
+    counts = get_bucket_counts(g)
+    thresholds = heat_thresholds(g, counts, [percent for (name, percent) in g.heat_classes])
+    verbose_print(g, "heat thresholds: " + str(thresholds))
+    print "Attributing latency and processes to buckets.  Please wait..."
+    plist = []
+    num = 0
+    for file in file_list:
+        num += 1
+        if not os.path.exists(file):
+            continue # Plain trace, already parsed and removed
+        if g.single_threaded:
+            thread_parse_detail(g, file, num, counts, thresholds)
+        else:
+            start_worker(g, plist, thread_parse_detail, file, num, counts, thresholds)
+    for p in plist:
+        p.join()
+    return
+# detail_pass (DONE)
+
+### New arrival-rate state for one window size: a ring of the newest windows, and HDR
+### histograms of the I/O's and sectors of every window that has left the ring
+def burst_state(g, resolution):
+    return {'resolution': resolution, 'base': None, 'last': 0, 'ios': [0] * g.burst_ring, 'sectors': [0] * g.burst_ring,
+            'hist_ios': [0] * g.hdr_size, 'hist_sectors': [0] * g.hdr_size, 'windows': 0, 'total_ios': 0, 'total_sectors': 0,
+            'peak_ios': 0, 'peak_sectors': 0, 'late': 0}
+# burst_state (DONE)
+
+### Move the oldest windows out of the ring until window fits in it
+def burst_retire(g, state, window):
+    ring = g.burst_ring
+    while window >= state['base'] + ring:
+        if state['base'] > state['last']:
+            # The ring is empty: count the idle gap's windows in bulk
+            skip = window - ring + 1 - state['base']
+            state['hist_ios'][0] += skip
+            state['hist_sectors'][0] += skip
+            state['windows'] += skip
+            state['base'] += skip
+            continue
+        slot = state['base'] % ring
+        (ios, sectors) = (state['ios'][slot], state['sectors'][slot])
+        state['hist_ios'][hdr_index(g, ios)] += 1
+        state['hist_sectors'][hdr_index(g, sectors)] += 1
+        state['windows'] += 1
+        state['total_ios'] += ios
+        state['total_sectors'] += sectors
+        state['peak_ios'] = max(state['peak_ios'], ios)
+        state['peak_sectors'] = max(state['peak_sectors'], sectors)
+        state['ios'][slot] = state['sectors'][slot] = 0
+        state['base'] += 1
+    return
+# burst_retire (DONE)
+
+### Count one queued I/O in the window of its timestamp (seconds since the start of its trace)
+def burst_add(g, state, timestamp, size):
+    window = int(timestamp / state['resolution'])
+    if state['base'] == None:
+        state['base'] = window
+    if window < state['base']:
+        state['late'] += 1 # Older than the ring, blkparse sorts events so this is rare
+        return
+    if window >= state['base'] + g.burst_ring:
+        burst_retire(g, state, window)
+    slot = window % g.burst_ring
+    state['ios'][slot] += 1
+    state['sectors'][slot] += size
+    state['last'] = max(state['last'], window)
+    return
+# burst_add (DONE)
+
+### Combine thread-local arrival-rate and queue depth summaries into the global list
+def total_burst_counts(g, num, states, depth_time):
+    if states[0]['base'] == None and not depth_time:
+        return
+    for state in states:
+        if state['base'] != None:
+            burst_retire(g, state, state['last'] + g.burst_ring)
+        del state['ios'], state['sectors']
+    g.burst_parts.append((states, depth_time))
+    return
+# total_burst_counts (DONE)
+
+### Print IOPS and bandwidth percentiles and peak-to-mean ratios per window size, and the queue depth
+def print_bursts(g):
+    g.burst_report = None
+    if len(g.burst_parts) == 0:
+        return
+    merged = [burst_state(g, resolution) for resolution in g.burst_resolutions]
+    depth_time = {}
+    for (states, part_depth_time) in g.burst_parts:
+        for (total, state) in zip(merged, states):
+            for key in ('hist_ios', 'hist_sectors'):
+                total[key] = [a + b for (a, b) in zip(total[key], state[key])]
+            for key in ('windows', 'total_ios', 'total_sectors', 'late'):
+                total[key] += state[key]
+            for key in ('peak_ios', 'peak_sectors'):
+                total[key] = max(total[key], state[key])
+        for (depth, seconds) in part_depth_time.iteritems():
+            depth_time[depth] = depth_time.get(depth, 0) + seconds
+    rows = []
+    for state in merged:
+        if state['windows'] == 0:
+            continue
+        resolution = state['resolution']
+        mean_ios = float(state['total_ios']) / state['windows']
+        mean_sectors = float(state['total_sectors']) / state['windows']
+        mib = float(g.sector_size) / g.MiB / resolution
+        # HDR percentiles are the top of their bucket, never report more than the peak
+        rows.append((resolution, mean_ios / resolution,
+                     [min(hdr_percentile(g, state['hist_ios'], percent), state['peak_ios']) / resolution for percent in g.burst_percentiles],
+                     state['peak_ios'] / resolution, state['peak_ios'] / mean_ios if mean_ios else 0, mean_sectors * mib,
+                     [min(hdr_percentile(g, state['hist_sectors'], percent), state['peak_sectors']) * mib for percent in g.burst_percentiles],
+                     state['peak_sectors'] * mib))
+    if not rows:
+        return
+    depth = None
+    if depth_time:
+        total_time = sum(depth_time.itervalues())
+        depths = sorted(depth_time)
+        percentiles = []
+        for percent in g.burst_percentiles:
+            running = 0
+            for d in depths:
+                running += depth_time[d]
+                if running >= total_time * percent / 100.0:
+                    percentiles.append(d)
+                    break
+        depth = (sum([d * t for (d, t) in depth_time.iteritems()]) / total_time if total_time else 0, percentiles, depths[-1])
+    g.burst_report = (rows, depth)
+
+    print "--------------------------------------------"
+    print "Burstiness (queued I/O's per window, within each trace interval):"
+    header = "%-8s %10s" % ("Window", "Mean IOPS")
+    for percent in g.burst_percentiles:
+        header += " %10s" % ("p" + str(percent))
+    header += " %10s %9s %10s %10s" % ("Peak IOPS", "Peak/mean", "Mean MiB/s", "Peak MiB/s")
+    print header
+    for (resolution, mean_iops, iops, peak_iops, ratio, mean_mib, mib, peak_mib) in rows:
+        line = "%-8s %10.0f" % ("%gms" % (resolution * 1000) if resolution < 1 else "%gs" % resolution, mean_iops)
+        for value in iops:
+            line += " %10.0f" % value
+        line += " %10.0f %9.1f %10.1f %10.1f" % (peak_iops, ratio, mean_mib, peak_mib)
+        print line
+    if depth != None:
+        (mean, percentiles, peak) = depth
+        print "Queue depth (dispatched, not completed; time-weighted): mean %.2f, %s, max %d" % (mean,
+            ", ".join(["p%s %d" % (percent, value) for (percent, value) in zip(g.burst_percentiles, percentiles)]), peak)
+    late = sum([state['late'] for state in merged])
+    if late:
+        print "%d out of order I/O's were older than the %d window ring and not counted" % (late, g.burst_ring)
+    print "--------------------------------------------"
+    return
+# print_bursts (DONE)
+
+### Print latency percentiles
+def print_latency(g):
+    if len(g.latency_hists) == 0:
+        return
+    hists = dict(g.latency_hists)
+    names = {'R': "READ", 'W': "WRITE"}
+    metrics = ['Q2D', 'D2C', 'Q2C']
+    heats = [name for (name, percent) in g.heat_classes] + ['cold']
+    keys = sorted(hists, key=lambda k: (k[1], metrics.index(k[0]), heats.index(k[3]) if k[2] == 'heat' else k[3]))
+    header = "%-20s" % "Latency (usec):"
+    for percent in g.percentiles:
+        header += "%10s" % ("p" + str(percent))
+    header += "%12s" % "count"
+
+    print "--------------------------------------------"
+    print header
+    for (group, title) in (('all', ''), ('size', "by I/O size"), ('heat', "by bucket heat")):
+        if title != '':
+            print "Q2C " + title + ":"
+        for key in keys:
+            (metric, rw, key_group, value) = key
+            if key_group != group or (group != 'all' and metric != 'Q2C'):
+                continue
+            label = metric + " " + names[rw]
+            if group == 'size':
+                label = size_label(g, value) + " " + names[rw]
+            elif group == 'heat':
+                label = value + " " + names[rw]
+            line = "%-20s" % label
+            for percent in g.percentiles:
+                line += "%10d" % hdr_percentile(g, hists[key], percent)
+            line += "%12d" % sum(hists[key])
+            print line
+    if g.inflight_dropped.value:
+        print "In-flight table overflow: %d I/O's dropped from latency stats" % g.inflight_dropped.value
+    print "--------------------------------------------"
+    return
+# print_latency (DONE)
+
 ## File trace routine
 def parse_filetrace(g, filename, num):
     thread_files_to_lbas = {}
@@ -1106,20 +4080,33 @@ def parse_filetrace(g, filename, num):
         print "ERROR: Failed to open " + filename + " Err: ", e
         sys.exit(3)
     else:
+        ranges_list = []
         for line in fo:
             result_set = regex_find(g, '(\S+)\s+::\s+(.+)', line)
             if result_set != False:
                 object = result_set[0]
                 ranges = result_set[1]
+                if g.spill_entries:
+                    # Out-of-core mode: sorted runs of bucket ranges instead of the shared hash
+                    ranges_list += [(start, finish, object) for (start, finish) in file_bucket_ranges(g, ranges)]
+                    if len(ranges_list) > g.spill_entries:
+                        write_run(g, "files", sorted(ranges_list))
+                        ranges_list = []
+                    continue
                 thread_files_to_lbas[object] = ranges
-                debug_print(g, filename + ": obj=" + object + " ranges:" + ranges + "\n")
+                debug_print(g, "%s: obj=%s ranges:%s\n", filename, object, ranges)
         fo.close()
+        if g.spill_entries:
+            if ranges_list:
+                write_run(g, "files", sorted(ranges_list))
+            return
 
         debug_print(g, "Thread " + str(num) + "wants file_to_lba lock for " + filename + "\n")
         g.files_to_lbas_semaphore.acquire()
         for key,value in thread_files_to_lbas.iteritems():
             g.files_to_lbas[key] = value
-            debug_print(g, "k=" + str(key) + " value=" + str(g.files_to_lbas[key]))
+            if g.debug:
+                debug_print(g, "k=%s value=%s", key, g.files_to_lbas[key])
         g.files_to_lbas_semaphore.release()
         debug_print(g, "Thread " + str(num) + "freed file_to_lba lock for " + filename + "\n")
 
@@ -1128,18 +4115,11 @@ def parse_filetrace(g, filename, num):
 
 ### Choose color for heatmap block
 def choose_color(g, num):
-    if num == -1 or num == 0:
+    if num <= 0:
+        g.color_index = " "
         return g.black
-    g.color_index = num / g.vpc
-    if (g.color_index > (g.choices - 1)):
-        g.debug = True
-        debug_print(g, "HIT! num=" + num)
-        g.debug = False
-        g.color_index=7
-        return g.red
-    color = g.colors[g.color_index]
-    debug_print(g, "cap=" + g.cap + " num=" + num + " ci=" + g.color_index + " vpc=" + g.vpc + " cap=" + g.cap)
-    return color
+    g.color_index = bisect.bisect_right(g.color_thresholds, num)
+    return g.colors[g.color_index]
 # choose_color (DONE)
 
 ### Clear Screen for heatmap (UNUSED)
@@ -1152,40 +4132,638 @@ def clear_screen(g):
 ### Get block value by combining buckets into larger heatmap blocks for term
 def get_value(g, offset, rate):
     start = offset * rate
-    end = start + rate
-    sum = 0
-
-    g.debug = True
-    debug_print(g, "start=" + start + " end=" + end)
-    g.debug = False
-
-    index=start
-    while(index <= end):
-        index+=1
-        r = 0
-        w = 0
-        if index in g.reads:
-            r = g.reads[index]
-        if index in g.writes:
-            w = g.writes[index]
-        sum = sum + r + w
-
-    g.debug = True
-    debug_print(g, "s=" + sum)
-    g.debug = False
-
-    return sum
+    return sum(get_bucket_counts(g)[start:start + rate])
 # get_value (DONE)
 
-### Draw heatmap on color terminal
+### Get terminal size (columns, lines)
+def terminal_size(g):
+    try:
+        (lines, cols) = struct.unpack('hh', fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, '1234'))
+    except:
+        (lines, cols) = (int(os.environ.get('LINES', 24)), int(os.environ.get('COLUMNS', 80)))
+    return (cols, lines)
+# terminal_size (DONE)
+
+### Draw a dense bucket count array or (bucket, reads, writes) totals as a heatmap on the color terminal, in one of <panes> heatmaps stacked to fit it
+def draw_heatmap_cells(g, totals, num_buckets, bucket_size, title, panes=1):
+    (cols, lines) = terminal_size(g)
+    term_x = cols - g.scale_x
+    term_y = (lines - g.scale_y - 5 * (panes - 1)) / panes
+    if term_x < g.min_x:
+        print "Make the terminal wider please"
+        return
+    elif term_y < g.min_y:
+        print "Make the terminal taller please"
+        return
+
+    # Downsample the buckets into one sum per terminal cell
+    holes = term_x * term_y
+    g.rate = max(1, (num_buckets + holes - 1) / holes)
+    if isinstance(totals, array.array):
+        # Dense per-bucket counts: reduce each cell's slice with C-level sums, no Python work per bucket
+        starts = xrange(0, num_buckets, g.rate)
+        cells = map(sum, itertools.imap(totals.__getslice__, starts, xrange(g.rate, num_buckets + g.rate, g.rate)))
+        cells.extend([0] * (holes - len(cells)))
+    else:
+        # Sparse (bucket, reads, writes) rows: only the touched buckets are visited
+        cells = [0] * max(holes, (num_buckets + g.rate - 1) / g.rate)
+        for (bucket, reads, writes) in totals:
+            cells[min(bucket, num_buckets - 1) / g.rate] += reads + writes
+
+    # Quantile color scale: each color gets an equal share of the non-empty cells
+    hot = sorted([value for value in cells if value])
+    g.cap = hot[-1] if hot else 0
+    g.color_thresholds = [hot[(len(hot) * i) / g.choices] for i in xrange(1, g.choices)] if hot else []
+    blocks = {}
+    for value in set(cells):
+        color = choose_color(g, value)
+        blocks[value] = color + str(g.color_index)
+    verbose_print(g, "cap=" + str(g.cap) + " thresholds=" + str(g.color_thresholds) + " holes=" + str(holes) + " rate=" + str(g.rate))
+
+    square_size = float(g.rate * bucket_size) / g.MiB
+    lookup = blocks.__getitem__
+    output = []
+    if title == '':
+        output.append("This heatmap can help you 'see' hot spots.  It is adjusted to terminal size, so each square = %0.2f MiB" % square_size)
+        output.append("The HTML report may be more precise with each pixel=%s" % size_label(g, bucket_size))
+    else:
+        output.append(title + ", each square = %s" % size_label(g, g.rate * bucket_size))
+    output.append("Heatmap Key: Black (No I/O), white(Coldest),blue(Cold),cyan(Warm),green(Warmer),yellow(Very Warm),magenta(Hot),red(Hottest)")
+    output.append("+" + "-" * term_x + "-+")
+    for y in xrange(term_y):
+        output.append("|" + "".join(map(lookup, cells[y * term_x:(y + 1) * term_x])) + g.none + "|")
+    output.append(g.none + "+" + "-" * term_x + "-+")
+    sys.stdout.write("\n".join(output) + "\n")
+    sys.stdout.flush()
+    return
+# draw_heatmap_cells (DONE)
+
+### Draw the device heatmap in the terminal (and the decayed one in live mode)
 def draw_heatmap(g):
+    # Use the dense bucket array unless that would be the only reason to build it under --memory
+    if g.bucket_counts != None or not g.memory_limit:
+        totals = get_bucket_counts(g)
+    else:
+        totals = bucket_totals(g)
+    if g.decay_scores == None:
+        draw_heatmap_cells(g, totals, g.num_buckets, g.bucket_size, '')
+        return
+    # Live mode with decayed scores: the last interval above the long-term hot spots
+    draw_heatmap_cells(g, totals, g.num_buckets, g.bucket_size, '', 2)
+    draw_heatmap_cells(g, [(bucket, score, 0) for (bucket, score) in decayed_scores(g)], g.num_buckets, g.bucket_size,
+                       "Decayed hotness (half-life %gs)" % g.half_life, 2)
     return
-# draw_heatmap (TODO)
+# draw_heatmap (DONE)
+
+### Get sector size, total LBAs and device name from fdisk output
+def parse_fdisk(g, out):
+    result = regex_find(g, "Units = sectors of \d+ \S \d+ = (\d+) bytes", out)
+    if result == False:
+        #Units: sectors of 1 * 512 = 512 bytes
+        result = regex_find(g, "Units: sectors of \d+ \* \d+ = (\d+) bytes", out)
+        if result == False:
+            print "ERROR: Sector Size Invalid"
+            sys.exit()
+    g.sector_size = int(result[0])
+    verbose_print(g, "sector size="+ str(g.sector_size))
+    result = regex_find(g, ".+ total (\d+) sectors", out)
+    if result == False:
+        #Disk /dev/sdb: 111.8 GiB, 120034123776 bytes, 234441648 sectors
+        result = regex_find(g, "Disk /dev/\S+: \d+.\d+ GiB, \d+ bytes, (\d+) sectors", out)
+        if result == False:
+            print "ERROR: Total LBAs is Invalid"
+            sys.exit()
+    g.total_lbas  = int(result[0])
+    verbose_print(g, "sector count ="+ str(g.total_lbas))
+
+    result = regex_find(g, "Disk (\S+): \S+ GB, \d+ bytes", out)
+    if result == False:
+        # LINE:  Disk /dev/sdb: 111.8 GiB, 120034123776 bytes, 234441648 sectors
+        result = regex_find(g, "Disk (\S+):", out)
+        if result == False:
+            print "ERROR: Device Name is Invalid"
+            sys.exit()
+    g.device = result[0]
+    verbose_print(g, "dev="+ g.device + " lbas=" + str(g.total_lbas) + " sec_size=" + str(g.sector_size))
+    return
+# parse_fdisk (DONE)
+
+### Fold this live interval's bucket hits into the decayed (EWMA) hotness scores.  Only the buckets hit
+### this interval are touched: each keeps the interval it was last updated in, and the decay it missed
+### since then is applied when it's next updated or read
+def decay_update(g):
+    if g.decay_scores == None:
+        g.decay_scores = array.array('d', [0.0]) * g.num_buckets
+        g.decay_epochs = array.array('L', [0]) * g.num_buckets
+        g.decay_factor = 0.5 ** (float(g.timeout) / g.half_life)
+    scores = g.decay_scores
+    epochs = g.decay_epochs
+    now = g.live_itterations
+    for (bucket, reads, writes) in bucket_totals(g):
+        if bucket >= g.num_buckets:
+            bucket = g.num_buckets - 1
+        scores[bucket] = scores[bucket] * g.decay_factor ** (now - epochs[bucket]) + reads + writes
+        epochs[bucket] = now
+        g.decay_live.add(bucket)
+    return
+# decay_update (DONE)
+
+### Decayed hotness scores as of this live interval: [(bucket, score)] of the buckets above the floor.
+### Buckets that decayed below it are forgotten, so reads only walk the buckets that are still warm
+def decayed_scores(g):
+    scores = []
+    now = g.live_itterations
+    for bucket in sorted(g.decay_live):
+        score = g.decay_scores[bucket] * g.decay_factor ** (now - g.decay_epochs[bucket])
+        if score < g.decay_floor:
+            g.decay_scores[bucket] = 0.0
+            g.decay_live.discard(bucket)
+        else:
+            scores.append((bucket, score))
+    return scores
+# decayed_scores (DONE)
+
+### Print the decayed histogram and compare the current interval's hot set with the long-term one (live mode)
+def print_decayed(g):
+    g.decay_report = None
+    if g.decay_scores == None:
+        return
+    hot = sorted([score for (bucket, score) in decayed_scores(g)], reverse=True)
+    total = sum(hot)
+    histogram = []
+    limit = g.percent * g.total_capacity_gib
+    (count, section, running, size) = (0, 0.0, 0.0, 0)
+    for (i, score) in enumerate(hot):
+        count += 1
+        section += score
+        if (count * g.bucket_size) / g.GiB > limit or i == len(hot) - 1:
+            size += count * g.bucket_size
+            running += section
+            histogram.append(("%.1f" % (float(size) / g.GiB), "%.1f" % (section * 100 / total), "%.1f" % (running * 100 / total)))
+            (count, section) = (0, 0.0)
+    current = hot_set_buckets(g, get_bucket_counts(g), g.hot_set_percents)
+    longterm = hot_set_buckets(g, hot, g.hot_set_percents)
+    g.decay_report = (histogram, current, longterm)
+
+    print "--------------------------------------------"
+    print "Histogram IOPS, decayed (half-life %gs, %d intervals):" % (g.half_life, g.live_itterations)
+    for (gb, io_perc, io_sum_perc) in histogram:
+        print gb + " GB " + io_perc + "% (" + io_sum_perc + "% cumulative)"
+    print "Hot set    " + "".join(["%10s" % ("%d%%" % percent) for percent in g.hot_set_percents])
+    print "  current  " + "".join(["%10s" % size_label(g, count * g.bucket_size) for count in current])
+    print "  decayed  " + "".join(["%10s" % size_label(g, count * g.bucket_size) for count in longterm])
+    print "--------------------------------------------"
+    return
+# print_decayed (DONE)
+
+### Reset all counters between live mode intervals
+def reset_counts(g):
+    g.thread_io_total = g.thread_bucket_hits_total = g.thread_read_total = g.thread_write_total = 0
+    g.thread_total_blocks = g.thread_max_bucket_hits = 0
+    for counters in (g.thread_r_totals, g.thread_w_totals, g.thread_reads, g.thread_writes,
+                     g.reads, g.writes, g.r_totals, g.w_totals, g.stream_stats):
+        counters.clear()
+    for value in (g.io_total, g.read_total, g.write_total, g.bucket_hits_total, g.total_blocks, g.max_bucket_hits):
+        value.value = 0
+    g.bucket_counts = None
+    g.thread_roi = None
+    del g.roi_parts[:]
+    return
+# reset_counts (DONE)
+
+### Path of a rollup in the daemon store
+def rollup_path(g, level, start):
+    (name, period, format) = g.store_levels[level]
+    return os.path.join(g.store, name, time.strftime(format, time.gmtime(start)) + ".json.gz")
+# rollup_path (DONE)
+
+### List the rollups of one store level as {start time: path}
+def list_rollups(g, level):
+    (name, period, format) = g.store_levels[level]
+    rollups = {}
+    directory = os.path.join(g.store, name)
+    if not os.path.isdir(directory):
+        return rollups
+    for filename in os.listdir(directory):
+        if filename.endswith(".json.gz"):
+            start = calendar.timegm(time.strptime(filename[:-len(".json.gz")], format))
+            rollups[start] = os.path.join(directory, filename)
+    return rollups
+# list_rollups (DONE)
+
+### Build a rollup from the thread-local counters of one capture interval
+def counts_to_rollup(g, start, period, dropped):
+    return {"start": start, "period": period, "io_total": g.thread_io_total, "read_total": g.thread_read_total,
+            "write_total": g.thread_write_total, "bucket_hits_total": g.thread_bucket_hits_total,
+            "total_blocks": g.thread_total_blocks, "dropped": dropped, "r_totals": g.thread_r_totals,
+            "w_totals": g.thread_w_totals, "reads": g.thread_reads, "writes": g.thread_writes}
+# counts_to_rollup (DONE)
+
+### Add one rollup into another
+def merge_rollup(g, total, rollup):
+    for key in g.rollup_totals:
+        total[key] = total.get(key, 0) + rollup[key]
+    for key in g.rollup_hashes:
+        hits = total.setdefault(key, {})
+        for (item, count) in rollup[key].iteritems():
+            hits[item] = hits.get(item, 0) + count
+    return total
+# merge_rollup (DONE)
+
+### Write a rollup (gzipped JSON), replacing any previous copy atomically
+def write_rollup(g, path, rollup):
+    record = dict(rollup)
+    for key in g.rollup_hashes:
+        record[key] = sorted(rollup[key].iteritems())
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    try:
+        fo = gzip.open(path + ".tmp", "wb", 6)
+    except:
+        print "ERROR: Failed to open " + path
+        sys.exit(3)
+    json.dump(record, fo)
+    fo.close()
+    os.rename(path + ".tmp", path)
+    return
+# write_rollup (DONE)
+
+### Read a rollup written by write_rollup
+def read_rollup(g, path):
+    fo = gzip.open(path, "rb")
+    rollup = json.load(fo)
+    fo.close()
+    for key in g.rollup_hashes:
+        rollup[key] = dict([(int(item), count) for (item, count) in rollup[key]])
+    return rollup
+# read_rollup (DONE)
+
+### Record (or check) the device geometry the store was captured with
+def store_geometry(g, create):
+    path = os.path.join(g.store, "device.json")
+    fields = ["device", "device_str", "sector_size", "total_lbas", "bucket_size"]
+    if os.path.exists(path):
+        fo = open(path, "r")
+        geometry = json.load(fo)
+        fo.close()
+        if create and [geometry[field] for field in fields] != [getattr(g, field) for field in fields]:
+            print "ERROR: " + g.store + " was captured from a different device or bucket size: " + str(geometry)
+            sys.exit(11)
+        (g.device, g.device_str, g.sector_size, g.total_lbas, g.bucket_size) = [geometry[field] for field in fields]
+        return
+    if not create:
+        print "ERROR: " + g.store + " is not an ioprof store (no device.json)"
+        sys.exit(11)
+    if not os.path.isdir(g.store):
+        os.makedirs(g.store)
+    fo = open(path, "w")
+    json.dump(dict([(field, getattr(g, field)) for field in fields] + [("version", g.version)]), fo)
+    fo.close()
+    return
+# store_geometry (DONE)
+
+### Compact finished periods into the next coarser level, then apply the retention limits
+def compact_store(g, now):
+    for level in xrange(1, len(g.store_levels)):
+        period = g.store_levels[level][1]
+        existing = list_rollups(g, level)
+        groups = {}
+        for (start, path) in list_rollups(g, level - 1).iteritems():
+            groups.setdefault(start - start % period, []).append(path)
+        for (start, paths) in sorted(groups.iteritems()):
+            if start + period > now or start in existing:
+                continue
+            # One rollup in memory at a time, plus the running total
+            total = {"start": start, "period": period}
+            for path in sorted(paths):
+                merge_rollup(g, total, read_rollup(g, path))
+            write_rollup(g, rollup_path(g, level, start), total)
+            verbose_print(g, "compacted %d %s rollups into %s", len(paths), g.store_levels[level - 1][0], rollup_path(g, level, start))
+
+    for level in xrange(len(g.store_levels)):
+        rollups = list_rollups(g, level)
+        for start in sorted(rollups)[:max(0, len(rollups) - g.store_retention[level])]:
+            # Only expire rollups that a coarser level already covers (the coarsest level just expires)
+            if level + 1 < len(g.store_levels):
+                period = g.store_levels[level + 1][1]
+                if not os.path.exists(rollup_path(g, level + 1, start - start % period)):
+                    continue
+            os.remove(rollups[start])
+    return
+# compact_store (DONE)
+
+### Pick the fewest rollups that cover [start, end) exactly once, coarsest first
+def select_rollups(g, start, end):
+    levels = [(period, list_rollups(g, level)) for (level, (name, period, format)) in enumerate(g.store_levels)]
+    levels.reverse()
+    finest = g.store_levels[0][1]
+    t = start - start % finest
+    chosen = []
+    while t < end:
+        for (period, rollups) in levels:
+            if t % period == 0 and t + period <= end and t in rollups:
+                chosen.append(rollups[t])
+                t += period
+                break
+        else:
+            t += finest
+    return chosen
+# select_rollups (DONE)
+
+### Parse a --from/--to time: epoch seconds or YYYY-mm-dd[ HH:MM[:SS]] (UTC)
+def parse_time(g, text):
+    if re.match("^\d+$", text):
+        return int(text)
+    for format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return calendar.timegm(time.strptime(text, format))
+        except ValueError:
+            pass
+    print "ERROR: invalid time " + text + " (use epoch seconds or YYYY-mm-dd HH:MM UTC)"
+    sys.exit(11)
+# parse_time (DONE)
+
+### Load the counters for a time range from the daemon store (post mode --store)
+def load_store(g):
+    end = g.store_to
+    if end == 0:
+        # Up to now, including the minute being captured
+        end = int(time.time()) + 60 - int(time.time()) % 60
+    paths = select_rollups(g, g.store_from, end)
+    if len(paths) == 0:
+        print "ERROR: no rollups in " + g.store + " between " + time.strftime("%Y-%m-%d %H:%M", time.gmtime(g.store_from)) + " and " + time.strftime("%Y-%m-%d %H:%M", time.gmtime(end)) + " UTC"
+        sys.exit(11)
+    total = {}
+    covered = 0
+    for path in paths:
+        rollup = read_rollup(g, path)
+        merge_rollup(g, total, rollup)
+        covered += rollup["period"]
+    print "Loaded %d rollups covering %d of the %d minutes from %s to %s UTC" % (len(paths), covered / 60, (end - g.store_from) / 60,
+        time.strftime("%Y-%m-%d %H:%M", time.gmtime(g.store_from)), time.strftime("%Y-%m-%d %H:%M", time.gmtime(end)))
+    g.reads = total["reads"]
+    g.writes = total["writes"]
+    g.r_totals = total["r_totals"]
+    g.w_totals = total["w_totals"]
+    for key in ("io_total", "read_total", "write_total", "bucket_hits_total", "total_blocks"):
+        getattr(g, key).value = total[key]
+    g.max_bucket_hits.value = max(g.reads.values() + g.writes.values() + [0])
+    # Daemon mode only traces Q events, so the captured events are the I/O's
+    g.trace_events = total["io_total"]
+    g.trace_dropped = total["dropped"]
+    g.trace_seconds = covered
+    return
+# load_store (DONE)
+
+### Read the sector size and total LBA's of a device (block device ioctls, or sysfs if those fail)
+def device_geometry(g):
+    try:
+        fd = os.open(g.device, os.O_RDONLY)
+        try:
+            g.sector_size = struct.unpack("i", fcntl.ioctl(fd, g.BLKSSZGET, struct.pack("i", 0)))[0]
+            size = struct.unpack("Q", fcntl.ioctl(fd, g.BLKGETSIZE64, struct.pack("Q", 0)))[0]
+        finally:
+            os.close(fd)
+    except (OSError, IOError):
+        sysfs = "/sys/class/block/" + os.path.basename(os.path.realpath(g.device))
+        queue = sysfs + "/queue"
+        if not os.path.isdir(queue):
+            queue = sysfs + "/../queue" # Partitions share the queue of their disk
+        try:
+            size = int(open(sysfs + "/size").read()) * 512 # Always in 512 byte units
+            g.sector_size = int(open(queue + "/logical_block_size").read())
+        except (IOError, ValueError):
+            print "ERROR: Failed to read the size of " + g.device
+            sys.exit(2)
+    g.total_lbas = size / g.sector_size
+    verbose_print(g, "dev=%s lbas=%d sec_size=%d", g.device, g.total_lbas, g.sector_size)
+    return
+# device_geometry (DONE)
+
+### Save the device geometry in the fdisk format that the 'post' phase reads
+def write_geometry(g, filename):
+    try:
+        fo = open(filename, "w")
+    except:
+        print "ERROR: Failed to open " + filename
+        sys.exit(3)
+    size = g.total_lbas * g.sector_size
+    fo.write("Disk %s: %.1f GiB, %d bytes, %d sectors\n" % (g.device, float(size) / g.GiB, size, g.total_lbas))
+    fo.write("Units: sectors of 1 * %d = %d bytes\n" % (g.sector_size, g.sector_size))
+    partitions = sysfs_partitions(g)
+    if partitions:
+        fo.write("\n%-16s %12s %12s %12s %7s\n" % ("Device", "Start", "End", "Sectors", "Size"))
+        for (name, start, end) in partitions:
+            fo.write("%-16s %12d %12d %12d %6.1fG\n" % ("/dev/" + name, start, end - 1, end - start, float(end - start) * g.sector_size / g.GiB))
+    fo.close()
+    return
+# write_geometry (DONE)
+
+### Get the partitions (name, start, end) of the traced device from sysfs, in device sectors
+def sysfs_partitions(g):
+    partitions = []
+    for (kname, dev, dm_name, start, sectors, parent) in sysfs_block_devices(g):
+        if parent == os.path.basename(os.path.realpath(g.device)):
+            partitions.append((start * 512 / g.sector_size, (start + sectors) * 512 / g.sector_size, kname))
+    return [(name, start, end) for (start, end, name) in sorted(partitions)]
+# sysfs_partitions (DONE)
+
+### List the block devices in sysfs: (kernel name, major:minor, dm name, start, sectors, parent disk), 512 byte sectors
+def sysfs_block_devices(g):
+    devices = []
+    for path in sorted(glob.glob("/sys/class/block/*")):
+        fields = {}
+        for field in ("dev", "start", "size", "dm/name"):
+            try:
+                fields[field] = open(os.path.join(path, field)).read().strip()
+            except IOError:
+                fields[field] = None
+        if fields["dev"] == None or fields["size"] == None:
+            continue
+        parent = None
+        if fields["start"] != None:
+            parent = os.path.basename(os.path.dirname(os.path.realpath(path)))
+        devices.append((os.path.basename(path), fields["dev"], fields["dm/name"], int(fields["start"] or 0), int(fields["size"]), parent))
+    return devices
+# sysfs_block_devices (DONE)
+
+### Save the device-mapper tables and device numbers, so 'post' mode can attribute I/O to LVs or backing devices
+def write_layout(g, filename):
+    devices = sysfs_block_devices(g)
+    if not [device for device in devices if device[2] != None]:
+        return False # No device-mapper devices
+    if find_program(g, "dmsetup") == None:
+        verbose_print(g, "dmsetup not installed, skipping the device-mapper layout")
+        return False
+    (rc, table) = run_cmd(g, "dmsetup table")
+    if rc != 0:
+        verbose_print(g, "dmsetup table failed, skipping the device-mapper layout")
+        return False
+    try:
+        fo = open(filename, "w")
+    except:
+        print "ERROR: Failed to open " + filename
+        sys.exit(3)
+    fo.write("# ioprof layout v1: dev <major:minor> <name> <dm name> <start> <sectors> <parent> (512 byte sectors), then 'dmsetup table'\n")
+    for (kname, dev, dm_name, start, sectors, parent) in devices:
+        fo.write("dev %s %s %s %d %d %s\n" % (dev, kname, dm_name or "-", start, sectors, parent or "-"))
+    for line in table.splitlines():
+        if line.strip():
+            fo.write("table " + line + "\n")
+    fo.close()
+    return True
+# write_layout (DONE)
+
+### Write the trace metadata member: geometry, layout, capture settings, drop counts and host, as JSON
+def write_metadata(g, filename, start, capture_log, layout):
+    uname = os.uname()
+    meta = {"format": "ioprof-trace", "format_version": g.meta_version, "ioprof_version": g.version,
+            "device": g.device, "device_str": g.device_str, "sector_size": g.sector_size, "total_lbas": g.total_lbas,
+            "partitions": [{"name": name, "start": start_lba, "end": end_lba} for (name, start_lba, end_lba) in sysfs_partitions(g)],
+            "layout": None,
+            "capture": {"start": start, "end": time.time(), "runtime": g.runtime, "interval": g.timeout,
+                        "intervals": len(capture_log), "traced_intervals": sum([entry[1] for entry in capture_log]),
+                        "buffer_size_kib": g.buffer_size, "buffer_count": g.buffer_count, "events": g.trace_events, "dropped": g.trace_dropped,
+                        "actions": g.blktrace_actions, "blkparse_format": g.blkparse_format,
+                        "latency": g.latency, "procs": g.procs, "files": g.trace_files},
+            "host": {"hostname": uname[1], "kernel": uname[2], "machine": uname[4], "cpus": multiprocessing.cpu_count(),
+                     "python": sys.version.split()[0]}}
+    if layout:
+        (devices, tables) = read_layout(g, "layout." + g.device_str)
+        meta["layout"] = {"devices": devices, "tables": tables}
+    try:
+        fo = open(filename, "w")
+    except:
+        print "ERROR: Failed to open " + filename
+        sys.exit(3)
+    json.dump(meta, fo, indent=1, sort_keys=True)
+    fo.write("\n")
+    fo.close()
+    return
+# write_metadata (DONE)
+
+### Snapshot resource usage before a capture (for print_overhead)
+def overhead_start(g):
+    return (time.time(), os.times())
+# overhead_start (DONE)
+
+### Print the CPU and memory ioprof and its blktrace/blkparse children used during a capture
+def print_overhead(g, start):
+    (wall, before) = start
+    after = os.times()
+    elapsed = max(time.time() - wall, 0.001)
+    cpu_self = (after[0] - before[0]) + (after[1] - before[1])
+    cpu_children = (after[2] - before[2]) + (after[3] - before[3])
+    rss_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    printf("Capture overhead: %.2f CPU seconds over %.0f seconds (%.2f%% of one CPU): ioprof %.2fs, blktrace/blkparse %.2fs\n",
+           cpu_self + cpu_children, elapsed, (cpu_self + cpu_children) * 100 / elapsed, cpu_self, cpu_children)
+    printf("Capture memory: ioprof %.1f MiB peak RSS, largest blktrace/blkparse %.1f MiB peak RSS, %d KiB kernel trace buffers per CPU\n",
+           rss_self / 1024.0, rss_children / 1024.0, g.buffer_size * g.buffer_count)
+    print "  (in-kernel tracepoint cost is paid by the traced I/O's and is not included)"
+    return
+# print_overhead (DONE)
+
+### Size the buckets and heatmap for the device geometry
+def set_buckets(g):
+    g.total_capacity_gib = g.total_lbas * g.sector_size / g.GiB
+    printf("lbas: %d sec_size: %d total: %0.2f GiB\n", g.total_lbas, g.sector_size, g.total_capacity_gib)
+    g.num_buckets = g.total_lbas * g.sector_size / g.bucket_size
+    g.y_height = g.x_width = int(math.sqrt(g.num_buckets))
+    verbose_print(g, "num_buckets=" + str(g.num_buckets) + " sector_size=" + str(g.sector_size) + " total_lbas=" + str(g.total_lbas) + " bucket_size=" + str(g.bucket_size))
+    return
+# set_buckets (DONE)
+
+### Blktrace events dropped so far on a device being traced (read from debugfs)
+def debugfs_dropped(g):
+    try:
+        fo = open("/sys/kernel/debug/block/" + g.device_str + "/dropped", "r")
+        dropped = int(fo.read().strip())
+        fo.close()
+    except (IOError, ValueError):
+        return 0
+    return dropped
+# debugfs_dropped (DONE)
+
+### Fold the current interval into its minute rollup and compact the store
+def flush_rollup(g, start, dropped):
+    period = g.store_levels[0][1]
+    rollup = counts_to_rollup(g, start, period, dropped)
+    path = rollup_path(g, 0, start)
+    if os.path.exists(path):
+        # Restarted within the same minute: add to what the last run wrote
+        rollup = merge_rollup(g, read_rollup(g, path), rollup)
+    write_rollup(g, path, rollup)
+    debug_print(g, "%s: %d I/O's, %d dropped", path, g.thread_io_total, dropped)
+    reset_counts(g)
+    compact_store(g, start + period)
+    return
+# flush_rollup (DONE)
+
+### Trace continuously, keeping only per-minute aggregates in the store (daemon mode)
+def run_daemon(g):
+    store_geometry(g, True)
+    blktrace_err = os.path.join(g.store, "blktrace.err")
+    cmd = "nice -n 19 blktrace -b " + str(g.buffer_size) + " -n " + str(g.buffer_count) + " -a queue -d " + g.device + " -o - 2>" + blktrace_err + " | nice -n 19 blkparse -q -i - -f '" + g.blkparse_format + "'"
+    debug_print(g, "cmd: " + cmd)
+    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, preexec_fn=os.setsid)
+    def stop(signum, frame):
+        g.daemon_stopping = True
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print "Capturing " + g.device + " into " + g.store + " (pid " + str(os.getpid()) + ", SIGTERM to stop)"
+    sys.stdout.flush()
+    overhead = overhead_start(g)
+
+    period = g.store_levels[0][1]
+    began = time.time()
+    start = int(began) - int(began) % period
+    deadline = began + g.runtime if g.runtime != 0 else None
+    dropped_last = debugfs_dropped(g)
+    fd = p.stdout.fileno()
+    pending = ""
+    eof = False
+    while True:
+        now = time.time()
+        finished = g.daemon_stopping or eof or (deadline != None and now >= deadline)
+        if now >= start + period or finished:
+            dropped = debugfs_dropped(g)
+            flush_rollup(g, start, max(0, dropped - dropped_last))
+            dropped_last = dropped
+            start = int(now) - int(now) % period
+            if finished:
+                break
+        try:
+            (ready, unused, unused) = select.select([fd], [], [], max(0.1, min(start + period, deadline or start + period) - time.time()))
+        except select.error:
+            continue # Interrupted by a signal
+        if ready:
+            data = os.read(fd, 65536)
+            if data == "":
+                eof = True
+                continue
+            lines = (pending + data).split("\n")
+            pending = lines.pop()
+            parse_lines(g, lines)
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    p.wait()
+    (rc, err) = run_cmd(g, "cat " + blktrace_err)
+    if eof and not g.daemon_stopping:
+        print "ERROR: blktrace stopped unexpectedly: " + err
+        sys.exit(7)
+    print "Stopped capturing " + g.device
+    print_overhead(g, overhead)
+    return
+# run_daemon (DONE)
 
 ### Cleanup temp files
 def cleanup_files(g):
     verbose_print(g, "Cleaning up temp files\n")
-    for file in g.cleanup:
+    for file in g.cleanup + [name for (kind, name) in g.spill_runs]:
         debug_print(g, file)
         os.system("rm -f " + file)
     os.system("rm -f filetrace.*.txt")
@@ -1242,40 +4820,74 @@ def main(argv):
     print "VERSION: ", g.version
 
     check_args(g, argv)
+    phase_start(g)
+    if g.cprofile != '':
+        if not os.path.isdir(g.cprofile):
+            os.makedirs(g.cprofile)
+        main_profile = cProfile.Profile()
+        main_profile.enable()
+    if g.format != '':
+        if g.mode == 'trace' or g.mode == 'daemon' or g.mode == 'diff':
+            print "ERROR: --format is only available in 'post' and 'live' modes"
+            sys.exit(10)
+        open_output(g)
+    if g.roi_ranges and (g.mode not in ('post', 'live') or g.store != ''):
+        print "ERROR: --lba-range is only available in 'post' mode on a trace tarball and in 'live' mode"
+        sys.exit(10)
+    if g.iolog_file != '' and (g.mode != 'post' or g.store != ''):
+        print "ERROR: --fio-iolog is only available in 'post' mode on a trace tarball"
+        sys.exit(10)
+    if g.fio_job_file != '' and (g.mode != 'post' or g.iolog_file != ''):
+        print "ERROR: --fio-job is only available in 'post' mode"
+        sys.exit(10)
+    if g.overwrite and (g.mode != 'post' or g.store != ''):
+        print "ERROR: --overwrites is only available in 'post' mode on a trace tarball"
+        sys.exit(10)
+    if g.hot_file != '' and g.mode != 'post':
+        print "ERROR: --hot-extents is only available in 'post' mode"
+        sys.exit(10)
 
-    if g.mode == 'live' or g.mode == 'trace':
+    if g.mode == 'live' or g.mode == 'trace' or g.mode == 'daemon':
         mount_debugfs(g)
 
     if g.mode == 'trace':
         # Trace
 
-        # Check sudo permissions
-        rc = os.system("sudo -v &>/dev/null")
-        if rc != 0:
-            print "ERROR: You need to have sudo permissions to collect all necessary data.  Please run from a privilaged account."
+        # blktrace needs root
+        if os.geteuid() != 0:
+            print "ERROR: You need to be root to collect all necessary data.  Please run from a privilaged account."
             sys.exit(6)
-        # Save fdisk info
-        debug_print(g, "Running fdisk")
-        fdisk_version = ""
-        (rc, fdisk_version) = run_cmd(g, "fdisk -v")
-        match = re.search("util-linux-ng", fdisk_version)
-        if match:
-            # RHEL 6.x
-            os.system("fdisk -ul "+g.device+" > fdisk."+g.device_str)
-        else:
-            # RHEL 7.x
-            os.system("fdisk -l -u=sectors "+g.device+" > fdisk."+g.device_str)
+        # Save the device geometry
+        device_geometry(g)
+        write_geometry(g, "fdisk." + g.device_str)
+        layout = write_layout(g, "layout." + g.device_str)
 
-        os.system("rm -f blk.out.* &>/dev/null") # Cleanup previous mess
+        for file in glob.glob("blk.out.*"): # Cleanup previous mess
+            os.remove(file)
+        overhead = overhead_start(g)
+        capture_log = []
+        interval = 0
         runcount = g.runtime / g.timeout
+        trace_count = 0
         while runcount > 0:
             time_left = runcount * g.timeout
             percent_prog = (g.runtime - time_left) * 100  / g.runtime
             printf( "\r%d %% done (%d seconds left)", percent_prog, time_left)
             # BEN
             sys.stdout.flush()
-            cmd = "blktrace -b " + str(g.buffer_size) + " -n " + str(g.buffer_count) + " -a queue -d " + str(g.device) + " -o blk.out." + str(g.device_str) + ".0 -w " + str(g.timeout) + " &> /dev/null"
-            rc = os.system(cmd)
+            interval += 1
+            runcount -= 1
+            if (interval - 1) % g.sample_every != 0:
+                # Sampled out
+                capture_log.append((interval, 0, g.buffer_size, g.buffer_count, 0, 0))
+                time.sleep(g.timeout)
+                continue
+            blk_out = "blk.out." + g.device_str + "." + str(trace_count)
+            cmd = "blktrace -b " + str(g.buffer_size) + " -n " + str(g.buffer_count) + " " + g.blktrace_actions + " -d " + str(g.device) + " -o " + blk_out + " -w " + str(g.timeout)
+            debug_print(g, "cmd: " + cmd)
+            p = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            out = p.communicate()[0]
+            rc = p.returncode
             if rc != 0:
                 print "Unable to run the 'blktrace' tool required to trace all of your I/O"
                 print "If you are using SLES 11 SP1, then it is likely that your default kernel is missing CONFIG_BLK_DEV_IO_TRACE"
@@ -1286,31 +4898,77 @@ def main(argv):
                 print "option enabled.  This should allow blktrace to function\n"
                 print "ERROR: Could not run blktrace"
                 sys.exit(7)
-            cmd = "blkparse -i blk.out." + g.device_str + ".0 -q -f " + '" %d %a %S %n\n" | grep -v cfq | gzip --fast > blk.out.' + g.device_str + ".0.blkparse.gz;"
-            rc = os.system(cmd)
-            runcount -= 1
+            p = subprocess.Popen(["blkparse", "-i", blk_out, "-q", "-f", g.blkparse_format], stdout=subprocess.PIPE)
+            write_block_trace(g, (line for line in p.stdout if "cfq" not in line), blk_out + ".blkparse.gz")
+            p.wait()
+            for file in glob.glob(blk_out + ".blktrace.*"):
+                os.remove(file)
+            trace_count += 1
+            (events, dropped) = blktrace_stats(g, out)
+            capture_log.append((interval, 1, g.buffer_size, g.buffer_count, events, dropped))
+            g.trace_events += events
+            g.trace_dropped += dropped
+            tune_capture(g, events, dropped)
+        write_capture_log(g, "capture." + g.device_str, capture_log)
+        print "\r100 % done                              "
+        if drop_percent(g) != None:
+            printf("blktrace dropped %d of %d events (%.2f%%)\n", g.trace_dropped, g.trace_events + g.trace_dropped, drop_percent(g))
+        print_overhead(g, overhead)
         print "\rMapping files to block locations                "
         if g.trace_files:
             find_all_files(g)
         tarball_name = g.device_str + ".tar"
         print "\rCreating tarball " + tarball_name
-        filetrace = ""
+        members = sorted(glob.glob("blk.out." + g.device_str + ".*.gz")) + sorted(glob.glob("blk.out." + g.device_str + ".*.idx"))
+        write_metadata(g, g.meta_file, overhead[0], capture_log, layout)
+        members += [g.meta_file, "fdisk." + g.device_str, "capture." + g.device_str]
+        if layout:
+            members.append("layout." + g.device_str)
         if g.trace_files:
-            filetrace = "filetrace." + g.device_str + ".*.txt.gz"
-        cmd = "tar -cf " + tarball_name + " blk.out." + g.device_str + ".*.gz fdisk." + g.device_str + " " + filetrace + " &> /dev/null"
-        print cmd
-        rc = os.system(cmd)
+            members += sorted(glob.glob("filetrace." + g.device_str + ".*.txt.gz"))
+        debug_print(g, "tar -cf " + tarball_name + " " + " ".join(members))
+        # No shell: under /bin/sh (dash) a '&>' redirect would background tar while its inputs are removed
+        devnull = open(os.devnull, "w")
+        rc = subprocess.call(["tar", "-cf", tarball_name] + members, stdout=devnull, stderr=devnull)
+        devnull.close()
         if rc != 0:
             print "ERROR: failed to tarball " + tarball_name
             sys.exit(8)
-        cmd = "rm -f blk.out." + g.device_str + ".*.gz; rm -f fdisk." + g.device_str + "; rm -f filetrace." + g.device_str + ".*.gz"
-        rc = os.system(cmd)
+        for file in members:
+            os.remove(file)
         print "\rFINISHED tracing: " + tarball_name
         name = os.path.basename(__file__)
         print "Please use this file with " + name + " -m post -t " + tarball_name + " to create a report"
 
+    elif g.mode == 'post' and g.store != '':
+        # Post, from the rollups of a daemon store
+        set_buckets(g)
+        load_store(g)
+        phase_mark(g, 'load', g.io_total.value)
+        print_results(g)
+        print_stats(g)
+        if g.fio_job_file != '':
+            print_model(g)
+        if g.hot_file != '':
+            export_hot_extents(g)
+        if g.format != '':
+            write_record(g)
+        draw_heatmap(g)
+        if g.pdf == True:
+            print_header_heatmap(g)
+            print_header_histogram_iops(g)
+            print_header_stats_iops(g)
+            create_report(g)
+        phase_mark(g, 'report', g.bucket_hits_total.value)
+
+    elif g.mode == 'post' and g.iolog_file != '':
+        # Post, converting the trace into a fio iolog
+        export_iolog(g)
+        cleanup_files(g)
+
     elif g.mode == 'post':
         # Post 
+        start_manager(g)
         g.THREAD_MAX = multiprocessing.cpu_count() * 4
         cmd = 'tar -tf ' + g.tarfile 
         print g.tarfile
@@ -1331,43 +4989,38 @@ def main(argv):
             print "ERROR: Failed to unpack input file: " + g.tarfile
             sys.exit(9)
 
-        rc=0
-        out=""
-        (rc, out) = run_cmd(g, 'cat '+ g.fdisk_file )
-        result = regex_find(g, "Units = sectors of \d+ \S \d+ = (\d+) bytes", out)
-        if result == False:
-            #Units: sectors of 1 * 512 = 512 bytes
-            result = regex_find(g, "Units: sectors of \d+ \* \d+ = (\d+) bytes", out)
-            if result == False:
-                print "ERROR: Sector Size Invalid"
-                sys.exit()
-        g.sector_size = int(result[0])
-        verbose_print(g, "sector size="+ str(g.sector_size))
-        result = regex_find(g, ".+ total (\d+) sectors", out)
-        if result == False:
-            #Disk /dev/sdb: 111.8 GiB, 120034123776 bytes, 234441648 sectors
-            result = regex_find(g, "Disk /dev/\w+: \d+.\d+ GiB, \d+ bytes, (\d+) sectors", out)
-            if result == False:
-                print "ERROR: Total LBAs is Invalid"
-                sys.exit()
-        g.total_lbas  = int(result[0])
-        verbose_print(g, "sector count ="+ str(g.total_lbas))
-
-        result = regex_find(g, "Disk (\S+): \S+ GB, \d+ bytes", out)
-        if result == False:
-            # LINE:  Disk /dev/sdb: 111.8 GiB, 120034123776 bytes, 234441648 sectors
-            result = regex_find(g, "Disk (\S+):", out)
-            if result == False:
-                print "ERROR: Device Name is Invalid"
-                sys.exit()
-        g.device = result[0]
-        verbose_print(g, "dev="+ g.device + " lbas=" + str(g.total_lbas) + " sec_size=" + str(g.sector_size))
-
+        if g.meta_file in file_list:
+            # Self-describing trace: the tarball name doesn't matter
+            g.cleanup.remove(g.fdisk_file)
+            (partitions, layout) = read_metadata(g, g.meta_file)
+            g.fdisk_file = "fdisk." + g.device_str
+            g.cleanup += [g.meta_file, g.fdisk_file]
+        else:
+            # Older traces: scrape the fdisk output
+            try:
+                out = open(g.fdisk_file, "r").read()
+            except:
+                print "ERROR: Failed to open " + g.fdisk_file
+                sys.exit(3)
+            parse_fdisk(g, out)
+            partitions = parse_partitions(g, out)
+            layout = None
+            if "layout." + g.device_str in file_list:
+                layout = read_layout(g, "layout." + g.device_str)
+        if "layout." + g.device_str in file_list:
+            g.cleanup.append("layout." + g.device_str)
+        build_regions(g, partitions, layout)
+        phase_mark(g, 'unpack', len(file_list))
 
         g.total_capacity_gib = g.total_lbas * g.sector_size / g.GiB
         printf("lbas: %d sec_size: %d total: %0.2f GiB\n", g.total_lbas, g.sector_size, g.total_capacity_gib)
 
         g.num_buckets = g.total_lbas * g.sector_size / g.bucket_size
+        if g.roi_ranges:
+            setup_roi(g)
+        if g.overwrite:
+            g.thread_overwrite_hist = [0] * g.hdr_size
+            g.overwrite_head = (min([trace_number(g, name) for name in file_list if name.startswith("blk.out.")] or [0]), 0)
 
         # Make the PDF plot a square matrix to keep gnuplot happy
         g.y_height = g.x_width = int(math.sqrt(g.num_buckets))
@@ -1379,26 +5032,59 @@ def main(argv):
         rc = os.system("rm -f filetrace." + g.device_str + ".*.txt")
         rc = os.system("rm -f blk.out." + g.device_str + ".*.blkparse")
         print "Time to parse.  Please wait...\n"
+        if g.memory_limit:
+            # Out-of-core mode: one worker per CPU, each with an equal share of the memory ceiling
+            g.thread_max = g.parse_workers
+            share = g.memory_limit / g.parse_workers
+            if g.overwrite:
+                # Half of each share goes to the overwrite state
+                share /= 2
+                g.overwrite_max_chunks = max(64, share / g.overwrite_chunk_bytes)
+            g.spill_entries = max(1024, share / g.spill_entry_bytes)
+            verbose_print(g, "memory limit %d MiB: spilling after %d entries per worker", g.memory_limit / g.MiB, g.spill_entries)
 
         size = len(file_list)
         file_count = 0
 
         plist = []
+        blk_files = []
         for filename in file_list:
             file_count += 1
             perc = file_count * 100 / size
             printf("\rInput Percent: %d %% (File %d of %d) threads=%d", (file_count*100 / size), file_count, size, len(plist))
             sys.stdout.flush()
+            if filename.endswith(".idx"):
+                continue # Block index, read along with its trace below
+            if filename.startswith("capture."):
+                read_capture_log(g, filename)
+                g.cleanup.append(filename)
+                continue
             result = regex_find(g, "(blk.out.\S+).gz", filename)
             if result != False:
                 new_file = result[0]
-                if g.single_threaded:
+                blk_files.append(new_file)
+                index = read_block_index(g, filename)
+                if index != None:
+                    fo = open(filename, "rb")
+                    detail = len(read_trace_line(g, fo, index[0]).split()) > 4
+                    fo.close()
+                    if detail:
+                        # Timestamped traces are kept whole for the detail pass
+                        g.cleanup.append(filename + ".idx")
+                        index = None
+                if index != None:
+                    # Block-compressed trace: split it across the workers by byte range
+                    g.cleanup += [filename, filename + ".idx"]
+                    for blocks in split_blocks(g, index, g.parse_workers):
+                        if g.single_threaded:
+                            thread_parse_range(g, filename, blocks, file_count)
+                        else:
+                            start_worker(g, plist, thread_parse_range, filename, blocks, file_count)
+                elif g.single_threaded:
                     thread_parse(g, new_file, file_count)
                     debug_print(g, "blk.out hit = " + filename + "\n")
                 else:
-                    p = Process(target=thread_parse, args=(g, new_file, file_count))
-                    plist.append(p)
-                    p.start()
+                    start_worker(g, plist, thread_parse, new_file, file_count)
             result = regex_find(g, "(filetrace.\S+.\S+.txt).gz", filename)
             if result != False:
                 new_file = result[0]
@@ -1408,19 +5094,7 @@ def main(argv):
                     parse_filetrace(g, new_file, file_count)
                     debug_print(g, "blk.out hit = " + filename + "\n")
                 else:
-                    p = Process(target=parse_filetrace, args=(g, new_file, file_count))
-                    plist.append(p)
-                    p.start()
-            while len(plist) > g.thread_max:
-                for p in plist:
-                    try:
-                        p.join(0)
-                    except:
-                        pass
-                    else:
-                        if not p.is_alive():
-                            plist.remove(p)
-                time.sleep(0.10)
+                    start_worker(g, plist, parse_filetrace, new_file, file_count)
         if g.single_threaded == False:
             x=1
             while len(plist) > 0:
@@ -1443,21 +5117,107 @@ def main(argv):
                             plist.remove(p)
                 time.sleep(0.10)
         print "\rFinished parsing files.  Now to analyze         \n"
-        file_to_buckets(g)
+        phase_mark(g, 'parse', g.io_total.value)
+        if g.spill_entries:
+            merge_spill_runs(g)
+            phase_mark(g, 'merge', len(g.spill_runs))
+        if g.detail_trace.value:
+            detail_pass(g, blk_files)
+            phase_mark(g, 'detail', g.io_total.value)
+        if g.spill_entries == 0:
+            file_to_buckets(g)
+            phase_mark(g, 'map', len(g.files_to_lbas))
         print_results(g)
+        print_top_processes(g)
         print_stats(g)
+        print_streams(g)
+        print_latency(g)
+        print_bursts(g)
+        print_regions(g)
+        print_roi(g)
+        print_overwrites(g)
+        if g.fio_job_file != '':
+            print_model(g)
+        if g.hot_file != '':
+            export_hot_extents(g)
+        if g.format != '':
+            write_record(g)
         draw_heatmap(g)
         if g.pdf == True:
             print_header_heatmap(g)
             print_header_histogram_iops(g)
             print_header_stats_iops(g)
             create_report(g)
+        phase_mark(g, 'report', g.bucket_hits_total.value)
         cleanup_files(g)
         
     elif g.mode == 'live':
         # Live
-        print "Live Mode - Coming Soon ..."
+        g.timeout = 1
+        g.sample_max = 1 # Every interval is displayed, so drops only grow the buffers
+        device_geometry(g)
+        set_buckets(g)
+        if g.roi_ranges:
+            setup_roi(g)
+        blktrace_err = "blktrace." + g.device_str + ".err"
+        g.cleanup.append(blktrace_err)
+        if g.metrics_port:
+            start_metrics_server(g)
+        while True:
+            g.live_itterations += 1
+            if g.runtime != 0 and (g.live_itterations * g.timeout) > g.runtime:
+                verbose_print(g, "Exceeded " + str(g.runtime) + " runtime.  Exiting.")
+                break
+            cmd = "blktrace -b " + str(g.buffer_size) + " -n " + str(g.buffer_count) + " -a queue -w " + str(g.timeout) + " -d " + g.device + " -o - 2>" + blktrace_err + " | blkparse -q -i - -f '" + g.blkparse_format + "' | grep -v cfq"
+            p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+            events = parse_lines(g, p.stdout)
+            p.wait()
+            # Parsing streams while blktrace runs, so this phase includes its -w wait
+            phase_mark(g, 'capture', g.thread_io_total)
+            total_thread_counts(g, 0)
+            if g.half_life:
+                decay_update(g)
+            phase_mark(g, 'merge', g.io_total.value)
+            (rc, err) = run_cmd(g, "cat " + blktrace_err)
+            # Only queue events are traced, so every event blktrace kept is a line parse_lines counted
+            g.trace_events = events
+            g.trace_dropped = blktrace_stats(g, err)[1]
+
+            print_results(g)
+            print_stats(g)
+            print_roi(g)
+            print_decayed(g)
+            if g.format != '':
+                write_record(g)
+            if g.metrics_port:
+                publish_metrics(g, g.trace_dropped)
+            draw_heatmap(g)
+            phase_mark(g, 'report', g.bucket_hits_total.value)
+            reset_counts(g)
+            tune_capture(g, g.trace_events, g.trace_dropped)
+        cleanup_files(g)
+
+    elif g.mode == 'diff':
+        # Diff
+        before = load_diff_input(g, g.diff_inputs[0])
+        after = load_diff_input(g, g.diff_inputs[1])
+        print_diff(g, before, after)
+        cleanup_files(g)
+
+    elif g.mode == 'daemon':
+        # Daemon
+        device_geometry(g)
+        set_buckets(g)
+        run_daemon(g)
 
+    if g.output_fo != None:
+        g.output_fo.close()
+    if g.profile != '':
+        print_profile(g)
+    if g.cprofile != '':
+        main_profile.disable()
+        main_profile.dump_stats(os.path.join(g.cprofile, "main.%d.prof" % os.getpid()))
+        print "cProfile output is in " + g.cprofile
     sys.exit()
 # main (IN PROGRESS)
 
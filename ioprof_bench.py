@@ -0,0 +1,315 @@
+#!/usr/bin/python -tt
+# I/O Profiler for Linux - post-processing benchmark
+# Copyright (c) 2017, Intel Corporation.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# Generates deterministic synthetic trace tarballs (the same layout 'trace'
+# mode produces) and times each phase of 'ioprof.py -m post' against them
+# (using its --profile output).
+# No block device, blktrace or root access is needed.
+#
+
+import sys, getopt, os, re, gzip, random, bisect, tarfile, tempfile, shutil, time, subprocess, json, itertools, imp
+
+# Global Variables
+
+class bench_variables:
+    def __init__(self):
+        self.version         = "1.0.0.1"                    # Version string
+        self.verbose         = False                        # Verbose logging (-v flag)
+        self.keep            = False                        # Keep generated tarballs and work dirs (-k flag)
+        self.ioprof          = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ioprof.py") # Script under test
+        self.python          = sys.executable               # Interpreter for the script under test
+        self.extra_args      = []                           # Extra ioprof.py arguments (-a flag)
+
+        # Unit Scales
+        self.KiB             = 1024                         # 2^10
+        self.MiB             = 1048576                      # 2^20
+        self.GiB             = 1073741824                   # 2^30
+        self.TiB             = 1099511627776                # 2^40
+
+        # Generator settings
+        self.device_str      = "sdz"                        # Device name recorded in the tarball
+        self.device_sizes    = [10 * self.GiB]              # Device sizes to benchmark (-s flag)
+        self.sector_size     = 512                          # Sector size (bytes)
+        self.events          = 1000000                      # Queued I/O's per trace (-e flag)
+        self.members         = 4                            # blk.out.*.blkparse.gz members per trace (-n flag)
+        self.block_size      = 0                            # Write block-compressed members with this block size, 0 = single stream (-b flag)
+        self.trace_block_size  = 0                          # Block size passed to ioprof.write_block_trace
+        self.trace_block_level = 1                          # gzip level passed to ioprof.write_block_trace
+        self.ioprof_module   = None                         # ioprof.py loaded as a module (-b flag)
+        self.files           = 0                            # Files in the filetrace member, 0 = none (-f flag)
+        self.seed            = 1                            # Random seed (--seed flag)
+        self.theta           = 1.0                          # Zipf theta of hot spot popularity (-z flag)
+        self.hot_spots       = 1024                         # Number of hot spots
+        self.hot_spot_size   = 64 * self.MiB                # Size of each hot spot
+        self.seq_fraction    = 0.30                         # Fraction of I/O's that continue a sequential stream
+        self.streams         = 8                            # Concurrent sequential streams
+        self.read_fraction   = 0.70                         # Fraction of I/O's that are reads
+        self.sizes           = [(1, 5), (8, 50), (16, 15), (64, 15), (256, 10), (2048, 5)] # (sectors, weight) I/O size mix
+# bench_variables
+
+### Print usage
+def usage(g, argv):
+    name = os.path.basename(__file__)
+    print "Invalid command\n"
+    print name,
+    for opt in argv:
+        print opt,
+    print "\n\nUsage:"
+    print name + " [-s <size>[,<size>...]] [-e <events>] [-n <members>] [-b <size>] [-f <files>] [-z <theta>] [--seed <n>] [-a <args>] [-k] [-v]"
+    print "\nCommand Line Arguments:"
+    print "-s <size>,...       : (OPTIONAL) Device sizes to benchmark, with a K/M/G/T/P suffix (default: 10G).  e.g. -s 1G,1T,100T"
+    print "-e <events>         : (OPTIONAL) Queued I/O's per generated trace (default: 1000000)"
+    print "-n <members>        : (OPTIONAL) blk.out.*.blkparse.gz members per trace (default: 4)"
+    print "-b <size>           : (OPTIONAL) Write block-compressed members (gzip members of <size> plus an .idx offset index)"
+    print "                      that post mode splits across all CPUs, e.g. -b 16M"
+    print "-f <files>          : (OPTIONAL) Also generate a filetrace member mapping <files> files to LBA ranges"
+    print "-z <theta>          : (OPTIONAL) Zipf theta of hot spot popularity (default: 1.0)"
+    print "--seed <n>          : (OPTIONAL) Random seed.  The same seed always generates the same trace (default: 1)"
+    print "-a <args>           : (OPTIONAL) Extra arguments for ioprof.py -m post (e.g. -a '--format json')"
+    print "-k                  : (OPTIONAL) Keep the generated tarballs and work directories"
+    print "-v                  : (OPTIONAL) Print the ioprof.py output"
+    sys.exit(-1)
+# usage (DONE)
+
+### Parse a size with an optional K/M/G/T/P suffix into bytes
+def parse_size(g, text):
+    match = re.match("^(\d+(?:\.\d+)?)([KMGTP]?)i?B?$", text.upper())
+    if match == None:
+        return 0
+    return int(float(match.group(1)) * (1024 ** " KMGTP".index(match.group(2) or " ")))
+# parse_size (DONE)
+
+### Check arguments
+def check_args(g, argv):
+    try:
+        opts, args = getopt.getopt(argv, "s:e:n:b:f:z:a:kv", ["seed="])
+    except getopt.GetoptError as err:
+        print str(err)
+        usage(g, argv)
+
+    for opt, arg in opts:
+        if opt == '-s':
+            g.device_sizes = [parse_size(g, size) for size in arg.split(",")]
+            if 0 in g.device_sizes:
+                usage(g, argv)
+        elif opt == '-e':
+            g.events = int(arg)
+        elif opt == '-n':
+            g.members = max(1, int(arg))
+        elif opt == '-b':
+            g.block_size = parse_size(g, arg)
+            if g.block_size == 0:
+                usage(g, argv)
+            g.trace_block_size = g.block_size
+            g.ioprof_module = imp.load_source("ioprof", g.ioprof)
+        elif opt == '-f':
+            g.files = int(arg)
+        elif opt == '-z':
+            g.theta = float(arg)
+        elif opt == '--seed':
+            g.seed = int(arg)
+        elif opt == '-a':
+            g.extra_args = arg.split()
+        elif opt == '-k':
+            g.keep = True
+        elif opt == '-v':
+            g.verbose = True
+        else:
+            usage(g, argv)
+    if args:
+        usage(g, argv)
+    return
+# check_args (DONE)
+
+### Human readable byte count (e.g. 10G, 100T)
+def size_str(g, size):
+    for (unit, scale) in (("P", g.TiB * 1024), ("T", g.TiB), ("G", g.GiB), ("M", g.MiB), ("K", g.KiB)):
+        if size >= scale:
+            return "%g%s" % (float(size) / scale, unit)
+    return "%dB" % size
+# size_str (DONE)
+
+### Write the fdisk member in the same format 'fdisk -l -u=sectors' uses
+def write_fdisk(g, filename, device_size):
+    total_lbas = device_size / g.sector_size
+    fo = open(filename, "w")
+    fo.write("Disk /dev/%s: %0.1f GiB, %d bytes, %d sectors\n" % (g.device_str, float(device_size) / g.GiB, device_size, total_lbas))
+    fo.write("Units: sectors of 1 * %d = %d bytes\n" % (g.sector_size, g.sector_size))
+    fo.write("Sector size (logical/physical): %d bytes / %d bytes\n" % (g.sector_size, g.sector_size))
+    fo.close()
+    return
+# write_fdisk (DONE)
+
+### Cumulative weights for weighted/Zipf choices
+def cumulative(weights):
+    total = 0.0
+    cdf = []
+    for weight in weights:
+        total += weight
+        cdf.append(total)
+    return cdf
+# cumulative (DONE)
+
+### Generate blkparse lines: Zipf hot spots, sequential streams and mixed sizes
+def trace_lines(g, rand, device_size):
+    total_lbas = device_size / g.sector_size
+    spot_lbas = min(g.hot_spot_size / g.sector_size, total_lbas)
+    spots = [rand.randrange(0, total_lbas - spot_lbas + 1) for i in xrange(g.hot_spots)]
+    spot_cdf = cumulative([1.0 / ((rank + 1) ** g.theta) for rank in xrange(g.hot_spots)])
+    size_cdf = cumulative([weight for (sectors, weight) in g.sizes])
+    streams = [rand.randrange(0, total_lbas) for i in xrange(g.streams)]
+
+    for i in xrange(g.events):
+        size = g.sizes[bisect.bisect(size_cdf, rand.random() * size_cdf[-1])][0]
+        if rand.random() < g.seq_fraction:
+            stream = rand.randrange(g.streams)
+            lba = streams[stream]
+            if lba + size > total_lbas:
+                lba = 0
+            streams[stream] = lba + size
+        else:
+            spot = spots[bisect.bisect(spot_cdf, rand.random() * spot_cdf[-1])]
+            lba = spot + rand.randrange(0, max(1, spot_lbas - size))
+        lba = min(lba, total_lbas - size)
+        rw = "R" if rand.random() < g.read_fraction else "W"
+        # blkparse -f " %d %a %S %n\n"
+        yield " %s Q %d %d\n" % (rw, lba, size)
+# trace_lines (DONE)
+
+### Write the blkparse members, splitting the events evenly between them
+def write_blkparse(g, rand, names, device_size):
+    events = trace_lines(g, rand, device_size)
+    for member in xrange(len(names)):
+        count = g.events / len(names) + (1 if member < g.events % len(names) else 0)
+        lines = itertools.islice(events, count)
+        if g.block_size:
+            # Block-compressed members with an offset index, written by ioprof.py itself
+            g.ioprof_module.write_block_trace(g, lines, names[member])
+            continue
+        fo = gzip.open(names[member], "wb", 1)
+        while True:
+            chunk = list(itertools.islice(lines, 65536))
+            if not chunk:
+                break
+            fo.write("".join(chunk))
+        fo.close()
+    return
+# write_blkparse (DONE)
+
+### Write the filetrace member: "<file> :: <start>:<finish> ..." per file
+def write_filetrace(g, rand, name, device_size):
+    total_lbas = device_size / g.sector_size
+    fo = gzip.open(name, "wb", 1)
+    for i in xrange(g.files):
+        extents = []
+        for j in xrange(rand.randint(1, 4)):
+            start = rand.randrange(0, total_lbas)
+            extents.append("%d:%d" % (start, min(total_lbas - 1, start + rand.randrange(8, 65536))))
+        fo.write("/mnt/bench/dir%d/file%d :: %s \n" % (i % 64, i, " ".join(extents)))
+    fo.close()
+    return
+# write_filetrace (DONE)
+
+### Generate a trace tarball for one device size
+def generate_trace(g, workdir, device_size):
+    rand = random.Random(g.seed)
+    members = ["fdisk." + g.device_str]
+    write_fdisk(g, os.path.join(workdir, members[0]), device_size)
+    names = ["blk.out.%s.%d.blkparse.gz" % (g.device_str, n) for n in xrange(g.members)]
+    write_blkparse(g, rand, [os.path.join(workdir, name) for name in names], device_size)
+    members += names
+    if g.block_size:
+        members += [name + ".idx" for name in names]
+    if g.files:
+        name = "filetrace.%s.0.txt.gz" % g.device_str
+        write_filetrace(g, rand, os.path.join(workdir, name), device_size)
+        members.append(name)
+
+    tarball = os.path.join(workdir, g.device_str + ".tar")
+    tar = tarfile.open(tarball, "w")
+    for name in members:
+        tar.add(os.path.join(workdir, name), arcname=name)
+        os.remove(os.path.join(workdir, name))
+    tar.close()
+    return tarball
+# generate_trace (DONE)
+
+### Run 'ioprof.py -m post --profile json' on a tarball and collect its phase times
+def run_post(g, workdir, tarball):
+    cmd = [g.python, g.ioprof, "-m", "post", "-t", os.path.basename(tarball), "--profile", "json"] + g.extra_args
+    env = dict(os.environ)
+    env["LINES"] = "40"
+    env["COLUMNS"] = "100"
+    start = time.time()
+    p = subprocess.Popen(cmd, cwd=workdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    out = p.stdout.read()
+    # wait4() returns the resource usage of this run only (including its workers)
+    (pid, status, usage) = os.wait4(p.pid, 0)
+    end = time.time()
+    if g.verbose:
+        sys.stdout.write(out)
+    if status != 0:
+        print "ERROR: ioprof.py exited with status " + str(status >> 8)
+
+    times = {}
+    for line in out.split("\n"):
+        if line.startswith('{"profile"'):
+            for row in json.loads(line)["profile"]:
+                if not row["workers"]:
+                    times[row["phase"]] = row["wall"]
+    times["total"] = end - start
+    times["cpu"] = usage.ru_utime + usage.ru_stime
+    times["max_rss"] = usage.ru_maxrss * 1024
+    return times
+# run_post (DONE)
+
+### MAIN
+def main(argv):
+    g = bench_variables()
+    check_args(g, argv)
+    print "VERSION: ", g.version
+    print "Benchmarking %s: %d events, %d members, %d files, seed %d" % (g.ioprof, g.events, g.members, g.files, g.seed)
+    if g.block_size:
+        print "Block-compressed members: %s blocks" % size_str(g, g.block_size)
+
+    columns = ["device", "gen", "unpack", "parse", "detail", "map", "report", "total", "cpu", "events/s", "peak RSS"]
+    rows = []
+    for device_size in g.device_sizes:
+        workdir = tempfile.mkdtemp(prefix="ioprof_bench.")
+        start = time.time()
+        tarball = generate_trace(g, workdir, device_size)
+        gen = time.time() - start
+        times = run_post(g, workdir, tarball)
+        parse = times.get("parse", 0)
+        rate = g.events / parse if parse else 0
+        row = [size_str(g, device_size), "%.2f" % gen] + ["%.2f" % times.get(phase, 0) for phase in ("unpack", "parse", "detail", "map", "report", "total", "cpu")]
+        row += ["%d" % rate, "%.1fM" % (float(times["max_rss"]) / g.MiB)]
+        rows.append(row)
+        if g.keep:
+            print "Kept " + workdir
+        else:
+            shutil.rmtree(workdir)
+
+    print "--------------------------------------------"
+    print "Post-processing times (seconds):"
+    line = "".join(["%10s" % column for column in columns])
+    print line
+    for row in rows:
+        print "".join(["%10s" % value for value in row])
+    print "--------------------------------------------"
+    return
+# main (DONE)
+
+### Start MAIN
+if __name__ == "__main__":
+    main(sys.argv[1:])
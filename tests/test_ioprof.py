@@ -0,0 +1,151 @@
+#!/usr/bin/python -tt
+# I/O Profiler for Linux - unit tests
+# Copyright (c) 2017, Intel Corporation.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# Run with: python -m unittest discover tests
+#
+
+import os, sys, gzip, tarfile, tempfile, shutil, imp, unittest, StringIO
+
+ioprof = imp.load_source('ioprof', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ioprof.py'))
+
+### Work in a scratch directory, the way post mode unpacks tarballs into the current one
+class scratch_test(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp(prefix="ioprof_test.")
+        os.chdir(self.dir)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+### fio iolog export (--fio-iolog)
+class export_iolog_test(scratch_test):
+    events = [(1.0, 'R', 13512, 8), (1.002, 'WS', 3033, 8), (1.0105, 'R', 2048, 256), (1.5, 'D', 4096, 8)]
+
+    def write_tarball(self):
+        fo = open("fdisk.sdb", "w")
+        fo.write("Disk /dev/sdb: 1.0 GiB, 1073741824 bytes, 2097152 sectors\nUnits: sectors of 1 * 512 = 512 bytes\n")
+        fo.close()
+        fo = gzip.open("blk.out.sdb.0.blkparse.gz", "w")
+        for (timestamp, rw, lba, size) in self.events:
+            fo.write("%12.9f %s Q %d %d\n" % (timestamp, rw, lba, size))
+            fo.write("%12.9f %s C %d %d\n" % (timestamp + 0.0001, rw, lba, size))
+        fo.close()
+        tar = tarfile.open("sdb.tar", "w")
+        for name in ("fdisk.sdb", "blk.out.sdb.0.blkparse.gz"):
+            tar.add(name)
+            os.remove(name)
+        tar.close()
+
+    def export(self, version):
+        self.write_tarball()
+        g = ioprof.global_variables()
+        g.tarfile = "sdb.tar"
+        g.device_str = "sdb"
+        g.fdisk_file = "fdisk.sdb"
+        g.iolog_file = "sdb.iolog"
+        g.iolog_version = version
+        ioprof.export_iolog(g)
+        return open(g.iolog_file).read().splitlines()
+
+    def test_v2_field_counts(self):
+        lines = self.export(2)
+        self.assertEqual(lines[0], "fio version 2 iolog")
+        waits = 0
+        for line in lines[1:]:
+            fields = line.split()
+            if fields[1] in ('add', 'open', 'close'):
+                self.assertEqual(len(fields), 2, line)
+            else:
+                # I/O's and waits are <file> <action> <offset> <length>
+                self.assertEqual(len(fields), 4, line)
+                waits += fields[1] == 'wait'
+        self.assertEqual(waits, len(self.events) - 1)
+        self.assertIn("/dev/sdb wait 8500 0", lines)
+
+    def test_v3_field_counts(self):
+        lines = self.export(3)
+        self.assertEqual(lines[0], "fio version 3 iolog")
+        for line in lines[1:]:
+            fields = line.split()
+            self.assertNotEqual(fields[2], 'wait', line)
+            if fields[2] in ('add', 'open', 'close'):
+                self.assertEqual(len(fields), 3, line)
+            else:
+                # <timestamp> <file> <action> <offset> <length>
+                self.assertEqual(len(fields), 5, line)
+        self.assertIn("2000000 /dev/sdb write 1552896 4096", lines)
+
+### Out-of-core merge of spilled runs (--memory)
+class spill_runs_test(scratch_test):
+    def test_device_name_with_dots(self):
+        g = ioprof.global_variables()
+        g.device_str = "mapper_vg0-lv.data"
+        ioprof.write_run(g, "buckets", [(1, 2, 0), (5, 0, 1)])
+        ioprof.write_run(g, "buckets", [(1, 1, 1), (7, 3, 0)])
+        ioprof.merge_spill_runs(g)
+        self.assertNotEqual(g.bucket_file, '')
+        self.assertEqual(list(ioprof.bucket_totals(g, True)), [(1, 3, 1), (5, 0, 1), (7, 3, 0)])
+
+### Overwrite analysis (--overwrites)
+class overwrite_test(unittest.TestCase):
+    def test_write_clock_past_32_bits(self):
+        g = ioprof.global_variables()
+        g.sector_size = 512
+        g.thread_segment = (0, 4096)
+        g.thread_overwrite_hist = [0] * g.hdr_size
+        g.thread_write_clock = 1 << 32
+        ioprof.track_overwrite(g, 0, 16)
+        ioprof.track_overwrite(g, 8, 8)
+        self.assertEqual(sum(g.thread_overwrite_hist), 1)
+        (blocks, lasts, counts, firsts) = ioprof.overwrite_state(g)
+        self.assertEqual(list(blocks), [0, 1])
+        self.assertEqual(list(lasts), [(1 << 32) + 1, (1 << 32) + 3])
+        self.assertEqual(list(counts), [1, 2])
+        self.assertEqual(list(firsts), [(1 << 32) + 1, (1 << 32) + 1])
+
+### Partition, logical volume and backing device attribution
+class regions_test(unittest.TestCase):
+    # sda2 is an extended partition holding the logical partitions sda5 and sda6
+    partitions = [("sda1", 2048, 4096), ("sda2", 4096, 100000), ("sda5", 6144, 50000), ("sda6", 52000, 100000)]
+
+    def setUp(self):
+        self.g = ioprof.global_variables()
+        self.g.sector_size = 512
+        self.g.bucket_size = 1024 * 1024
+        ioprof.build_regions(self.g, self.partitions, None)
+
+    def test_extended_partition_left_out(self):
+        (kind, starts, entries) = self.g.regions[0]
+        self.assertEqual(kind, 'partition')
+        self.assertEqual([entry[2][1] for entry in entries], ["sda1", "sda5", "sda6"])
+
+    def test_extended_and_logical_layout(self):
+        g = self.g
+        ioprof.attribute_batch(g, [('R', 3000, 8), ('W', 6144, 8), ('R', 51000, 8), ('W', 60000, 16), ('R', 49000, 8)])
+        stats = g.thread_region_stats
+        self.assertEqual(sorted(stats), [('partition', "sda1"), ('partition', "sda5"), ('partition', "sda6")])
+        self.assertEqual(stats[('partition', "sda1")][:4], [1, 0, 8, 0])
+        self.assertEqual(stats[('partition', "sda5")][:4], [1, 1, 8, 8])
+        self.assertEqual(stats[('partition', "sda6")][:4], [0, 1, 0, 16])
+        # Hot extents split at the same boundaries, the space between logical partitions is device-relative
+        parts = ioprof.partition_extents(g, [(0, 48, 49)], [1] * 49)
+        self.assertEqual([part[0] for part in parts], ['-', "sda1", '-', "sda5", '-', "sda6", '-'])
+        self.assertEqual(sum([part[3] for part in parts]), 49)
+
+if __name__ == '__main__':
+    unittest.main()